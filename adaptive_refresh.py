@@ -0,0 +1,63 @@
+import logging
+
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class RefreshResult:
+    members: int
+    changes: int                        # roles and nickname changes applied
+    requests: int                       # bulk requests sent
+    average_latency: float              # average time of bulk request, including waits for Discord's rate limits (seconds)
+    rate_limited: int                   # requests rejected by Discord with 429
+
+
+class RefreshIntervalTuner:
+    """
+        Chooses auto refresh interval (in minutes) from results of the last refresh, within [min_interval, max_interval].
+
+        Interval grows when Discord was throttling the bot (429 responses, or requests slowed down by per route limits)
+        or when refresh changed nothing, and shrinks when a noticeable part of members needed changes.
+    """
+    SlowRequestLatency = 0.5            # average bulk request time (seconds) above which there is no rate limit headroom
+    HighChangeRatio = 0.01              # part of members changed above which roles are considered stale
+    GrowFactor = 2.0
+    IdleGrowFactor = 1.5
+    ShrinkFactor = 0.5
+
+    def __init__(self, min_interval: int, max_interval: int, logger: logging.Logger):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(f"Invalid auto refresh bounds: {min_interval} - {max_interval}")
+
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.logger = logger
+        self.last_result: Optional[RefreshResult] = None
+        self.reason = "brak danych z poprzedniego odświeżenia"
+
+    def next_interval(self, current: int, result: RefreshResult) -> int:
+        self.last_result = result
+        change_ratio = result.changes / result.members if result.members > 0 else 0.0
+
+        if result.rate_limited > 0 or result.average_latency > RefreshIntervalTuner.SlowRequestLatency:
+            factor = RefreshIntervalTuner.GrowFactor
+            self.reason = f"Discord ogranicza zapytania (odrzucone: {result.rate_limited}, średni czas zapytania {result.average_latency:.2f}s)"
+        elif result.changes == 0:
+            factor = RefreshIntervalTuner.IdleGrowFactor
+            self.reason = "ostatnie odświeżenie nic nie zmieniło"
+        elif change_ratio > RefreshIntervalTuner.HighChangeRatio:
+            factor = RefreshIntervalTuner.ShrinkFactor
+            self.reason = f"ostatnie odświeżenie zmieniło {result.changes} z {result.members} użytkowników"
+        else:
+            factor = 1.0
+            self.reason = f"ostatnie odświeżenie zmieniło niewielu użytkowników ({result.changes})"
+
+        interval = min(max(round(current * factor), self.min_interval), self.max_interval)
+
+        if interval == current and factor != 1.0:
+            self.reason += ", osiągnięto granicę"
+
+        self.logger.info(f"Auto refresh interval {current} -> {interval} minutes ({result})")
+
+        return interval
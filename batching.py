@@ -0,0 +1,63 @@
+import asyncio
+import logging
+
+from typing import Awaitable, Callable, Generic, List, TypeVar
+
+T = TypeVar("T")
+
+
+class MicroBatcher(Generic[T]):
+    """
+        Collects items and passes them to `process` in batches.
+
+        Batch is processed `delay` seconds after its first item arrived or as soon as it reaches `max_size` items.
+        Items added while a batch is being processed go to the next batch.
+    """
+
+    def __init__(self, process: Callable[[List[T]], Awaitable[None]], delay: float, max_size: int, logger: logging.Logger):
+        self.process = process
+        self.delay = delay
+        self.max_size = max_size
+        self.logger = logger
+        self.items: List[T] = []
+        self.full = asyncio.Event()
+        self.task = None
+
+    def add(self, item: T):
+        self.items.append(item)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        elif len(self.items) >= self.max_size:
+            self.full.set()
+
+    def pending(self) -> int:
+        return len(self.items)
+
+    async def flush(self):
+        """
+            Process all collected items now and wait until it is done
+        """
+        self.full.set()
+
+        if self.task is not None:
+            await self.task
+
+    async def _run(self):
+        while len(self.items) > 0:
+            if len(self.items) < self.max_size:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+
+            self.full.clear()
+            batch = self.items[:self.max_size]
+            self.items = self.items[self.max_size:]
+
+            self.logger.debug(f"Processing batch of {len(batch)} items")
+
+            try:
+                await self.process(batch)
+            except Exception:
+                self.logger.exception("Batch processing failed")
@@ -28,3 +28,16 @@ class BotConfig:
     guild_id: int = None                                                                    # allowed guild ID
     system_users: List[int] = field(default_factory=list)                                   # user ids to ignore during mass operations
     threads_to_keep_alive: List[int] = field(default_factory=list)                          # list of threads to keep alive
+    request_budget: int = 40                                                                # max requests per second sent to Discord (by all operations)
+    metrics_port: Optional[int] = None                                                      # localhost port for Prometheus metrics endpoint, disabled when None
+    shard_count: int = 1                                                                    # number of cooperating instances splitting members between them in mass operations
+    shard: Optional[int] = None                                                             # this instance's part of members (0 based), (bot_id - 1) % shard_count when None
+    low_memory: bool = False                                                                # no messages cache and only required intents (members cache stays complete)
+    lazy_members_chunking: bool = False                                                     # load members in background after connecting, instead of before bot is ready
+    coordination_db: Optional[str] = None                                                   # SQLite file shared by cooperating instances, used to take over parts of instances which are down
+    loop_stall_threshold: Optional[float] = None                                            # seconds of blocked event loop reported as a stall, detector disabled when None
+    gateway_recording: Optional[str] = None                                                 # file to record handled gateway events to (reactions, joins, leaves, commands) for replay
+    auto_refresh_bounds: Tuple[int, int] = (60, 2880)                                       # min and max minutes between auto refreshes in adaptive mode ('set autorefresh auto')
+    log_file: Optional[str] = None                                                          # file to write logs to (used by RolesBot.run), stderr when None
+    json_logs: bool = False                                                                 # write logs as JSON lines
+    log_sampling: Optional[int] = None                                                      # max debug lines per second with the same template, no sampling when None
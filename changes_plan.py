@@ -0,0 +1,63 @@
+import discord
+
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List
+
+
+@dataclass
+class RolesChange:
+    member: discord.Member
+    add: List[str]
+    remove: List[str]
+    skipped: List[str] = field(default_factory=list)      # roles to add or remove, which bot is not able to manage
+
+    def api_calls(self) -> int:
+        # discord.py adds and removes roles one by one (one request per role)
+        return len(self.add) + len(self.remove)
+
+
+@dataclass
+class NicknameChange:
+    member: discord.Member
+    nickname: str
+
+    def api_calls(self) -> int:
+        return 1
+
+
+@dataclass
+class ChangesPlan:
+    """
+        Role and nickname changes to be done, computed without touching Discord.
+
+        Plan can be inspected (cost, list of changes) before it is applied.
+    """
+    description: str
+    roles: List[RolesChange] = field(default_factory=list)
+    nicknames: List[NicknameChange] = field(default_factory=list)
+    created: datetime = field(default_factory=datetime.now)
+
+    def api_calls(self) -> int:
+        return sum(change.api_calls() for change in self.roles) + sum(change.api_calls() for change in self.nicknames)
+
+    def is_empty(self) -> bool:
+        return len(self.roles) == 0 and len(self.nicknames) == 0
+
+    def prioritize(self, role_name: str):
+        """
+            Move changes adding given role to the front, so users waiting for access get it first
+        """
+        self.roles.sort(key = lambda change: role_name not in change.add)
+
+    def details(self) -> str:
+        lines = []
+
+        for change in self.roles:
+            roles = [f"+{role}" for role in change.add] + [f"-{role}" for role in change.remove] + [f"pominięta {role}" for role in change.skipped]
+            lines.append(f"{change.member.name}: {', '.join(roles)}")
+
+        for change in self.nicknames:
+            lines.append(f"{change.member.display_name} ({change.member.name}) -> {change.nickname}")
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,120 @@
+import asyncio
+import contextlib
+import logging
+import sqlite3
+import time
+import zlib
+
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Set
+
+
+@dataclass
+class ShardState:
+    shard: int
+    bot_id: int
+    heartbeat: float
+    last_refresh: Optional[float]
+
+
+def shard_of(member_id: int, shard_count: int) -> int:
+    # crc32 instead of hash() so all instances (and Python versions) agree on the split
+    return zlib.crc32(member_id.to_bytes(8, "little")) % shard_count
+
+
+class ShardCoordinator:
+    """
+        Splits guild members between cooperating bot instances, so mass operations run in parallel.
+
+        Each instance owns members whose id hash falls into its shard. When `path` to a database shared by
+        instances is given, instances report their liveness there and shards of instances which stopped
+        reporting are taken over by the remaining ones until their owners come back.
+    """
+    HeartbeatInterval = 60              # seconds
+    HeartbeatTimeout = 180              # seconds after which silent instance's shard is taken over
+    DatabaseTimeout = 5                 # seconds to wait for database lock
+
+    def __init__(self, path: Optional[str], shard: int, shard_count: int, bot_id: int, logger: logging.Logger):
+        if not 0 <= shard < shard_count:
+            raise ValueError(f"Invalid shard {shard} for {shard_count} shards")
+
+        self.path = path
+        self.shard = shard
+        self.shard_count = shard_count
+        self.bot_id = bot_id
+        self.logger = logger
+        self.owned_shards: Set[int] = {shard}
+        self.states: List[ShardState] = []
+        self.started = time.time()
+
+        if self.path is not None:
+            with self._connect() as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, bot_id INTEGER, shard_count INTEGER, heartbeat REAL, last_refresh REAL)")
+
+    def owns(self, member_id: int) -> bool:
+        return self.shard_count == 1 or shard_of(member_id, self.shard_count) in self.owned_shards
+
+    async def heartbeat(self):
+        """
+            Report this instance is alive and update list of owned shards.
+            Database errors (like lock timeout) are logged, owned shards are kept until the next successful heartbeat.
+        """
+        if self.path is not None:
+            try:
+                await asyncio.to_thread(self._heartbeat)
+            except sqlite3.Error as error:
+                self.logger.error(f"Heartbeat failed: {error}")
+
+    async def record_refresh(self):
+        if self.path is not None:
+            try:
+                await asyncio.to_thread(self._record_refresh)
+            except sqlite3.Error as error:
+                self.logger.error(f"Could not record refresh: {error}")
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.path, timeout = ShardCoordinator.DatabaseTimeout)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _heartbeat(self):
+        now = time.time()
+
+        with self._connect() as connection:
+            connection.execute("INSERT INTO shards (shard, bot_id, shard_count, heartbeat) VALUES (?, ?, ?, ?) "
+                               "ON CONFLICT(shard) DO UPDATE SET bot_id = excluded.bot_id, shard_count = excluded.shard_count, heartbeat = excluded.heartbeat",
+                               (self.shard, self.bot_id, self.shard_count, now))
+            rows = connection.execute("SELECT shard, bot_id, shard_count, heartbeat, last_refresh FROM shards ORDER BY shard").fetchall()
+
+        mismatched = [bot_id for _, bot_id, shard_count, _, _ in rows if shard_count != self.shard_count]
+        if len(mismatched) > 0:
+            self.logger.error(f"Instances {mismatched} use different number of shards than {self.shard_count}")
+
+        self.states = [ShardState(shard, bot_id, heartbeat, last_refresh) for shard, bot_id, _, heartbeat, last_refresh in rows if shard < self.shard_count]
+        alive = {state.shard for state in self.states if now - state.heartbeat < ShardCoordinator.HeartbeatTimeout}
+
+        if now - self.started < ShardCoordinator.HeartbeatTimeout:
+            # give other instances time to register after all of them were started
+            alive |= set(range(self.shard_count)) - {state.shard for state in self.states}
+
+        alive = sorted(alive)
+
+        # orphaned shards are spread over alive instances, each instance computes the same assignment
+        owned_shards = {self.shard}
+        for shard in range(self.shard_count):
+            if shard not in alive and alive[shard % len(alive)] == self.shard:
+                owned_shards.add(shard)
+
+        if owned_shards != self.owned_shards:
+            self.logger.warning(f"Owned shards changed: {sorted(self.owned_shards)} -> {sorted(owned_shards)}")
+
+        self.owned_shards = owned_shards
+
+    def _record_refresh(self):
+        with self._connect() as connection:
+            connection.execute("UPDATE shards SET last_refresh = ? WHERE shard IN (%s)" % ",".join("?" * len(self.owned_shards)),
+                               (time.time(), *self.owned_shards))
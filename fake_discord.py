@@ -0,0 +1,412 @@
+"""
+    Local stand-in for Discord's REST API and gateway, for load testing RolesBot without touching production.
+
+    Only routes and gateway operations used by the bot are implemented. Each route has its own rate limit bucket
+    (per major parameter, like Discord does), responses can be delayed and random 429s can be injected.
+"""
+
+import asyncio
+import discord
+import json
+import logging
+import random
+import time
+import yarl
+
+from aiohttp import web, WSMsgType
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote
+
+
+def redirect_client(port: int):
+    """
+        Make discord.py talk to fake Discord listening on given port (also in other process)
+    """
+    discord.http.Route.BASE = f"http://127.0.0.1:{port}/api/v10"
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(f"ws://127.0.0.1:{port}/")
+
+
+@dataclass
+class RouteLimit:
+    limit: int
+    period: float                   # seconds
+
+
+@dataclass
+class FakeDiscordSettings:
+    latency: float = 0.0                                                        # base response delay (seconds)
+    jitter: float = 0.0                                                         # max additional random delay (seconds)
+    error_rate: float = 0.0                                                     # probability of spurious 429
+    default_limit: RouteLimit = field(default_factory=lambda: RouteLimit(5, 5.0))
+    route_limits: Dict[str, RouteLimit] = field(default_factory=lambda: {
+        "PUT /guilds/{guild_id}/members/{user_id}/roles/{role_id}": RouteLimit(10, 10.0),
+        "DELETE /guilds/{guild_id}/members/{user_id}/roles/{role_id}": RouteLimit(10, 10.0),
+        "PATCH /guilds/{guild_id}/members/{user_id}": RouteLimit(10, 10.0),
+        "GET /channels/{channel_id}/messages/{message_id}/reactions/{emoji}": RouteLimit(5, 1.0),
+        "DELETE /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/{user_id}": RouteLimit(1, 0.25),
+    })
+    global_limit: RouteLimit = field(default_factory=lambda: RouteLimit(50, 1.0))
+
+
+class _Bucket:
+    def __init__(self, limit: RouteLimit):
+        self.limit = limit
+        self.remaining = limit.limit
+        self.reset_at = 0.0
+
+    def take(self, now: float) -> Optional[float]:
+        """
+            Take one request from bucket. Returns None on success or time to wait when bucket is exhausted
+        """
+        if now >= self.reset_at:
+            self.remaining = self.limit.limit
+            self.reset_at = now + self.limit.period
+
+        if self.remaining == 0:
+            return self.reset_at - now
+
+        self.remaining -= 1
+        return None
+
+
+class FakeDiscord:
+    LargeGuildThreshold = 250
+    MembersChunkSize = 1000
+
+    def __init__(self, settings: Optional[FakeDiscordSettings] = None, logger: logging.Logger = logging.getLogger("FakeDiscord")):
+        self.settings = settings = settings or FakeDiscordSettings()
+        self.logger = logger
+        self.next_id = discord.utils.time_snowflake(datetime.now(timezone.utc))
+        self.buckets: Dict[Tuple[str, str], _Bucket] = {}
+        self.global_bucket = _Bucket(settings.global_limit)
+        self.requests = Counter()                   # route -> requests count
+        self.rate_limited = Counter()               # route -> 429 count
+        self.sockets: List[web.WebSocketResponse] = []
+        self.sequence = 0
+        self.runner = None
+        self.port = None
+
+        self.bot_user = self._user(self.snowflake(), "GatekeeperBot", bot = True)
+        self.guild_id = self.snowflake()
+        self.roles: Dict[int, Dict[str, Any]] = {}
+        self.channels: Dict[int, Dict[str, Any]] = {}
+        self.members: Dict[int, Dict[str, Any]] = {}
+        self.messages: Dict[int, Dict[int, Dict[str, Any]]] = defaultdict(dict)      # channel id -> message id -> message
+        self.reactions: Dict[int, Dict[str, Set[int]]] = defaultdict(dict)          # message id -> emoji -> user ids
+
+        self.add_role("@everyone", role_id = self.guild_id)
+        admin_role = self.add_role("Bot", permissions = discord.Permissions.all().value)
+        self.add_member("GatekeeperBot", [admin_role], user = self.bot_user)
+
+    # guild setup
+
+    def snowflake(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def add_role(self, name: str, permissions: int = 0, role_id: Optional[int] = None) -> int:
+        role_id = role_id or self.snowflake()
+        self.roles[role_id] = {"id": str(role_id), "name": name, "position": len(self.roles), "permissions": str(permissions),
+                               "color": 0, "hoist": False, "managed": False, "mentionable": False}
+        return role_id
+
+    def role_id(self, name: str) -> int:
+        return next(int(role["id"]) for role in self.roles.values() if role["name"] == name)
+
+    def add_channel(self, name: str, channel_type: int = 0, channel_id: Optional[int] = None) -> int:
+        channel_id = channel_id or self.snowflake()
+        self.channels[channel_id] = {"id": str(channel_id), "type": channel_type, "name": name, "position": len(self.channels),
+                                     "guild_id": str(self.guild_id), "permission_overwrites": []}
+        return channel_id
+
+    def add_member(self, name: str, role_ids: List[int], user: Optional[Dict[str, Any]] = None) -> int:
+        user = user or self._user(self.snowflake(), name)
+        user_id = int(user["id"])
+        self.members[user_id] = {"user": user, "roles": [str(role_id) for role_id in role_ids], "nick": None,
+                                 "joined_at": datetime.now(timezone.utc).isoformat(), "deaf": False, "mute": False, "flags": 0}
+        return user_id
+
+    def add_message(self, channel_id: int, content: str, author: Optional[Dict[str, Any]] = None, message_id: Optional[int] = None) -> int:
+        message_id = message_id or self.snowflake()
+        self.messages[channel_id][message_id] = {"id": str(message_id), "channel_id": str(channel_id), "author": author or self.bot_user, "content": content}
+        return message_id
+
+    def add_reaction(self, message_id: int, emoji: str, user_id: int):
+        self.reactions[message_id].setdefault(emoji, set()).add(user_id)
+
+    # server
+
+    async def start(self, port: int = 0):
+        app = web.Application()
+        app.router.add_get("/", self._gateway)
+        api = [
+            ("GET", "/users/@me", self._get_me),
+            ("GET", "/oauth2/applications/@me", self._get_application),
+            ("GET", "/gateway/bot", self._get_gateway),
+            ("GET", "/users/{user_id}", self._get_user),
+            ("POST", "/users/@me/channels", self._create_dm),
+            ("GET", "/channels/{channel_id}", self._get_channel),
+            ("POST", "/channels/{channel_id}/typing", self._no_content),
+            ("GET", "/channels/{channel_id}/messages", self._get_messages),
+            ("POST", "/channels/{channel_id}/messages", self._post_message),
+            ("POST", "/channels/{channel_id}/messages/bulk-delete", self._bulk_delete),
+            ("GET", "/channels/{channel_id}/messages/{message_id}", self._get_message),
+            ("DELETE", "/channels/{channel_id}/messages/{message_id}", self._delete_message),
+            ("GET", "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}", self._get_reactions),
+            ("DELETE", "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/{user_id}", self._delete_reaction),
+            ("PUT", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}", self._add_member_role),
+            ("DELETE", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}", self._remove_member_role),
+            ("PATCH", "/guilds/{guild_id}/members/{user_id}", self._edit_member),
+        ]
+
+        for method, path, handler in api:
+            app.router.add_route(method, "/api/v{version}" + path, self._limited(f"{method} {path}", handler))
+
+        self.runner = web.AppRunner(app, access_log = None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.logger.info(f"Fake Discord listening on port {self.port}")
+
+    async def stop(self):
+        for socket in self.sockets:
+            await socket.close()
+
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def redirect_client(self):
+        """
+            Make discord.py talk to this server instead of Discord
+        """
+        redirect_client(self.port)
+
+    def reset_stats(self):
+        self.requests.clear()
+        self.rate_limited.clear()
+
+    async def dispatch(self, event: str, data: Dict[str, Any]):
+        for socket in self.sockets:
+            self.sequence += 1
+            await socket.send_str(json.dumps({"op": 0, "t": event, "s": self.sequence, "d": data}))
+
+    # rate limiting
+
+    def _limited(self, route: str, handler):
+        route_limit = self.settings.route_limits.get(route, self.settings.default_limit)
+
+        async def limited_handler(request: web.Request) -> web.Response:
+            self.requests[route] += 1
+
+            major = request.match_info.get("channel_id") or request.match_info.get("guild_id") or ""
+            bucket = self.buckets.setdefault((route, major), _Bucket(route_limit))
+            now = time.monotonic()
+
+            delay = self.settings.latency + random.uniform(0, self.settings.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            retry_after = self.global_bucket.take(now)
+            is_global = retry_after is not None
+
+            if retry_after is None:
+                retry_after = bucket.take(now)
+
+            if retry_after is None and random.random() < self.settings.error_rate:
+                retry_after = 0.1
+
+            headers = {"X-RateLimit-Limit": str(route_limit.limit), "X-RateLimit-Remaining": str(bucket.remaining),
+                       "X-RateLimit-Reset-After": f"{max(bucket.reset_at - now, 0):.3f}", "X-RateLimit-Bucket": route}
+
+            if retry_after is not None:
+                self.rate_limited[route] += 1
+                headers["Via"] = "1.1 fake-discord"
+                return self._json({"message": "You are being rate limited.", "retry_after": retry_after, "global": is_global}, 429, headers)
+
+            response = await handler(request)
+            response.headers.update(headers)
+            return response
+
+        return limited_handler
+
+    # gateway
+
+    async def _gateway(self, request: web.Request) -> web.WebSocketResponse:
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        self.sockets.append(socket)
+
+        await socket.send_str(json.dumps({"op": 10, "d": {"heartbeat_interval": 41250}}))
+
+        async for message in socket:
+            if message.type != WSMsgType.TEXT:
+                continue
+
+            payload = json.loads(message.data)
+            op = payload["op"]
+
+            if op == 1:
+                await socket.send_str(json.dumps({"op": 11}))
+            elif op in [2, 6]:
+                await self._send_ready(socket)
+            elif op == 8:
+                members = list(self.members.values())
+                chunks = [members[begin:begin + FakeDiscord.MembersChunkSize] for begin in range(0, len(members), FakeDiscord.MembersChunkSize)] or [[]]
+                for index, chunk in enumerate(chunks):
+                    data = {"guild_id": str(self.guild_id), "members": chunk, "chunk_index": index, "chunk_count": len(chunks), "nonce": payload["d"].get("nonce")}
+                    await self.dispatch("GUILD_MEMBERS_CHUNK", data)
+
+        self.sockets.remove(socket)
+        return socket
+
+    async def _send_ready(self, socket: web.WebSocketResponse):
+        ready = {"v": 10, "user": self.bot_user, "guilds": [{"id": str(self.guild_id), "unavailable": True}], "session_id": "fake",
+                 "resume_gateway_url": f"ws://127.0.0.1:{self.port}/", "application": {"id": self.bot_user["id"], "flags": 0}}
+
+        self.sequence += 1
+        await socket.send_str(json.dumps({"op": 0, "t": "READY", "s": self.sequence, "d": ready}))
+        self.sequence += 1
+        await socket.send_str(json.dumps({"op": 0, "t": "GUILD_CREATE", "s": self.sequence, "d": self._guild()}))
+
+    # REST handlers
+
+    async def _get_me(self, request: web.Request) -> web.Response:
+        return self._json(self.bot_user)
+
+    async def _get_application(self, request: web.Request) -> web.Response:
+        return self._json({"id": self.bot_user["id"], "name": "GatekeeperBot", "icon": None, "description": "", "bot_public": False,
+                           "bot_require_code_grant": False, "owner": self.bot_user, "verify_key": "", "flags": 0})
+
+    async def _get_gateway(self, request: web.Request) -> web.Response:
+        limit = {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 1}
+        return self._json({"url": f"ws://127.0.0.1:{self.port}/", "shards": 1, "session_start_limit": limit})
+
+    async def _get_user(self, request: web.Request) -> web.Response:
+        member = self.members.get(int(request.match_info["user_id"]))
+        return self._json(member["user"]) if member else self._not_found()
+
+    async def _create_dm(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        channel_id = self.add_channel(f"dm-{data['recipient_id']}", channel_type = 1)
+        return self._json({"id": str(channel_id), "type": 1, "recipients": [self.members[int(data["recipient_id"])]["user"]]})
+
+    async def _get_channel(self, request: web.Request) -> web.Response:
+        channel = self.channels.get(int(request.match_info["channel_id"]))
+        return self._json(channel) if channel else self._not_found()
+
+    async def _no_content(self, request: web.Request) -> web.Response:
+        return web.Response(status = 204)
+
+    async def _get_messages(self, request: web.Request) -> web.Response:
+        messages = self.messages[int(request.match_info["channel_id"])]
+        limit = int(request.query.get("limit", 50))
+        before = int(request.query.get("before", 2 ** 63))
+        ids = sorted((message_id for message_id in messages if message_id < before), reverse = True)[:limit]
+        return self._json([self._message(messages[message_id]) for message_id in ids])
+
+    async def _post_message(self, request: web.Request) -> web.Response:
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            form = await request.post()
+            data = json.loads(form["payload_json"])
+
+        channel_id = int(request.match_info["channel_id"])
+        message_id = self.add_message(channel_id, data.get("content") or "")
+        return self._json(self._message(self.messages[channel_id][message_id]))
+
+    async def _bulk_delete(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        for message_id in data["messages"]:
+            self.messages[int(request.match_info["channel_id"])].pop(int(message_id), None)
+
+        return web.Response(status = 204)
+
+    async def _get_message(self, request: web.Request) -> web.Response:
+        message = self.messages[int(request.match_info["channel_id"])].get(int(request.match_info["message_id"]))
+        return self._json(self._message(message)) if message else self._not_found()
+
+    async def _delete_message(self, request: web.Request) -> web.Response:
+        self.messages[int(request.match_info["channel_id"])].pop(int(request.match_info["message_id"]), None)
+        return web.Response(status = 204)
+
+    async def _get_reactions(self, request: web.Request) -> web.Response:
+        users = self.reactions[int(request.match_info["message_id"])].get(unquote(request.match_info["emoji"]), set())
+        limit = int(request.query.get("limit", 25))
+        after = int(request.query.get("after", 0))
+        ids = sorted(user_id for user_id in users if user_id > after)[:limit]
+        return self._json([self.members[user_id]["user"] if user_id in self.members else self._user(user_id, str(user_id)) for user_id in ids])
+
+    async def _delete_reaction(self, request: web.Request) -> web.Response:
+        users = self.reactions[int(request.match_info["message_id"])].get(unquote(request.match_info["emoji"]), set())
+        users.discard(int(request.match_info["user_id"]))
+        return web.Response(status = 204)
+
+    async def _add_member_role(self, request: web.Request) -> web.Response:
+        return await self._update_member_role(request, add = True)
+
+    async def _remove_member_role(self, request: web.Request) -> web.Response:
+        return await self._update_member_role(request, add = False)
+
+    async def _update_member_role(self, request: web.Request, add: bool) -> web.Response:
+        member = self.members.get(int(request.match_info["user_id"]))
+        if member is None:
+            return self._not_found()
+
+        role_id = request.match_info["role_id"]
+        roles = set(member["roles"])
+        roles = roles | {role_id} if add else roles - {role_id}
+        member["roles"] = list(roles)
+
+        await self.dispatch("GUILD_MEMBER_UPDATE", dict(member, guild_id = str(self.guild_id)))
+        return web.Response(status = 204)
+
+    async def _edit_member(self, request: web.Request) -> web.Response:
+        member = self.members.get(int(request.match_info["user_id"]))
+        if member is None:
+            return self._not_found()
+
+        data = await request.json()
+        if "nick" in data:
+            member["nick"] = data["nick"]
+
+        await self.dispatch("GUILD_MEMBER_UPDATE", dict(member, guild_id = str(self.guild_id)))
+        return self._json(member)
+
+    # helpers
+
+    def _json(self, data: Any, status: int = 200, headers: Dict[str, str] = {}) -> web.Response:
+        # discord.py requires content type to be exactly 'application/json' (no charset)
+        response = web.Response(body = json.dumps(data).encode("utf-8"), status = status, headers = headers)
+        response.headers["Content-Type"] = "application/json"
+        return response
+
+    def _not_found(self) -> web.Response:
+        return self._json({"message": "Unknown", "code": 10000}, 404)
+
+    def _user(self, user_id: int, name: str, bot: bool = False) -> Dict[str, Any]:
+        return {"id": str(user_id), "username": name, "discriminator": "0", "global_name": None, "avatar": None, "bot": bot}
+
+    def _message(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        reactions = [{"emoji": {"id": None, "name": emoji}, "count": len(users), "me": False}
+                     for emoji, users in self.reactions[int(message["id"])].items() if len(users) > 0]
+
+        return dict(message, guild_id = str(self.guild_id), type = 0, tts = False, timestamp = discord.utils.snowflake_time(int(message["id"])).isoformat(),
+                    edited_timestamp = None, mention_everyone = False, mentions = [], mention_roles = [], attachments = [],
+                    embeds = [], pinned = False, reactions = reactions)
+
+    def _guild(self) -> Dict[str, Any]:
+        # as Discord does, members of large guilds are not sent with the guild, they need to be requested in chunks
+        large = len(self.members) > FakeDiscord.LargeGuildThreshold
+
+        return {
+            "id": str(self.guild_id), "name": "Fake guild", "owner_id": self.bot_user["id"], "unavailable": False,
+            "member_count": len(self.members), "large": large, "features": [], "emojis": [], "stickers": [],
+            "roles": list(self.roles.values()), "channels": [channel for channel in self.channels.values() if channel["type"] != 1],
+            "members": [] if large else list(self.members.values()), "threads": [], "voice_states": [], "presences": [],
+        }
@@ -0,0 +1,138 @@
+"""
+    Load harness running RolesBot against FakeDiscord and reporting end-to-end refresh time, requests and throttling.
+
+    Usage (from repository's parent directory):
+        python -m GatekeeperBot.fake_discord_load --members 2000 --change-ratio 0.2 --latency 0.05 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+
+from typing import Dict, List, Tuple
+
+from .bot_config import BotConfig
+from .data_sources import RolesSource, UserStatusFlags
+from .fake_discord import FakeDiscord, FakeDiscordSettings
+from .logging_pipeline import SamplingFilter, setup_logging
+from .roles_bot import GuildBot, RolesBot
+
+
+class LoadTestRolesSource(RolesSource):
+    """
+        Roles source granting 'Member' role to given fraction of members
+    """
+
+    def __init__(self, change_ratio: float):
+        self.change_ratio = change_ratio
+
+    def get_user_roles(self, member, flags: Dict[UserStatusFlags, bool]) -> Tuple[List[str], List[str]]:
+        return (["Member"], []) if (member.id % 100) < self.change_ratio * 100 else ([], [])
+
+    def get_users_roles(self, members) -> Dict[int, Tuple[List[str], List[str]]]:
+        return {member.id: self.get_user_roles(member, flags) for member, flags in members.items()}
+
+    def role_for_known_users(self) -> str:
+        return "Known"
+
+
+def setup_guild(fake: FakeDiscord, members_count: int) -> Tuple[int, Tuple[int, int]]:
+    """
+        Populate fake guild. Returns dedicated channel id and regulations message id
+    """
+    known_role = fake.add_role("Known")
+    fake.add_role("Member")
+
+    dedicated_channel = fake.add_channel("bot")
+    regulations_channel = fake.add_channel("regulamin")
+    regulations_message = fake.add_message(regulations_channel, "Regulamin")
+
+    for index in range(members_count):
+        member_id = fake.add_member(f"user{index}", [known_role])
+        if index % 2 == 0:
+            fake.add_reaction(regulations_message, GuildBot.AcceptanceEmoji, member_id)
+
+    return dedicated_channel, (regulations_channel, regulations_message)
+
+
+async def run(args) -> int:
+    fake = FakeDiscord(FakeDiscordSettings(latency = args.latency, jitter = args.jitter, error_rate = args.error_rate))
+    dedicated_channel, regulations = setup_guild(fake, args.members)
+
+    await fake.start()
+    fake.redirect_client()
+
+    config = BotConfig(dedicated_channel = dedicated_channel, roles_source = LoadTestRolesSource(args.change_ratio),
+                       guild_id = fake.guild_id, server_regulations_message_ids = [regulations], lazy_members_chunking = args.lazy_chunking)
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        bot = RolesBot(config, storage_dir, logging.getLogger("RolesBot"))
+        guild_bot = bot.guild_bots[fake.guild_id]
+        bot_task = asyncio.create_task(bot.start("fake-token"))
+
+        try:
+            startup_start = time.perf_counter()
+            while not bot.bot_initialized:
+                if bot_task.done():
+                    bot_task.result()
+
+                await asyncio.sleep(0.1)
+
+            startup_time = time.perf_counter() - startup_start
+            await guild_bot.members_ready.wait()
+            members_ready_time = time.perf_counter() - startup_start
+            startup_requests = sum(fake.requests.values())
+            fake.reset_stats()
+
+            guild = bot.get_guild(fake.guild_id)
+            members = guild_bot._collect_all_users(guild)
+
+            refresh_start = time.perf_counter()
+            await guild_bot._refresh_roles(members)
+            await guild_bot._refresh_names([member.id for member in members])
+            refresh_time = time.perf_counter() - refresh_start
+        finally:
+            await bot.close()
+            guild_bot.storage.timer.cancel()
+            await fake.stop()
+
+    total_requests = sum(fake.requests.values())
+    total_rate_limited = sum(fake.rate_limited.values())
+
+    print(f"Startup: {startup_time:.2f}s (members loaded after {members_ready_time:.2f}s), {startup_requests} requests")
+    print(f"Refresh of {len(members)} members: {refresh_time:.2f}s, {total_requests} requests ({total_requests / refresh_time:.1f}/s), {total_rate_limited} rate limited")
+    print("Requests by route:")
+    for route, count in fake.requests.most_common():
+        print(f"    {route:90} {count:8} (429: {fake.rate_limited[route]})")
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "RolesBot load test against local fake Discord")
+    parser.add_argument("--members", type = int, default = 1000)
+    parser.add_argument("--change-ratio", type = float, default = 0.1, help = "fraction of members getting a new role")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "base latency of fake Discord responses (seconds)")
+    parser.add_argument("--jitter", type = float, default = 0.0, help = "max additional random latency (seconds)")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "probability of spurious 429 response")
+    parser.add_argument("--lazy-chunking", action = "store_true", help = "load members in background after bot is ready")
+    parser.add_argument("--verbose", action = "store_true")
+    parser.add_argument("--json-logs", action = "store_true", help = "write logs as JSON lines")
+    parser.add_argument("--log-sampling", type = int, default = 0, help = "max debug lines per second with the same template (0 - no sampling)")
+    args = parser.parse_args()
+
+    sampling = SamplingFilter(args.log_sampling) if args.log_sampling > 0 else None
+    listener = setup_logging(logging.DEBUG if args.verbose else logging.WARNING, json_output = args.json_logs, sampling = sampling)
+
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        listener.stop()
+
+    exit(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+    Memory benchmark running RolesBot against FakeDiscord with default and low-memory client profiles.
+
+    Bot runs in a separate process (one per profile), so its resident size is not affected by fake Discord.
+    Resident size growth since bot creation is reported per 10k members.
+
+    Usage (from repository's parent directory):
+        python -m GatekeeperBot.fake_discord_memory --members 20000 --messages 2000 [--output memory.json]
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import resource
+import sys
+import tempfile
+
+from typing import Any, Dict
+
+from .bot_config import BotConfig
+from .fake_discord import FakeDiscord, redirect_client
+from .fake_discord_load import LoadTestRolesSource, setup_guild
+from .roles_bot import RolesBot
+
+
+Profiles = {"default": False, "low-memory": True}
+
+
+def resident_size() -> int:
+    """
+        Current resident set size in bytes
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # no procfs, fall back to peak usage (kilobytes on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def run_bot(setup: Dict[str, Any]):
+    """
+        Bot side: connect to fake Discord, report readiness and wait for a request to measure memory
+    """
+    redirect_client(setup["port"])
+    config = BotConfig(dedicated_channel = setup["dedicated_channel"], roles_source = LoadTestRolesSource(0.0), guild_id = setup["guild_id"],
+                       server_regulations_message_ids = [tuple(setup["regulations"])], low_memory = setup["low_memory"])
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        gc.collect()
+        before = resident_size()
+
+        bot = RolesBot(config, storage_dir, logging.getLogger("RolesBot"))
+        guild_bot = bot.guild_bots[setup["guild_id"]]
+        bot_task = asyncio.create_task(bot.start("fake-token"))
+
+        try:
+            while not bot.bot_initialized:
+                if bot_task.done():
+                    bot_task.result()
+
+                await asyncio.sleep(0.1)
+
+            print("ready", flush = True)
+            await asyncio.to_thread(sys.stdin.readline)
+
+            gc.collect()
+            result = {"rss_before": before, "rss_after": resident_size(), "cached_messages": len(bot.cached_messages)}
+            print(json.dumps(result), flush = True)
+        finally:
+            await bot.close()
+            guild_bot.storage.timer.cancel()
+
+
+async def measure_profile(low_memory: bool, members_count: int, messages_count: int) -> Dict[str, Any]:
+    """
+        Fake Discord side: start server, run bot process, send chat traffic and collect bot's measurements
+    """
+    fake = FakeDiscord()
+    dedicated_channel, regulations = setup_guild(fake, members_count)
+    chat_channel = fake.add_channel("chat")
+    authors = list(fake.members.values())
+
+    await fake.start()
+
+    setup = {"port": fake.port, "dedicated_channel": dedicated_channel, "guild_id": fake.guild_id, "regulations": regulations, "low_memory": low_memory}
+    bot_process = await asyncio.create_subprocess_exec(sys.executable, "-m", __spec__.name, "--bot", json.dumps(setup),
+                                                       stdin = asyncio.subprocess.PIPE, stdout = asyncio.subprocess.PIPE)
+
+    try:
+        while (await bot_process.stdout.readline()).strip() != b"ready":
+            if bot_process.stdout.at_eof():
+                raise RuntimeError("Bot process exited before it was ready")
+
+        # regular chat traffic, which lands in messages cache
+        for index in range(messages_count):
+            author = authors[index % len(authors)]
+            message = fake._message({"id": str(fake.snowflake()), "channel_id": str(chat_channel), "author": author["user"], "content": f"message {index}"})
+            await fake.dispatch("MESSAGE_CREATE", dict(message, member = {key: value for key, value in author.items() if key != "user"}))
+
+        await asyncio.sleep(1)
+
+        bot_process.stdin.write(b"measure\n")
+        await bot_process.stdin.drain()
+        result = json.loads(await bot_process.stdout.readline())
+        await bot_process.wait()
+    finally:
+        if bot_process.returncode is None:
+            bot_process.kill()
+
+        await fake.stop()
+
+    result["rss_per_10k_members"] = (result["rss_after"] - result["rss_before"]) * 10000 / members_count
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "RolesBot memory usage with default and low-memory profiles")
+    parser.add_argument("--members", type = int, default = 20000)
+    parser.add_argument("--messages", type = int, default = 2000, help = "chat messages sent to the guild after bot is ready")
+    parser.add_argument("--output", help = "file to save results to (JSON)")
+    parser.add_argument("--bot", help = "run bot side with given setup (used internally)")
+    args = parser.parse_args()
+
+    if args.bot is not None:
+        asyncio.run(run_bot(json.loads(args.bot)))
+        return
+
+    results = {}
+    for profile, low_memory in Profiles.items():
+        result = asyncio.run(measure_profile(low_memory, args.members, args.messages))
+        results[profile] = result
+
+        print(f"{profile:12} RSS: {result['rss_after'] / 2**20:8.1f} MiB, {result['rss_per_10k_members'] / 2**20:8.2f} MiB per 10k members, cached messages: {result['cached_messages']}")
+
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as output_file:
+            json.dump({"members": args.members, "messages": args.messages, "results": results}, output_file, indent = 4)
+
+
+if __name__ == "__main__":
+    main()
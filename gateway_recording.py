@@ -0,0 +1,105 @@
+import discord
+import gzip
+import json
+import logging
+import time
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, Optional, Set, TextIO, Tuple
+
+
+@dataclass
+class RecordedEvent:
+    time: float                         # seconds since recording start
+    event: str                          # gateway event name, like MESSAGE_REACTION_ADD
+    data: Dict[str, Any]                # raw event payload
+
+
+class GatewayRecorder:
+    """
+        Records raw gateway events handled by the bot (reactions, joins, leaves and commands)
+        to gzipped JSON Lines file, for offline replay with gateway_replay.
+
+        First line is a header with guild and bot ids, each next one is an event: {"t": time, "e": event, "d": data}.
+        Only messages mentioning the bot (commands) are recorded, other chat traffic is skipped.
+    """
+    RecordedEvents = {"MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE", "GUILD_MEMBER_ADD", "GUILD_MEMBER_REMOVE", "MESSAGE_CREATE"}
+    FlushEvery = 100                    # events
+
+    def __init__(self, path: str, guild_ids: Set[int], logger: logging.Logger):
+        self.path = path
+        self.guild_ids = {str(guild_id) for guild_id in guild_ids}
+        self.logger = logger
+        self.file: Optional[TextIO] = None
+        self.connection = None
+        self.started = time.monotonic()
+        self.recorded = 0
+
+    def attach(self, connection: discord.state.ConnectionState):
+        """
+            Hook into connection's parsers. Must be called before client connects, as gateway takes parsers on connect.
+        """
+        self.connection = connection
+
+        for event in GatewayRecorder.RecordedEvents:
+            connection.parsers[event] = self._wrap(event, connection.parsers[event])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.logger.info(f"Recorded {self.recorded} events to {self.path}")
+
+    def _wrap(self, event: str, parser: Callable[[Dict[str, Any]], None]) -> Callable[[Dict[str, Any]], None]:
+        def recording_parser(data: Dict[str, Any]):
+            try:
+                self._record(event, data)
+            except Exception:
+                self.logger.exception(f"Could not record {event} event")
+
+            parser(data)
+
+        return recording_parser
+
+    def _record(self, event: str, data: Dict[str, Any]):
+        if data.get("guild_id") not in self.guild_ids:
+            return
+
+        if event == "MESSAGE_CREATE" and not any(int(user["id"]) == self.connection.self_id for user in data.get("mentions", [])):
+            return
+
+        if self.file is None:
+            self._open()
+
+        entry = {"t": round(time.monotonic() - self.started, 3), "e": event, "d": data}
+        self.file.write(json.dumps(entry, ensure_ascii = False, separators = (",", ":")) + "\n")
+        self.recorded += 1
+
+        if self.recorded % GatewayRecorder.FlushEvery == 0:
+            self.file.flush()
+
+    def _open(self):
+        # opened on first event, when bot's user id is already known. Each bot run starts a new recording
+        self.file = gzip.open(self.path, "wt", encoding = "utf-8")
+        self.started = time.monotonic()
+
+        header = {"guild_ids": sorted(int(guild_id) for guild_id in self.guild_ids), "bot_id": self.connection.self_id, "started": datetime.now().isoformat()}
+        self.file.write(json.dumps(header) + "\n")
+        self.logger.info(f"Recording gateway events to {self.path}")
+
+
+def read_recording(path: str) -> Tuple[Dict[str, Any], Iterator[RecordedEvent]]:
+    """
+        Open recording. Returns its header and iterator over recorded events.
+    """
+    recording = gzip.open(path, "rt", encoding = "utf-8")
+    header = json.loads(recording.readline())
+
+    def events() -> Iterator[RecordedEvent]:
+        with recording:
+            for line in recording:
+                entry = json.loads(line)
+                yield RecordedEvent(entry["t"], entry["e"], entry["d"])
+
+    return header, events()
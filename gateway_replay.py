@@ -0,0 +1,233 @@
+"""
+    Replays gateway events recorded by GatewayRecorder (BotConfig.gateway_recording) into RolesBot running against FakeDiscord,
+    and reports handler latency and API calls.
+
+    Fake guild is built from the recording: users, channels and reacted messages get their recorded ids.
+    Messages with acceptance reactions are used as regulations messages, unless given with --regulations.
+
+    Usage (from repository's parent directory):
+        python -m GatekeeperBot.gateway_replay recording.jsonl.gz --speed 10 [--latency 0.05]
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import tempfile
+import time
+
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Set, Tuple
+
+from .bot_config import BotConfig
+from .fake_discord import FakeDiscord, FakeDiscordSettings
+from .fake_discord_load import LoadTestRolesSource
+from .gateway_recording import RecordedEvent, read_recording
+from .roles_bot import GuildBot, RolesBot
+
+
+class ReplayRolesBot(RolesBot):
+    """
+        RolesBot measuring time its event handlers take
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handler_latency: Dict[str, List[float]] = defaultdict(list)
+        self.running_handlers = 0
+
+    async def _run_event(self, coro, event_name: str, *args, **kwargs):
+        start = time.perf_counter()
+        self.running_handlers += 1
+
+        try:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            self.running_handlers -= 1
+            self.handler_latency[event_name].append(time.perf_counter() - start)
+
+
+class ReplayGuild:
+    """
+        Builds fake guild matching recording and translates recorded events to it
+    """
+
+    def __init__(self, fake: FakeDiscord, header: Dict[str, Any], events: List[RecordedEvent]):
+        self.fake = fake
+        self.recorded_bot_id = header["bot_id"]
+        self.known_role = fake.add_role("Known")
+        self.admin_role = fake.add_role("Administrator")
+        fake.add_role("Member")
+
+        self.dedicated_channel = fake.add_channel("bot")
+        self.command_authors: Set[int] = {int(event.data["author"]["id"]) for event in events if event.event == "MESSAGE_CREATE"}
+        self.accepted_messages: Set[Tuple[int, int]] = set()
+
+        joined = set()
+        for event in events:
+            data = event.data
+
+            if event.event == "GUILD_MEMBER_ADD":
+                joined.add(int(data["user"]["id"]))
+            elif event.event.startswith("MESSAGE_REACTION"):
+                self._add_channel(int(data["channel_id"]))
+                self._add_message(int(data["channel_id"]), int(data["message_id"]))
+                self._add_member(data.get("member", {}).get("user") or fake._user(int(data["user_id"]), data["user_id"]), joined)
+
+                if data["emoji"]["name"] == GuildBot.AcceptanceEmoji:
+                    self.accepted_messages.add((int(data["channel_id"]), int(data["message_id"])))
+            elif event.event == "GUILD_MEMBER_REMOVE":
+                self._add_member(data["user"], joined)
+            elif event.event == "MESSAGE_CREATE":
+                self._add_channel(int(data["channel_id"]))
+                self._add_member(data["author"], joined)
+
+    def translate(self, event: RecordedEvent) -> Dict[str, Any]:
+        """
+            Rewrite event to fake guild and update fake's state like Discord would
+        """
+        data = dict(event.data, guild_id = str(self.fake.guild_id))
+
+        if "member" in data:
+            # in MESSAGE_CREATE member comes without user, it is the author
+            user = data["member"].get("user") or data["author"]
+            data["member"] = dict(data["member"], roles = self._roles(int(user["id"])))
+
+        if event.event == "GUILD_MEMBER_ADD":
+            data["roles"] = self._roles(int(data["user"]["id"]))
+            self.fake.add_member(data["user"]["username"], [int(role) for role in data["roles"]], user = data["user"])
+        elif event.event == "GUILD_MEMBER_REMOVE":
+            self.fake.members.pop(int(data["user"]["id"]), None)
+        elif event.event == "MESSAGE_REACTION_ADD":
+            self.fake.add_reaction(int(data["message_id"]), data["emoji"]["name"], int(data["user_id"]))
+        elif event.event == "MESSAGE_REACTION_REMOVE":
+            self.fake.reactions[int(data["message_id"])].get(data["emoji"]["name"], set()).discard(int(data["user_id"]))
+        elif event.event == "MESSAGE_CREATE":
+            fake_mention = f"<@{self.fake.bot_user['id']}>"
+            content = data["content"].replace(f"<@!{self.recorded_bot_id}>", fake_mention).replace(f"<@{self.recorded_bot_id}>", fake_mention)
+            data.update(content = content, mentions = [self.fake.bot_user], mention_roles = [], channel_id = str(self.dedicated_channel))
+
+        return data
+
+    def _roles(self, user_id: int) -> List[str]:
+        return [str(self.admin_role if user_id in self.command_authors else self.known_role)]
+
+    def _add_channel(self, channel_id: int):
+        if channel_id not in self.fake.channels:
+            self.fake.add_channel(str(channel_id), channel_id = channel_id)
+
+    def _add_message(self, channel_id: int, message_id: int):
+        if message_id not in self.fake.messages[channel_id]:
+            self.fake.add_message(channel_id, str(message_id), message_id = message_id)
+
+    def _add_member(self, user: Dict[str, Any], joined: Set[int]):
+        # users who joined during recording are added when their join is replayed
+        user_id = int(user["id"])
+        if user_id not in joined and user_id not in self.fake.members:
+            self.fake.add_member(user["username"], [int(role) for role in self._roles(user_id)], user = user)
+
+
+async def wait_until_idle(bot: ReplayRolesBot, fake: FakeDiscord, quiet_period: float):
+    """
+        Wait until handlers finish, batches are processed, jobs are done and no requests were sent for `quiet_period` seconds
+    """
+    requests = -1
+    while True:
+        for guild_bot in bot.guild_bots.values():
+            await guild_bot.join_batcher.flush()
+            await guild_bot.leave_batcher.flush()
+
+        if bot.running_handlers == 0 and all(len(guild_bot.jobs.jobs()) == 0 for guild_bot in bot.guild_bots.values()) and sum(fake.requests.values()) == requests:
+            return
+
+        requests = sum(fake.requests.values())
+        await asyncio.sleep(quiet_period)
+
+
+async def run(args) -> int:
+    header, events = read_recording(args.recording)
+    events = list(events)
+
+    fake = FakeDiscord(FakeDiscordSettings(latency = args.latency, jitter = args.jitter))
+    guild = ReplayGuild(fake, header, events)
+    regulations = [tuple(int(part) for part in regulation.split(":")) for regulation in args.regulations] or sorted(guild.accepted_messages)
+
+    await fake.start()
+    fake.redirect_client()
+
+    config = BotConfig(dedicated_channel = guild.dedicated_channel, roles_source = LoadTestRolesSource(args.change_ratio),
+                       guild_id = fake.guild_id, server_regulations_message_ids = regulations)
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        bot = ReplayRolesBot(config, storage_dir, logging.getLogger("RolesBot"))
+        guild_bot = bot.guild_bots[fake.guild_id]
+        bot_task = asyncio.create_task(bot.start("fake-token"))
+
+        try:
+            while not bot.bot_initialized:
+                if bot_task.done():
+                    bot_task.result()
+
+                await asyncio.sleep(0.1)
+
+            await guild_bot.members_ready.wait()
+            await wait_until_idle(bot, fake, args.quiet_period)
+            fake.reset_stats()
+            bot.handler_latency.clear()
+
+            replay_start = time.perf_counter()
+            for event in events:
+                if args.speed > 0:
+                    delay = replay_start + event.time / args.speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                await fake.dispatch(event.event, guild.translate(event))
+
+            dispatch_time = time.perf_counter() - replay_start
+            await wait_until_idle(bot, fake, args.quiet_period)
+            replay_time = time.perf_counter() - replay_start - args.quiet_period
+        finally:
+            await bot.close()
+            guild_bot.storage.timer.cancel()
+            await fake.stop()
+
+    recorded_time = events[-1].time if len(events) > 0 else 0.0
+    total_requests = sum(fake.requests.values())
+
+    print(f"Replayed {len(events)} events recorded over {recorded_time:.2f}s: dispatched in {dispatch_time:.2f}s, processed in {replay_time:.2f}s")
+    for event, count in Counter(event.event for event in events).most_common():
+        print(f"    {event:30} {count:8}")
+
+    print("Handler latency:")
+    for event_name, latencies in sorted(bot.handler_latency.items()):
+        latencies.sort()
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        print(f"    {event_name:30} {len(latencies):8} calls, mean {statistics.mean(latencies) * 1000:8.1f}ms, p95 {p95 * 1000:8.1f}ms, max {latencies[-1] * 1000:8.1f}ms")
+
+    print(f"API calls: {total_requests}, rate limited: {sum(fake.rate_limited.values())}")
+    for route, count in fake.requests.most_common():
+        print(f"    {route:90} {count:8} (429: {fake.rate_limited[route]})")
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Replay recorded gateway events into RolesBot against local fake Discord")
+    parser.add_argument("recording", help = "file written by BotConfig.gateway_recording")
+    parser.add_argument("--speed", type = float, default = 1.0, help = "replay speed multiplier, 0 - as fast as possible")
+    parser.add_argument("--regulations", nargs = "*", default = [], help = "regulations messages as channel_id:message_id (default: messages with acceptance reactions)")
+    parser.add_argument("--change-ratio", type = float, default = 0.0, help = "fraction of members getting a new role on roles update")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "base latency of fake Discord responses (seconds)")
+    parser.add_argument("--jitter", type = float, default = 0.0, help = "max additional random latency (seconds)")
+    parser.add_argument("--quiet-period", type = float, default = 2.0, help = "seconds without requests after which bot is considered idle")
+    parser.add_argument("--verbose", action = "store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING)
+
+    exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
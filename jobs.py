@@ -0,0 +1,102 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+_current_job: contextvars.ContextVar[Optional["Job"]] = contextvars.ContextVar("current_job", default = None)
+
+
+@dataclass
+class Job:
+    id: int
+    name: str
+    task: Optional[asyncio.Task] = None
+    started: datetime = field(default_factory = datetime.now)
+    stage: str = ""
+    done: int = 0
+    total: int = 0
+    waiting: int = 0                    # requests which joined this job instead of starting a new one
+
+
+def report_progress(stage: str, done: int, total: int):
+    """
+        Update progress of the job current code runs in (if any)
+    """
+    job = _current_job.get()
+
+    if job is not None:
+        job.stage = stage
+        job.done = done
+        job.total = total
+
+
+def current_job() -> Optional[Job]:
+    return _current_job.get()
+
+
+class JobManager:
+    """
+        Runs long operations as background jobs.
+
+        Jobs are identified by name (operation with its arguments). Only one job with given name runs at a time,
+        requests for an operation which is already running join it.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.ids = itertools.count(1)
+        self.running: Dict[str, Job] = {}
+
+    def start(self, name: str, job_function: Callable[[], Awaitable[None]]) -> Tuple[Job, bool]:
+        """
+            Start job or return running one with the same name. Returns job and True if it was started by this call
+        """
+        job = self.running.get(name)
+
+        if job is not None:
+            job.waiting += 1
+            return job, False
+
+        job = Job(next(self.ids), name)
+        job.task = asyncio.create_task(self._run(job, job_function), name = f"job-{job.id}")
+        self.running[name] = job
+        self.logger.info(f"Started job #{job.id} {repr(name)}")
+
+        return job, True
+
+    def find(self, job_id: int) -> Optional[Job]:
+        return next((job for job in self.running.values() if job.id == job_id), None)
+
+    def jobs(self) -> List[Job]:
+        return sorted(self.running.values(), key = lambda job: job.id)
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.find(job_id)
+
+        if job is None:
+            return False
+
+        self.logger.info(f"Cancelling job #{job.id} {repr(job.name)}")
+        job.task.cancel()
+        return True
+
+    async def _run(self, job: Job, job_function: Callable[[], Awaitable[None]]):
+        _current_job.set(job)
+
+        try:
+            await job_function()
+        except asyncio.CancelledError:
+            self.logger.info(f"Job #{job.id} {repr(job.name)} cancelled")
+            raise
+        except Exception:
+            self.logger.exception(f"Job #{job.id} {repr(job.name)} failed")
+            raise
+        else:
+            self.logger.info(f"Job #{job.id} {repr(job.name)} finished in {datetime.now() - job.started}")
+        finally:
+            del self.running[job.name]
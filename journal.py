@@ -0,0 +1,208 @@
+import bisect
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from array import array
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+
+@dataclass
+class JournalEntry:
+    time: float
+    member_id: int
+    member_name: str
+    change: str                         # one of ChangeJournal.RoleAdded, RoleRemoved, Nickname
+    value: str                          # role name or new nickname
+    source: str                         # operation which made the change
+
+
+class ChangeJournal:
+    """
+        Append-only journal of role and nickname changes, kept as JSON Lines segments in `directory`.
+
+        Segments are rotated when they reach SegmentSize, only the newest SegmentsKept are kept.
+        Entries are indexed by member id and by role name (segment number and offset in segment file, 8 bytes
+        per position in a sorted array per key), so history queries read only matching lines.
+
+        Entries are indexed right away, but written to segment files by a writer thread, so recording does not block
+        the event loop on disk. Entries recorded in a burst are flushed together, reads wait for pending writes.
+    """
+    RoleAdded = "+"
+    RoleRemoved = "-"
+    Nickname = "nick"
+    SegmentSize = 4 * 2**20             # bytes
+    SegmentsKept = 25
+
+    def __init__(self, directory: str, logger: logging.Logger):
+        self.directory = directory
+        self.logger = logger
+        self.members_index: Dict[int, array] = defaultdict(lambda: array("q"))     # member id -> positions
+        self.roles_index: Dict[str, array] = defaultdict(lambda: array("q"))       # role name -> positions
+        self.offset = 0                                                 # end of newest segment, including pending writes
+        self.pending: "queue.Queue[Optional[Tuple[int, Optional[bytes]]]]" = queue.Queue()   # segment and line, no line removes segment
+
+        os.makedirs(directory, exist_ok = True)
+        self.segments = sorted(self._segment_number(path) for path in glob.glob(os.path.join(directory, "journal-*.jsonl")))
+
+        for segment in self.segments:
+            self._index_segment(segment)
+
+        if len(self.segments) == 0:
+            self.segments.append(0)
+        else:
+            self.offset = os.path.getsize(self._path(self.segments[-1]))
+
+        self.writer = threading.Thread(target = self._write_entries, name = "ChangeJournal", daemon = True)
+        self.writer.start()
+
+    def record(self, member_id: int, member_name: str, change: str, value: str, source: str):
+        if self.offset >= ChangeJournal.SegmentSize:
+            self._rotate()
+
+        entry = {"t": round(time.time(), 3), "m": member_id, "u": member_name, "c": change, "v": value, "s": source}
+        line = (json.dumps(entry, ensure_ascii = False, separators = (",", ":")) + "\n").encode("utf-8")
+        position = self._position(self.segments[-1], self.offset)
+
+        self.pending.put((self.segments[-1], line))
+        self.offset += len(line)
+        self._index(position, member_id, change, value)
+
+    def member_history(self, member_id: int, role: Optional[str] = None, limit: int = 50) -> List[JournalEntry]:
+        """
+            Most recent changes of member (optionally only of given role), oldest first
+        """
+        positions = self.members_index.get(member_id, array("q"))
+
+        if role is not None:
+            role_positions = set(self.roles_index.get(role, array("q")))
+            positions = array("q", (position for position in positions if position in role_positions))
+
+        return self._read(positions[-limit:])
+
+    def role_history(self, role: str, limit: int = 50) -> List[JournalEntry]:
+        return self._read(self.roles_index.get(role, array("q"))[-limit:])
+
+    def flush(self):
+        """
+            Wait until all recorded entries are written
+        """
+        self.pending.join()
+
+    def close(self):
+        if self.writer is not None:
+            self.pending.put(None)
+            self.writer.join()
+            self.writer = None
+
+    # positions are segment number and offset packed in one int, to keep index small
+    @staticmethod
+    def _position(segment: int, offset: int) -> int:
+        return segment << 40 | offset
+
+    @staticmethod
+    def _segment_number(path: str) -> int:
+        return int(os.path.basename(path)[len("journal-"):-len(".jsonl")])
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"journal-{segment:06d}.jsonl")
+
+    def _index(self, position: int, member_id: int, change: str, value: str):
+        self.members_index[member_id].append(position)
+
+        if change != ChangeJournal.Nickname:
+            self.roles_index[value].append(position)
+
+    def _index_segment(self, segment: int):
+        with open(self._path(segment), "rb") as segment_file:
+            offset = 0
+            for line in segment_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    self.logger.warning(f"Skipping broken journal entry in segment {segment} at {offset}")
+                else:
+                    self._index(self._position(segment, offset), entry["m"], entry["c"], entry["v"])
+
+                offset += len(line)
+
+    def _rotate(self):
+        self.segments.append(self.segments[-1] + 1)
+        self.offset = 0
+
+        while len(self.segments) > ChangeJournal.SegmentsKept:
+            removed = self.segments.pop(0)
+            # removed by writer, after its pending entries are written
+            self.pending.put((removed, None))
+
+            # drop removed segment's positions from indexes, positions are recorded in increasing order
+            first_kept = self._position(self.segments[0], 0)
+            for index in [self.members_index, self.roles_index]:
+                for key in list(index.keys()):
+                    positions = index[key]
+                    del positions[:bisect.bisect_left(positions, first_kept)]
+
+                    if len(positions) == 0:
+                        del index[key]
+
+    def _write_entries(self):
+        segment_file: Optional[BinaryIO] = None
+        segment = None
+
+        try:
+            while True:
+                item = self.pending.get()
+
+                try:
+                    if item is None:
+                        return
+
+                    entry_segment, line = item
+                    if line is None:
+                        if entry_segment == segment and segment_file is not None:
+                            segment_file.close()
+                            segment_file = None
+
+                        os.remove(self._path(entry_segment))
+                        self.logger.info(f"Removed journal segment {entry_segment}")
+                        continue
+
+                    if entry_segment != segment or segment_file is None:
+                        if segment_file is not None:
+                            segment_file.close()
+                            segment_file = None
+
+                        segment_file = open(self._path(entry_segment), "ab")
+                        segment = entry_segment
+
+                    segment_file.write(line)
+
+                    if self.pending.empty():
+                        segment_file.flush()
+                except OSError:
+                    self.logger.exception("Could not write journal entry")
+                finally:
+                    self.pending.task_done()
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+
+    def _read(self, positions: Iterable[int]) -> List[JournalEntry]:
+        self.flush()
+        entries = []
+
+        for position in positions:
+            segment = position >> 40
+            with open(self._path(segment), "rb") as segment_file:
+                segment_file.seek(position & (2**40 - 1))
+                entry = json.loads(segment_file.readline())
+
+            entries.append(JournalEntry(entry["t"], entry["m"], entry["u"], entry["c"], entry["v"], entry["s"]))
+
+        return entries
@@ -0,0 +1,125 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+
+class JsonFormatter(logging.Formatter):
+    """
+        Formats records as single line JSON objects
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec = "milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+
+        return json.dumps(entry, ensure_ascii = False)
+
+
+class SamplingFilter(logging.Filter):
+    """
+        Rate limits records at or below `level`: at most `rate` records with the same message template
+        (logger and unformatted message) pass per `period` seconds.
+
+        Per-member debug lines share a template when logged lazily (`logger.debug("... %s", name)`),
+        so they are sampled, while one-off messages pass untouched.
+        First record passed after suppression is annotated with number of records dropped.
+    """
+
+    def __init__(self, rate: int = 10, period: float = 1.0, level: int = logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.period = period
+        self.level = level
+        self.lock = threading.Lock()
+        self.windows: Dict[Tuple[str, str], List] = {}        # template -> [window start, passed, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level:
+            return True
+
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+
+        with self.lock:
+            window = self.windows.get(key)
+
+            if window is None or now - window[0] >= self.period:
+                suppressed = 0 if window is None else window[2]
+                window = [now, 0, 0]
+                self.windows[key] = window
+
+                if suppressed > 0:
+                    record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+
+            window[1] += 1
+            return True
+
+
+class LoopFriendlyQueueHandler(logging.handlers.QueueHandler):
+    """
+        QueueHandler passing records as they are. Stock one formats records in prepare() on the calling thread
+        and drops their exc_info and stack_info, here formatting is left entirely to the listener's handler.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # records stay in process (SimpleQueue), so they do not need to be made picklable
+        return record
+
+
+def setup_logging(level: int = logging.INFO,
+                  filename: Optional[str] = None,
+                  json_output: bool = False,
+                  sampling: Optional[SamplingFilter] = None) -> logging.handlers.QueueListener:
+    """
+        Configure root logger to pass records through a queue to a background thread, which does
+        formatting and I/O (console or `filename`), so logging does not block the event loop.
+
+        Returned listener is already started, call its `stop()` at exit to flush remaining records.
+    """
+    if json_output:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s:%(name)s:%(message)s")
+
+    output = logging.StreamHandler(sys.stderr) if filename is None else logging.FileHandler(filename, encoding = "utf-8")
+    output.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = LoopFriendlyQueueHandler(records)
+
+    if sampling is not None:
+        # filter before enqueueing, so dropped records cost no formatting at all
+        queue_handler.addFilter(sampling)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level = True)
+    listener.start()
+
+    return listener
@@ -0,0 +1,122 @@
+import bisect
+import discord
+
+from array import array
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+MemberEntry = Tuple[int, List[int], Optional[float]]            # member id, role ids (without default one), join timestamp
+
+
+class MemberIndex:
+    """
+        Lookups of members by role and by join time, so mass operations can select members without walking through
+        the whole guild (discord.py's Role.members checks every cached member on each access).
+
+        Each role has a sorted array of its members' ids (8 bytes per role membership), members are also kept
+        sorted by join time. Index is built from members list once and then kept up to date with member events.
+
+        Building can be split: snapshot() of discord.py's members is taken on the event loop, and from_snapshot(),
+        which does the sorting, can run in a worker thread.
+    """
+
+    def __init__(self):
+        self.roles: Dict[int, array] = {}
+        self.joined_times = array("d")
+        self.joined_ids = array("q")
+
+    @classmethod
+    def build(cls, members: Iterable[discord.Member]) -> "MemberIndex":
+        return cls.from_snapshot(MemberIndex.snapshot(members))
+
+    @staticmethod
+    def snapshot(members: Iterable[discord.Member]) -> List[MemberEntry]:
+        return [(member.id, MemberIndex._role_ids(member), None if member.joined_at is None else member.joined_at.timestamp()) for member in members]
+
+    @classmethod
+    def from_snapshot(cls, entries: Iterable[MemberEntry]) -> "MemberIndex":
+        index = cls()
+        role_members = defaultdict(list)
+        joined = []
+
+        for member_id, role_ids, joined_time in entries:
+            for role_id in role_ids:
+                role_members[role_id].append(member_id)
+
+            if joined_time is not None:
+                joined.append((joined_time, member_id))
+
+        joined.sort()
+        index.roles = {role_id: array("q", sorted(ids)) for role_id, ids in role_members.items()}
+        index.joined_times = array("d", (joined_time for joined_time, _ in joined))
+        index.joined_ids = array("q", (member_id for _, member_id in joined))
+
+        return index
+
+    def add(self, member: discord.Member):
+        for role_id in MemberIndex._role_ids(member):
+            self._add_role(role_id, member.id)
+
+        if member.joined_at is not None:
+            joined_time = member.joined_at.timestamp()
+            position = bisect.bisect_right(self.joined_times, joined_time)
+            self.joined_times.insert(position, joined_time)
+            self.joined_ids.insert(position, member.id)
+
+    def remove(self, member: discord.Member):
+        for role_id in MemberIndex._role_ids(member):
+            self._remove_role(role_id, member.id)
+
+        if member.joined_at is not None:
+            joined_time = member.joined_at.timestamp()
+            position = bisect.bisect_left(self.joined_times, joined_time)
+
+            while position < len(self.joined_ids) and self.joined_times[position] == joined_time:
+                if self.joined_ids[position] == member.id:
+                    del self.joined_times[position]
+                    del self.joined_ids[position]
+                    break
+
+                position += 1
+
+    def update_roles(self, before: discord.Member, after: discord.Member):
+        before_roles = set(MemberIndex._role_ids(before))
+        after_roles = set(MemberIndex._role_ids(after))
+
+        for role_id in before_roles - after_roles:
+            self._remove_role(role_id, after.id)
+
+        for role_id in after_roles - before_roles:
+            self._add_role(role_id, after.id)
+
+    def role_members(self, role_id: int) -> List[int]:
+        return list(self.roles.get(role_id, []))
+
+    def joined_since(self, since: datetime) -> List[int]:
+        position = bisect.bisect_left(self.joined_times, since.timestamp())
+        return list(self.joined_ids[position:])
+
+    @staticmethod
+    def _role_ids(member: discord.Member) -> List[int]:
+        # everyone has the default role, indexing it would only copy the members list
+        return [role.id for role in member.roles if not role.is_default()]
+
+    def _add_role(self, role_id: int, member_id: int):
+        ids = self.roles.setdefault(role_id, array("q"))
+        position = bisect.bisect_left(ids, member_id)
+
+        if position == len(ids) or ids[position] != member_id:
+            ids.insert(position, member_id)
+
+    def _remove_role(self, role_id: int, member_id: int):
+        ids = self.roles.get(role_id)
+
+        if ids is None:
+            return
+
+        position = bisect.bisect_left(ids, member_id)
+
+        if position < len(ids) and ids[position] == member_id:
+            del ids[position]
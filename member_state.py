@@ -0,0 +1,169 @@
+import bisect
+import itertools
+
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+Regulation = Tuple[int, int]            # channel id, message id
+
+
+class MemberFlags:
+    # plain ints rather than IntFlag, as enum operations are too slow for per-member lookups
+    Known = 1
+    Accepted = 2                        # all regulations messages accepted
+
+
+class MemberStateTable:
+    """
+        Compact per-member state: sorted array of member ids with parallel arrays of flags
+        and bitmasks of accepted regulations messages (bit i set for i-th regulations message).
+
+        It takes 17 bytes per member, instead of several Python objects per member in sets and dicts.
+        Members not present in the table are considered known and not accepting regulations,
+        so they are added only when they get other state, and members who left can be removed.
+    """
+    MaxRegulations = 64
+
+    # flags byte -> 1 if member matches, for selecting members with bytes.translate and itertools.compress in C
+    AcceptedSelector = bytes(1 if flags & MemberFlags.Accepted else 0 for flags in range(256))
+    UnknownSelector = bytes(0 if flags & MemberFlags.Known else 1 for flags in range(256))
+
+    def __init__(self, regulations: List[Regulation]):
+        if len(regulations) > MemberStateTable.MaxRegulations:
+            raise ValueError(f"At most {MemberStateTable.MaxRegulations} regulations messages are supported")
+
+        self.regulation_bits = {regulation: 1 << index for index, regulation in enumerate(regulations)}
+        self.all_regulations = (1 << len(regulations)) - 1
+        self.ids = array("q")
+        self.flags = bytearray()
+        self.regulations = array("Q")
+        self.accepted_members = 0           # running counters, kept up to date by every flags change
+        self.unknown_members = 0
+
+    @classmethod
+    def build(cls, regulations: List[Regulation], unknown_ids: Iterable[int], regulations_status: Dict[int, Iterable[Regulation]]) -> "MemberStateTable":
+        table = cls(regulations)
+
+        unknown_ids = set(unknown_ids)
+        masks = {member_id: table._mask(accepted) for member_id, accepted in regulations_status.items()}
+        ids = sorted(unknown_ids | masks.keys())
+
+        table.ids = array("q", ids)
+        table.regulations = array("Q", (masks.get(member_id, 0) for member_id in ids))
+        table.flags = bytearray(table._flags(member_id not in unknown_ids, mask) for member_id, mask in zip(ids, table.regulations))
+        table.accepted_members = table.flags.translate(MemberStateTable.AcceptedSelector).count(1)
+        table.unknown_members = table.flags.translate(MemberStateTable.UnknownSelector).count(1)
+
+        return table
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get_flags(self, member_id: int) -> int:
+        index = self._find(member_id)
+        return MemberFlags.Known if index is None else self.flags[index]
+
+    def is_known(self, member_id: int) -> bool:
+        return bool(self.get_flags(member_id) & MemberFlags.Known)
+
+    def is_accepted(self, member_id: int) -> bool:
+        return bool(self.get_flags(member_id) & MemberFlags.Accepted)
+
+    def set_known(self, member_id: int, known: bool):
+        if known and self._find(member_id) is None:
+            return
+
+        index = self._insert(member_id)
+        self._set_flags(index, self._flags(known, self.regulations[index]))
+
+    def set_regulation(self, member_id: int, regulation: Regulation, accepted: bool) -> bool:
+        """
+            Mark regulations message as accepted or not by the member. Returns True if member's acceptance of all regulations changed.
+        """
+        bit = self.regulation_bits[regulation]
+
+        if not accepted and self._find(member_id) is None:
+            return False
+
+        index = self._insert(member_id)
+        previous_flags = self.flags[index]
+
+        self.regulations[index] = self.regulations[index] | bit if accepted else self.regulations[index] & ~bit
+        self._set_flags(index, self._flags(bool(previous_flags & MemberFlags.Known), self.regulations[index]))
+
+        return (previous_flags ^ self.flags[index]) & MemberFlags.Accepted != 0
+
+    def remove(self, member_id: int) -> bool:
+        """
+            Forget member's state. Returns True if member was in the table
+        """
+        index = self._find(member_id)
+
+        if index is None:
+            return False
+
+        self._set_flags(index, MemberFlags.Known)
+        del self.ids[index]
+        del self.flags[index]
+        del self.regulations[index]
+
+        return True
+
+    def accepted_ids(self) -> Set[int]:
+        if self.accepted_members == 0:
+            return set()
+
+        return set(itertools.compress(self.ids, self.flags.translate(MemberStateTable.AcceptedSelector)))
+
+    def regulation_ids(self, regulation: Regulation) -> Set[int]:
+        """
+            Members who accepted given regulations message
+        """
+        bit = self.regulation_bits[regulation]
+        return {member_id for member_id, mask in zip(self.ids, self.regulations) if mask & bit}
+
+    def unknown_ids(self) -> List[int]:
+        if self.unknown_members == 0:
+            return []
+
+        return list(itertools.compress(self.ids, self.flags.translate(MemberStateTable.UnknownSelector)))
+
+    def accepted_count(self) -> int:
+        return self.accepted_members
+
+    def unknown_count(self) -> int:
+        return self.unknown_members
+
+    def _mask(self, regulations: Iterable[Regulation]) -> int:
+        mask = 0
+        for regulation in regulations:
+            mask |= self.regulation_bits[regulation]
+
+        return mask
+
+    def _flags(self, known: bool, mask: int) -> int:
+        flags = MemberFlags.Known if known else 0
+        if mask == self.all_regulations and self.all_regulations != 0:
+            flags |= MemberFlags.Accepted
+
+        return flags
+
+    def _set_flags(self, index: int, flags: int):
+        previous_flags = self.flags[index]
+        self.accepted_members += bool(flags & MemberFlags.Accepted) - bool(previous_flags & MemberFlags.Accepted)
+        self.unknown_members += (not flags & MemberFlags.Known) - (not previous_flags & MemberFlags.Known)
+        self.flags[index] = flags
+
+    def _find(self, member_id: int) -> Optional[int]:
+        index = bisect.bisect_left(self.ids, member_id)
+        return index if index < len(self.ids) and self.ids[index] == member_id else None
+
+    def _insert(self, member_id: int) -> int:
+        index = bisect.bisect_left(self.ids, member_id)
+        if index == len(self.ids) or self.ids[index] != member_id:
+            self.ids.insert(index, member_id)
+            self.flags.insert(index, MemberFlags.Known)
+            self.regulations.insert(index, 0)
+
+        return index
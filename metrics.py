@@ -0,0 +1,227 @@
+import aiohttp
+import bisect
+import logging
+import re
+import time
+
+from aiohttp import web
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+DefaultBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+LongBuckets = [1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 3600.0]
+
+
+def _labels_key(labels: Dict[str, Any]) -> LabelsKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelsKey, extra: Dict[str, str] = {}) -> str:
+    items = list(key) + list(extra.items())
+    if len(items) == 0:
+        return ""
+
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[LabelsKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(key)} {value}" for key, value in self.values.items()]
+        return lines
+
+
+class Gauge:
+    """
+        Gauge with value read from callback at scrape time
+    """
+
+    def __init__(self, name: str, help: str, callback: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.callback()}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: List[float] = DefaultBuckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values: Dict[LabelsKey, Tuple[List[int], List[float]]] = {}      # labels -> (bucket counts, [sum])
+
+    def observe(self, value: float, **labels):
+        key = _labels_key(labels)
+        counts, total = self.values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def time(self, **labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': le})} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry:
+    """
+        Bot's metrics. Rendered in Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics: List[Any] = []
+
+        self.apply_member_roles = self.histogram("gatekeeper_apply_member_roles_seconds", "Time spent in _apply_member_roles")
+        self.refresh_duration = self.histogram("gatekeeper_refresh_roles_seconds", "Duration of roles refresh", LongBuckets)
+        self.refresh_members = self.counter("gatekeeper_refresh_members_total", "Members processed by roles refreshes")
+        self.rest_requests = self.counter("gatekeeper_rest_requests_total", "REST requests sent to Discord")
+        self.rest_rate_limited = self.counter("gatekeeper_rest_rate_limited_total", "REST requests rejected by Discord with 429")
+        self.event_latency = self.histogram("gatekeeper_event_handler_seconds", "Time spent in event handlers")
+        self.source_latency = self.histogram("gatekeeper_source_call_seconds", "Time spent in roles and nicknames sources calls")
+        self.request_wait = self.histogram("gatekeeper_request_wait_seconds", "Time requests waited for request budget", LongBuckets)
+        self.startup_phase = self.histogram("gatekeeper_startup_phase_seconds", "Duration of startup phases", LongBuckets)
+
+    def counter(self, name: str, help: str) -> Counter:
+        counter = Counter(name, help)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(self, name: str, help: str, buckets: List[float] = DefaultBuckets) -> Histogram:
+        histogram = Histogram(name, help, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name: str, help: str, callback: Callable[[], float]) -> Gauge:
+        gauge = Gauge(name, help, callback)
+        self.metrics.append(gauge)
+        return gauge
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+
+        return "\n".join(lines) + "\n"
+
+    def http_trace(self) -> aiohttp.TraceConfig:
+        """
+            Build aiohttp trace config counting REST requests (by route template) and 429 responses
+        """
+        async def on_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+            route = _route_template(params.url.path)
+            self.rest_requests.inc(method = params.method, route = route, status = params.response.status)
+
+            if params.response.status == 429:
+                self.rest_rate_limited.inc(method = params.method, route = route)
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_end.append(on_request_end)
+        return trace
+
+
+class InstrumentedSource:
+    """
+        Proxy for RolesSource/NicknamesSource measuring latency of each call
+    """
+
+    def __init__(self, source: Any, name: str, histogram: Histogram):
+        self._source = source
+        self._name = name
+        self._histogram = histogram
+
+    def __getattr__(self, attribute: str):
+        value = getattr(self._source, attribute)
+
+        if not callable(value):
+            return value
+
+        def timed(*args, **kwargs):
+            with self._histogram.time(source = self._name, call = attribute):
+                return value(*args, **kwargs)
+
+        return timed
+
+
+class MetricsServer:
+    """
+        Serves metrics over HTTP on localhost
+    """
+
+    def __init__(self, registry: MetricsRegistry, port: int, logger: logging.Logger):
+        self.registry = registry
+        self.port = port
+        self.logger = logger
+        self.runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+
+        self.runner = web.AppRunner(app, access_log = None)
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, "127.0.0.1", self.port)
+        await site.start()
+        self.logger.info(f"Serving metrics on http://127.0.0.1:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text = self.registry.render(), content_type = "text/plain", charset = "utf-8")
+
+
+_api_prefix = re.compile(r"^/api/v\d+")
+_snowflake = re.compile(r"/\d{15,}")
+
+
+def _route_template(path: str) -> str:
+    # replace ids with placeholder, so metrics are grouped by route instead of growing with each member
+    return _snowflake.sub("/{id}", _api_prefix.sub("", path))
@@ -0,0 +1,60 @@
+import cProfile
+import io
+import pstats
+import tracemalloc
+
+
+class Profiler:
+    """
+        Collects CPU (cProfile) and/or memory allocation (tracemalloc) profile between start() and stop().
+
+        Profiling is done on the event loop thread, so everything running on the loop in that time is included,
+        not only the profiled command.
+    """
+    TopFunctions = 50
+    TopAllocations = 30
+    TracebackFrames = 5
+
+    def __init__(self, cpu: bool, memory: bool):
+        self.cpu = cpu
+        self.memory = memory
+        self.profile = None
+        self.snapshot = None
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start(Profiler.TracebackFrames)
+            self.snapshot = tracemalloc.take_snapshot()
+
+        if self.cpu:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self) -> str:
+        """
+            Stop profiling and return text report
+        """
+        if self.cpu:
+            self.profile.disable()
+
+        if self.memory:
+            current_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        report = io.StringIO()
+
+        if self.cpu:
+            report.write(f"=== Top {Profiler.TopFunctions} functions by cumulative time ===\n")
+            stats = pstats.Stats(self.profile, stream = report)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(Profiler.TopFunctions)
+
+        if self.memory:
+            ignore_tracemalloc = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            current_snapshot = current_snapshot.filter_traces(ignore_tracemalloc)
+            previous_snapshot = self.snapshot.filter_traces(ignore_tracemalloc)
+
+            report.write(f"=== Top {Profiler.TopAllocations} allocation sites ===\n")
+            for stat in current_snapshot.compare_to(previous_snapshot, "lineno")[:Profiler.TopAllocations]:
+                report.write(f"{stat}\n")
+
+        return report.getvalue()
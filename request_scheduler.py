@@ -0,0 +1,209 @@
+import asyncio
+import contextlib
+import contextvars
+import discord
+import heapq
+import itertools
+import logging
+import time
+
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class Priority(IntEnum):
+    Interactive = 0             # actions users are waiting for (joins, reactions, regulations acceptance)
+    Bulk = 1                    # mass operations (refreshes, dumps, threads keeping)
+
+
+_current_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar("request_priority", default = Priority.Interactive)
+
+
+@dataclass
+class WaitStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, wait: float):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    def average(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
+
+
+class RequestScheduler:
+    """
+        Central gate for requests sent to Discord.
+
+        Requests are granted from a token bucket (`rate` requests per second, up to `burst` at once) in priority order,
+        so interactive actions get ahead of bulk jobs. Additionally bulk requests are not allowed to use the last
+        `interactive_reserve` tokens, so an interactive request does not need to wait for the bucket to refill.
+
+        Priority is taken from context (see priority()), so it is inherited by everything called within a bulk job.
+
+        Discord's per route limits are enforced later, inside discord.py, where requests of one route wait for each other
+        regardless of priority. So only BulkInFlightPerRoute bulk requests of a route are let through at once, and an interactive
+        request never waits there behind more than that. Route is told by the called method and, as Discord limits message routes
+        per channel, by the channel of object it is bound to (channel, message or reaction), or by its guild otherwise.
+    """
+    BulkInFlightPerRoute = 1
+
+    def __init__(self, rate: float, burst: int, interactive_reserve: int, logger: logging.Logger, on_wait: Optional[Callable[[Priority, float], None]] = None):
+        self.rate = rate
+        self.burst = burst
+        self.interactive_reserve = min(interactive_reserve, burst - 1)
+        self.logger = logger
+        self.on_wait = on_wait
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.waiting: List[Tuple[int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.stats: Dict[Priority, WaitStats] = {priority: WaitStats() for priority in Priority}
+        self.latency: Dict[Priority, WaitStats] = {priority: WaitStats() for priority in Priority}     # time of requests after they got a slot
+        self.bulk_routes: Dict[Tuple[str, Optional[int]], asyncio.Semaphore] = {}                     # method, channel or guild id
+
+    @staticmethod
+    @contextlib.contextmanager
+    def priority(priority: Priority) -> Iterator[None]:
+        """
+            Set priority of all requests made within the block
+        """
+        token = _current_priority.set(priority)
+        try:
+            yield
+        finally:
+            _current_priority.reset(token)
+
+    @staticmethod
+    def current_priority() -> Priority:
+        return _current_priority.get()
+
+    async def call(self, function: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+            Wait for a slot for current priority and call function.
+
+            Time of the call is recorded as latency. It includes waits for Discord's per route limits, which are handled inside discord.py.
+        """
+        priority = self.current_priority()
+
+        if priority == Priority.Interactive:
+            return await self._call(priority, function, *args, **kwargs)
+
+        route = self._route(function)
+        if route not in self.bulk_routes:
+            self.bulk_routes[route] = asyncio.Semaphore(RequestScheduler.BulkInFlightPerRoute)
+
+        async with self.bulk_routes[route]:
+            return await self._call(priority, function, *args, **kwargs)
+
+    async def _call(self, priority: Priority, function: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        await self.acquire(priority)
+
+        start = time.monotonic()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            self.latency[priority].add(time.monotonic() - start)
+
+    @staticmethod
+    def _route(function: Callable[..., Awaitable[Any]]) -> Tuple[str, Optional[int]]:
+        # like discord.py's buckets: method's route, per channel for channels and messages, per guild for the rest
+        bound_to = getattr(function, "__self__", None)
+        name = getattr(function, "__qualname__", None) or repr(function)
+
+        if isinstance(bound_to, discord.Reaction):
+            bound_to = bound_to.message
+
+        if isinstance(bound_to, discord.Message):
+            bound_to = bound_to.channel
+
+        if isinstance(bound_to, (discord.abc.GuildChannel, discord.Thread)):
+            return name, bound_to.id
+
+        guild = getattr(bound_to, "guild", None)
+        return name, getattr(guild, "id", None)
+
+    async def acquire(self, priority: Priority):
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.sequence), future))
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # slot was granted, but nobody is going to use it
+                self.tokens += 1
+            raise
+
+        wait = time.monotonic() - start
+        self.stats[priority].add(wait)
+
+        if self.on_wait is not None:
+            self.on_wait(priority, wait)
+
+    def queue_depth(self, priority: Priority) -> int:
+        return sum(1 for waiting_priority, _, future in self.waiting if waiting_priority == priority and not future.done())
+
+    def estimate_duration(self, requests: int, priority: Priority) -> float:
+        """
+            Estimate time needed to execute given number of requests of one route.
+
+            Slots are limited by the budget (current one and requests already waiting ahead), but requests do not go faster
+            than observed: each takes average latency of past calls of this priority (which includes Discord's per route waits),
+            and bulk ones run at most BulkInFlightPerRoute at once.
+        """
+        self._refill()
+
+        ahead = sum(1 for waiting_priority, _, future in self.waiting if waiting_priority <= priority and not future.done())
+        available = max(self.tokens - (self._required_tokens(priority) - 1), 0)
+        missing = ahead + requests - available
+
+        in_flight = RequestScheduler.BulkInFlightPerRoute if priority == Priority.Bulk else 1
+        observed = requests * self.latency[priority].average() / in_flight
+
+        return max(max(missing, 0) / self.rate, observed)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _required_tokens(self, priority: Priority) -> float:
+        return 1 if priority == Priority.Interactive else 1 + self.interactive_reserve
+
+    def _dispatch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self._refill()
+
+        while len(self.waiting) > 0:
+            priority, _, future = self.waiting[0]
+
+            if future.done():
+                heapq.heappop(self.waiting)
+                continue
+
+            if self.tokens < self._required_tokens(priority):
+                break
+
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            future.set_result(None)
+
+        if len(self.waiting) > 0:
+            priority = self.waiting[0][0]
+            delay = (self._required_tokens(priority) - self.tokens) / self.rate
+            self.timer = asyncio.get_running_loop().call_later(max(delay, 0.001), self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self._dispatch()
@@ -1,7 +1,8 @@
 
 import asyncio
-import csv
+import dataclasses
 import discord
+import io
 import logging
 import os
 import subprocess
@@ -11,12 +12,29 @@ from collections import defaultdict
 from datetime import datetime, timedelta
 from discord.utils import escape_markdown
 from discord.ext import tasks
-from typing import Any, Dict, List, Tuple, Set
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Set, Union
 
+from . import jobs
 from . import utils
+from . import users_export
+from .adaptive_refresh import RefreshIntervalTuner, RefreshResult
+from .batching import MicroBatcher
+from .changes_plan import ChangesPlan, NicknameChange, RolesChange
+from .coordination import ShardCoordinator
+from .gateway_recording import GatewayRecorder
+from .journal import ChangeJournal
+from .logging_pipeline import SamplingFilter, setup_logging
+from .member_index import MemberEntry, MemberIndex
+from .member_state import MemberFlags, MemberStateTable
+from .metrics import InstrumentedSource, MetricsRegistry, MetricsServer
+from .profiling import Profiler
+from .request_scheduler import Priority, RequestScheduler
+from .stall_detector import StallDetector
+from .startup_timings import StartupTimings
 from .configuration import Configuration
 from .bot_config import BotConfig
 from .data_sources import UserStatusFlags
+from .threads_keeper import ThreadsKeeper
 
 
 def get_current_commit_hash():
@@ -26,112 +44,202 @@ def get_current_commit_hash():
         return None
 
 
-class RolesBot(discord.Client):
+class GuildBot:
+    """
+        Bot logic and state for a single guild. Discord connection is provided by RolesBot (`client`),
+        which may serve several guilds at once.
+    """
     AutoRefreshEntry = "autorefresh"
     VerbosityEntry = "verbosity"
     IDEntry = "bot_id"
     DryRunEntry = "dry_run"
+    AdaptiveRefreshEntry = "autorefresh_adaptive"
     UnknownNotifiedUsers = "unknown_notified_users"
     AcceptanceEmoji = "👍"
-
-    def __init__(self, config: BotConfig, storage_dir: str, logger):
-        intents = discord.Intents.default()
-        intents.message_content = True
-        intents.members = True
-        super().__init__(intents = intents)
-
+    JoinBatchDelay = 1.0                # seconds to wait for more joining users before processing them
+    JoinBatchMaxSize = 100
+    LeaveBatchDelay = 5.0               # seconds to wait for more leaving users before cleaning up after them
+    LeaveBatchMaxSize = 500
+    IdsChannelMessagesBudget = (5, 5)   # messages per seconds
+    MaxProfilingTime = 600              # seconds
+    InteractiveRequestsReserve = 5      # part of request budget bulk jobs cannot use
+    PlanExpiration = timedelta(minutes = 30)
+    PlanProgressStep = 100              # roles changes between progress logs when applying a plan
+    ReportDetailsLimit = 20             # above this number of changed users mass reports contain only summary (details are in journal)
+    HistoryLimit = 50
+    StallsInStatus = 5                  # most recent event loop stalls listed by status command
+    BulkCommands = {"refresh", "refresh_autoroles", "dump_db", "dump_users", "ping_channels", "plan", "apply"}
+
+    def __init__(self, client: "RolesBot", config: BotConfig, storage_dir: str, logger):
+        self.client = client
+        self.metrics = client.metrics
+        self.request_scheduler = client.request_scheduler
         self.bot_initialized = False
         self.config = config
         self.channel = None
         self.logger = logger
-        self.member_ids_accepted_regulations = set()
+        self.members_state = MemberStateTable(config.server_regulations_message_ids)
+        self.member_index = MemberIndex()
+        self.manageable_roles: Optional[Set[str]] = None                                   # names of roles bot can give and take, None until known
         self.storage_dir = storage_dir
         self.storage = Configuration(storage_dir, logging.getLogger("Configuration"))
-        self.guild_id = None
-        self.unknown_users = set()
+        self.journal = ChangeJournal(os.path.join(storage_dir, "journal"), logging.getLogger("Journal"))
+        self.guild_id = config.guild_id
         self.last_auto_refresh = datetime.now()
-        self.last_thread_refresh = datetime.now()
+        self.refresh_tuner = RefreshIntervalTuner(*config.auto_refresh_bounds, logging.getLogger("RefreshIntervalTuner"))
+        self.join_batcher = MicroBatcher(self._process_joined_members, GuildBot.JoinBatchDelay, GuildBot.JoinBatchMaxSize, logger)
+        self.leave_batcher = MicroBatcher(self._process_left_members, GuildBot.LeaveBatchDelay, GuildBot.LeaveBatchMaxSize, logger)
+        self.ids_channel_budget = utils.RateBudget(*GuildBot.IdsChannelMessagesBudget)
+        self.profiler = None
+        self.pending_plan: Optional[ChangesPlan] = None
+        self.members_ready = asyncio.Event()
+        self.jobs = jobs.JobManager(logging.getLogger("Jobs"))
+        self.members_loading = None
+        self.threads_keeper = ThreadsKeeper(client, config.threads_to_keep_alive, logging.getLogger("ThreadsKeeper"), self._write_to_dedicated_channel, self.request_scheduler)
         self.message_prefix = self.storage.get_config().get("message_prefix", "")
 
         # setup default values in config
-        self.storage.set_default(RolesBot.AutoRefreshEntry, 1440)
-        self.storage.set_default(RolesBot.VerbosityEntry, logging.INFO)
-        self.storage.set_default(RolesBot.IDEntry, 1)
-        self.storage.set_default(RolesBot.DryRunEntry, False)
+        self.storage.set_default(GuildBot.AutoRefreshEntry, 1440)
+        self.storage.set_default(GuildBot.VerbosityEntry, logging.INFO)
+        self.storage.set_default(GuildBot.IDEntry, 1)
+        self.storage.set_default(GuildBot.DryRunEntry, False)
+        self.storage.set_default(GuildBot.AdaptiveRefreshEntry, False)
 
         # read bot's config from file
-        self.bot_id = self.storage.get_config().get(RolesBot.IDEntry)
-        self.dry_run = self.storage.get_config().get(RolesBot.DryRunEntry)
+        self.bot_id = self.storage.get_config().get(GuildBot.IDEntry)
+        self.dry_run = self.storage.get_config().get(GuildBot.DryRunEntry)
 
+        shard = config.shard if config.shard is not None else (self.bot_id - 1) % config.shard_count
+        self.coordinator = ShardCoordinator(config.coordination_db, shard, config.shard_count, self.bot_id, logging.getLogger("ShardCoordinator"))
 
-    async def on_ready(self):
+
+    async def on_ready(self, guild: discord.Guild, hash: Optional[str]):
         if self.bot_initialized:
             await self._write_to_dedicated_channel("Restart połączenia z discordem.")
+            await self._reconcile_after_reconnect(guild, self.client.disconnected_at)
             return
 
-        hash = get_current_commit_hash()
-        self.logger.info(f"Bot is ready as {self.user}. git commit: {hash}. Dry run: {self.dry_run}")
+        self.logger.info(f"Serving guild {guild.name} ({guild.id}). Dry run: {self.dry_run}")
+        startup = self.client.startup
+        self._update_manageable_roles(guild)
 
-        if len(self.guilds) != 1:
-            self.logger.error(f"Invalid number of guilds: {len(self.guilds)}")
-            await self.close()
-            return
-
-        guild = self.guilds[0]
-        self.guild_id = guild.id
+        # server state and coordination do not depend on channels, they are set up concurrently
+        heartbeat = asyncio.create_task(startup.measure(self._startup_phase("heartbeat"), self.coordinator.heartbeat()))
+        state = None
 
-        if self.guild_id != self.config.guild_id:
-            self.logger.error(f"Leaving unauthorized guild: {guild.name} ({guild.id})")
-            await guild.leave()
-            return
+        if not self.config.lazy_members_chunking:
+            with RequestScheduler.priority(Priority.Bulk):
+                state = asyncio.create_task(startup.measure(self._startup_phase("state"), self._update_state()))
 
-        self.channel = await self.fetch_channel(self.config.dedicated_channel)
+        channel_ids = [self.config.dedicated_channel] + self.config.auto_roles_channels
+        channels = asyncio.gather(*(self.client.fetch_channel(channel_id) for channel_id in channel_ids))
+        self.channel, *auto_roles_channels = await startup.measure(self._startup_phase("channels"), channels)
 
         self.logger.debug(f"Using channel {self.config.dedicated_channel} for notifications")
 
-        for auto_roles_channel in self.config.auto_roles_channels:
-            channel = await self.fetch_channel(auto_roles_channel)
+        for channel in auto_roles_channels:
             self.logger.debug(f"Auto roles: listening for reactions in channel {channel}")
 
         async with self.channel.typing():
-            await self._write_to_dedicated_channel(f"Start bota. git commit: {hash} ID: **{self.bot_id}**\n")
+            with startup.phase(self._startup_phase("start message")):
+                await self._write_to_dedicated_channel(f"Start bota. git commit: {hash} ID: **{self.bot_id}**\n")
 
-            if self.dry_run:
-                await self._write_to_dedicated_channel(f"**Tryb dry-run aktywny**\n", logging.WARNING)
+                if self.dry_run:
+                    await self._write_to_dedicated_channel(f"**Tryb dry-run aktywny**\n", logging.WARNING)
+
+            await heartbeat
 
-            await self._update_state()
+            if self.config.lazy_members_chunking:
+                self.members_loading = asyncio.create_task(self._load_members(guild))
+            else:
+                await state
+                self.members_ready.set()
+
+                if self._is_level_sufficent_for_send(logging.DEBUG):
+                    await self._print_status()
 
         self._auto_refresh.start()
+        self._heartbeat.start()
+        self.threads_keeper.start(self.guild_id)
         self.bot_initialized = True
 
 
-    async def on_guild_join(self, guild):
-        if guild.id != self.config.guild_id:
-            self.logger.error(f"Leaving unauthorized guild: {guild.name} ({guild.id})")
-            await guild.leave()
+    async def on_resumed(self, guild: discord.Guild):
+        # Discord replays events missed during resumed session, so users who joined meanwhile are handled by on_member_join
+        await self._reconcile_after_reconnect(guild, None)
+
+
+    async def _reconcile_after_reconnect(self, guild: discord.Guild, disconnected_at: Optional[datetime]):
+        if not self.members_ready.is_set():
+            # state is going to be collected from scratch anyway
+            return
+
+        with RequestScheduler.priority(Priority.Bulk):
+            await self._run_job("reconcile", lambda: self._reconcile_state(guild, disconnected_at))
+
+
+    async def _load_members(self, guild: discord.Guild):
+        """
+            Load all guild members in background and collect server state when it is done
+        """
+        self.logger.info(f"Loading {guild.member_count} members in background")
+        startup = self.client.startup
+
+        with RequestScheduler.priority(Priority.Bulk):
+            await startup.measure(self._startup_phase("members loading"), guild.chunk())
+            self.logger.info(f"Loaded {len(guild.members)} members")
+
+            await startup.measure(self._startup_phase("state"), self._update_state())
+
+        self.members_ready.set()
+
+        if self._is_level_sufficent_for_send(logging.DEBUG):
+            await self._print_status()
+
+
+    def _startup_phase(self, name: str) -> str:
+        # phases of all guilds are recorded together
+        return name if len(self.client.guild_bots) == 1 else f"{self.guild_id} {name}"
+
+
+    async def _wait_for_members(self):
+        if not self.members_ready.is_set():
+            self.logger.info("Waiting for members list to be loaded")
+            await self.members_ready.wait()
+
+
+    async def _get_member(self, guild: discord.Guild, member_id: int) -> Optional[discord.Member]:
+        """
+            Get member from cache or, if members list is not loaded yet, from Discord
+        """
+        member = guild.get_member(member_id)
+
+        if member is None and not guild.chunked:
+            try:
+                member = await self.request_scheduler.call(guild.fetch_member, member_id)
+            except discord.errors.NotFound:
+                member = None
+
+        return member
 
 
     async def on_message(self, message: discord.Message):
         author = message.author
         message_guild = message.guild
-        if message_guild is None:
-            self.logger.info(f"Ignoring private message from user {repr(author.name)}: {repr(message.content)}")
-            return
 
         if message_guild.id != self.guild_id:
             self.logger.error(f"Got message from guild '{message_guild}', which is not the current one. This should never happen.")
             return
 
-        if self.user in message.mentions:
+        if self.client.user in message.mentions:
             message_content = message.content.strip()
-            bot_mention = f"<@{self.user.id}>"
+            bot_mention = f"<@{self.client.user.id}>"
 
             if message_content.startswith(bot_mention):
                 if not any(role.name in ["Administrator", "Technik"] for role in author.roles):
                     self.logger.warning(f"User {author.name} has no rights to use bot.")
                     return
 
-                guild = message_guild
                 whole_command = message_content[len(bot_mention):].strip()
                 command_splitted = whole_command.split(" ")
 
@@ -158,195 +266,449 @@ class RolesBot(discord.Client):
                 command = command_splitted[0]
                 args = command_splitted[1:]
 
-                self.logger.debug(f"Got command {repr(command)} with args {repr(args)}")
-
-                if command == "refresh":
-                    async with self.channel.typing():
-                        if len(args) == 0:
-                            members = self._collect_all_users(guild)
-                            members_ids = [member.id for member in members]
-
-                            await self._refresh_roles(members)
-                            await self._refresh_names(members_ids)
-                        else:
-                            try:
-                                member_ids = [int(id) for id in args]
-                            except ValueError:
-                                await self._write_to_dedicated_channel("Argumenty muszą być numerami ID")
-                            else:
-                                members = [guild.get_member(member_id) for member_id in member_ids]
-                                await self._refresh_roles(members)
-                                await self._refresh_names(member_ids)
-                elif command == "status":
-                    async with self.channel.typing():
-                        await self._print_status()
-                elif command == "test" and len(args) > 0:
-                    subcommand = args[0]
-                    subargs = args[1:]
-                    if subcommand == "newuser" and len(subargs) == 1:
-                        user_mention = subargs[0]
-                        if user_mention.startswith('<@') and user_mention.endswith('>'):
-                            user_id = user_mention[2:-1]
-                            if user_id.startswith('!'):  # Handles the '!'-prefixed mention for nicknames
-                                user_id = user_id[1:]
-                            member_id = int(user_id)
-                            member = guild.get_member(member_id)
-
-                            self.logger.info(f"Testing on_member_join for member {member.name}")
-                            await self.on_member_join(member)
-                    elif subcommand == "del_emo" and len(subargs) == 3:
-                        channel_id = int(subargs[0])
-                        message_id = int(subargs[1])
-                        member_id = int(subargs[2])
-                        message = await utils.get_message(channel_id, message_id)
-                        status = await utils.remove_user_reactions(message_guild, message, member_id)
-                elif command == "dump_db":
-                    users_membership = self.config.roles_source.list_known_users()
-                    users_names =  self.config.nicknames_source.get_all_nicknames()
-                    status = "List znanych userów z bazy danych:\n"
-
-                    for user, data in users_membership.items():
-                        if user.isnumeric():
-                            # assume id
-                            member_id = int(user)
-                            member_details = await self._build_user_details(guild, member_id)
-                            status += member_details
-                        else:
-                            # assume direct user name
-                            status += f"{user}"
-
-                        nickname = users_names.get(user, None)
-                        display_nickname = "EMPTY" if nickname is None else "\\*" * len(nickname)
-                        status += f": {data} -> {display_nickname}\n"
-
-                    await self._write_to_dedicated_channel(status)
-                elif command == "dump_users":
-                    async with self.channel.typing():
-                        path, users_count = self._dump_users_to_csv(guild)
-                        await self._write_to_dedicated_channel(f"Zapisano listę {users_count} użytkowników do pliku `{os.path.basename(path)}`.")
-                elif command == "set" and len(args) > 0:
-                    subcommand = args[0]
-                    subargs = args[1:]
-                    if subcommand == "autorefresh" and len(subargs) == 1:
-                        async with self.channel.typing():
-                            autorefresh = int(subargs[0])
-                            if autorefresh >= 5:
-                                config = self.storage.get_config()
-                                current_value = config[RolesBot.AutoRefreshEntry]
-                                config[RolesBot.AutoRefreshEntry] = autorefresh
-                                self.storage.set_config(config)
-                                self.logger.info(f"Changing auto refresh {current_value} -> {autorefresh} minutes")
-                                await self._write_to_dedicated_channel(f"Częstotliwość odświeżania zmieniona na {autorefresh} minut")
-                            else:
-                                await self._write_to_dedicated_channel(f"Daj minimum 5 minut")
-                    elif subcommand == "verbosity" and len(subargs) == 1:
-                        async with self.channel.typing():
-                            verbosity = int(subargs[0])
-
-                            config = self.storage.get_config()
-                            current_value = config[RolesBot.VerbosityEntry]
-                            config[RolesBot.VerbosityEntry] = verbosity
-                            self.storage.set_config(config)
-                            self.logger.info(f"Changing verbosity {current_value} -> {verbosity}")
-                            await self._write_to_dedicated_channel(f"Poziom gadatliwości bota zmieniony na: {verbosity}")
-                elif command == "set_role" and len(args) >= 3:
-                    user_id = int(args[0])
-                    state = True if args[1] == "1" else False
-                    role_name = " ".join(args[2:])
-                    member = message_guild.get_member(user_id)
-                    if state:
-                        await self._apply_member_roles(member, [role_name], [])
+                self.logger.debug("Got command %r with args %r", command, args)
+                await self._execute_command(message, command, args)
+
+
+    async def _execute_command(self, message: discord.Message, command: str, args: List[str]):
+        # named task lets stall detector tell which command blocked the loop
+        asyncio.current_task().set_name(f"command {command}")
+        priority = Priority.Bulk if command in GuildBot.BulkCommands else Priority.Interactive
+
+        if priority == Priority.Bulk:
+            await self._wait_for_members()
+
+        with RequestScheduler.priority(priority):
+            await self._run_command(message, command, args)
+
+
+    async def _run_command(self, message: discord.Message, command: str, args: List[str]):
+        guild = message.guild
+
+        if command == "refresh":
+            async with self.channel.typing():
+                if len(args) == 0:
+                    await self._run_job("refresh", lambda: self._refresh_members(self._collect_own_users(guild)))
+                else:
+                    try:
+                        members = self._select_members(guild, args)
+                    except ValueError as error:
+                        await self._write_to_dedicated_channel(str(error))
                     else:
-                        await self._apply_member_roles(member, [], [role_name])
-
-                elif command == "refresh_autoroles":
-                    async with self.channel.typing():
-                        await self._refresh_autoroles()
-
-                elif command == "ping_channels":
-                    await self._ping_important_threads()
-
-                elif command == "help":
-                    async with self.channel.typing():
-                        await self._write_to_dedicated_channel("Dostepne polecenia:\n"
-                                                               "```\n"
-                                                               "refresh [ID1 ID2 ...]               - odświeża role użytkowników których ID podane są jako argumenty. Przy braku argumentów odświeżani są wszyscy.\n"
-                                                               "status                              - wyświetla stan bota\n"
-                                                               "test newuser @user                  - testuje procedurę dołączenia nowego użytkownika na użytkowniku @user\n"
-                                                               "test del_emo ch_id msg_id usr_id    - usuwa reakcje podanego usera spod wiadomości\n"
-                                                               "dump_db                             - zrzuca treść bazy danych\n"
-                                                               "dump_users                          - zapisuje listę użytkowników Discorda do pliku CSV w storage bota\n"
-                                                               "set autorefresh czas                - zmienia częstotliwość auto odświeżania ról na 'czas' minut (co najmniej 5)\n"
-                                                               "set verbosity poziom                - zmienia poziom gadatliwości bota. Wartości odpowiadają stałym poziomów logowania modułu 'logging' Pythona\n"
-                                                               "set_role user_id role_name          - przypisuje userowi podaną rolę (o ile to możliwe)\n"
-                                                               "refresh_autoroles                   - każdemu użytkownikowi przypisuje role według jego reakcji w odpowiednich kanałach\nUwaga: polecenie to jest bardzo czasochłonne "
-                                                                                                     "i zbyt często używane może powodować tymczasowe blokady bota przez serwery discorda.\n"
-                                                                                                     "Ponadto nie są weryfikowane żadne warunki (jak np akceptacje regulaminu). Korzystać w ostateczności.\n"
-                                                               "ping_channels                       - pinguje kanały oznaczone w konfiguracji jako ważne\n"
-                                                               "\n"
-                                                               "Polecenie może być poprzedzone ID bota (zdefiniowanym w pliku konfiguracyjnym), aby wysyłać komendy do konkretnej instancji bota.\n"
-                                                               "```"
-                                                              )
+                        await self._write_to_dedicated_channel(f"Odświeżanie wybranych użytkowników: {len(members)}")
+                        await self._run_job(f"refresh {' '.join(args)}", lambda: self._refresh_members(members))
+        elif command == "status":
+            async with self.channel.typing():
+                await self._print_status()
+        elif command == "test" and len(args) > 0:
+            subcommand = args[0]
+            subargs = args[1:]
+            if subcommand == "newuser" and len(subargs) == 1:
+                user_mention = subargs[0]
+                if user_mention.startswith('<@') and user_mention.endswith('>'):
+                    user_id = user_mention[2:-1]
+                    if user_id.startswith('!'):  # Handles the '!'-prefixed mention for nicknames
+                        user_id = user_id[1:]
+                    member_id = int(user_id)
+                    member = await self._get_member(guild, member_id)
+
+                    self.logger.info(f"Testing on_member_join for member {member.name}")
+                    await self.on_member_join(member)
+            elif subcommand == "del_emo" and len(subargs) == 3:
+                channel_id = int(subargs[0])
+                message_id = int(subargs[1])
+                member_id = int(subargs[2])
+                message = await utils.get_message(channel_id, message_id)
+                status = await utils.remove_user_reactions(guild, message, member_id, self.request_scheduler)
+        elif command == "dump_db":
+            await self._run_job("dump_db", lambda: self._dump_db(guild))
+        elif command == "dump_users":
+            async with self.channel.typing():
+                export_format = users_export.ExportFormat.JSONL if "jsonl" in args else users_export.ExportFormat.CSV
+                compress = "gz" in args
+                diff = "diff" in args
+
+                await self._run_job(f"dump_users {' '.join(args)}".strip(), lambda: self._dump_users_command(guild, export_format, compress, diff))
+        elif command == "set" and len(args) > 0:
+            subcommand = args[0]
+            subargs = args[1:]
+            if subcommand == "autorefresh" and len(subargs) == 1 and subargs[0] == "auto":
+                async with self.channel.typing():
+                    config = self.storage.get_config()
+                    config[GuildBot.AdaptiveRefreshEntry] = True
+                    self.storage.set_config(config)
+                    self.logger.info("Enabling adaptive auto refresh")
+                    await self._write_to_dedicated_channel(f"Częstotliwość odświeżania będzie dobierana automatycznie ({self.refresh_tuner.min_interval}-{self.refresh_tuner.max_interval} minut)")
+            elif subcommand == "autorefresh" and len(subargs) == 1:
+                async with self.channel.typing():
+                    autorefresh = int(subargs[0])
+                    if autorefresh >= 5:
+                        config = self.storage.get_config()
+                        current_value = config[GuildBot.AutoRefreshEntry]
+                        config[GuildBot.AutoRefreshEntry] = autorefresh
+                        config[GuildBot.AdaptiveRefreshEntry] = False
+                        self.storage.set_config(config)
+                        self.logger.info(f"Changing auto refresh {current_value} -> {autorefresh} minutes")
+                        await self._write_to_dedicated_channel(f"Częstotliwość odświeżania zmieniona na {autorefresh} minut")
+                    else:
+                        await self._write_to_dedicated_channel(f"Daj minimum 5 minut")
+            elif subcommand == "verbosity" and len(subargs) == 1:
+                async with self.channel.typing():
+                    verbosity = int(subargs[0])
+
+                    config = self.storage.get_config()
+                    current_value = config[GuildBot.VerbosityEntry]
+                    config[GuildBot.VerbosityEntry] = verbosity
+                    self.storage.set_config(config)
+                    self.logger.info(f"Changing verbosity {current_value} -> {verbosity}")
+                    await self._write_to_dedicated_channel(f"Poziom gadatliwości bota zmieniony na: {verbosity}")
+        elif command == "set_role" and len(args) >= 3:
+            user_id = int(args[0])
+            state = True if args[1] == "1" else False
+            role_name = " ".join(args[2:])
+            member = await self._get_member(guild, user_id)
+            if state:
+                await self._apply_member_roles(member, [role_name], [])
+            else:
+                await self._apply_member_roles(member, [], [role_name])
+
+        elif command == "refresh_autoroles":
+            async with self.channel.typing():
+                await self._run_job("refresh_autoroles", self._refresh_autoroles)
+
+        elif command == "ping_channels":
+            await self._ping_important_threads()
+
+        elif command == "profile" and len(args) > 0:
+            await self._profile(message, args)
+
+        elif command == "plan" and len(args) > 0:
+            async with self.channel.typing():
+                await self._prepare_plan(guild, args)
+
+        elif command == "apply":
+            async with self.channel.typing():
+                await self._run_job("apply", self._apply_pending_plan)
+
+        elif command == "history" and len(args) > 0:
+            await self._print_history(args)
+
+        elif command == "jobs":
+            await self._print_jobs()
+
+        elif command == "cancel" and len(args) == 1 and args[0].isdigit():
+            job_id = int(args[0])
+            if self.jobs.cancel(job_id):
+                await self._write_to_dedicated_channel(f"Anulowanie zadania #{job_id}.")
+            else:
+                await self._write_to_dedicated_channel(f"Brak zadania #{job_id}.")
+
+        elif command == "help":
+            async with self.channel.typing():
+                await self._write_to_dedicated_channel("Dostepne polecenia:\n"
+                                                       "```\n"
+                                                       "refresh [ID1 ID2 ...]               - odświeża role użytkowników których ID podane są jako argumenty. Przy braku argumentów odświeżani są wszyscy.\n"
+                                                       "refresh selektor [selektor ...]     - odświeża role użytkowników wybranych selektorami (można łączyć z ID): unknown - nieznani, not-accepted - bez akceptacji regulaminu,\n"
+                                                       "                                      joined-since:RRRR-MM-DD - dołączeni od podanej daty, role:nazwa - posiadający rolę (musi być ostatni)\n"
+                                                       "status                              - wyświetla stan bota\n"
+                                                       "test newuser @user                  - testuje procedurę dołączenia nowego użytkownika na użytkowniku @user\n"
+                                                       "test del_emo ch_id msg_id usr_id    - usuwa reakcje podanego usera spod wiadomości\n"
+                                                       "dump_db                             - zrzuca treść bazy danych\n"
+                                                       "dump_users [jsonl] [gz] [diff]      - zapisuje listę użytkowników Discorda do pliku CSV (lub JSON Lines) w storage bota. 'gz' kompresuje plik, 'diff' zapisuje dodatkowo zmiany względem poprzedniego dnia\n"
+                                                       "set autorefresh czas                - zmienia częstotliwość auto odświeżania ról na 'czas' minut (co najmniej 5)\n"
+                                                       "set autorefresh auto                - częstotliwość auto odświeżania dobierana na podstawie liczby zmian i zapasu limitu zapytań\n"
+                                                       "set verbosity poziom                - zmienia poziom gadatliwości bota. Wartości odpowiadają stałym poziomów logowania modułu 'logging' Pythona\n"
+                                                       "set_role user_id role_name          - przypisuje userowi podaną rolę (o ile to możliwe)\n"
+                                                       "refresh_autoroles                   - każdemu użytkownikowi przypisuje role według jego reakcji w odpowiednich kanałach\nUwaga: polecenie to jest bardzo czasochłonne "
+                                                                                             "i zbyt często używane może powodować tymczasowe blokady bota przez serwery discorda.\n"
+                                                                                             "Ponadto nie są weryfikowane żadne warunki (jak np akceptacje regulaminu). Korzystać w ostateczności.\n"
+                                                       "ping_channels                       - pinguje kanały oznaczone w konfiguracji jako ważne\n"
+                                                       "profile [cpu|mem|all] czas|polecenie - profiluje bota przez 'czas' sekund lub podczas wykonania polecenia (np. 'profile all refresh'). Raport wysyłany jest jako załącznik\n"
+                                                       "plan refresh [ID1 ... | selektory]  - przygotowuje (bez wprowadzania) zmiany ról i nicków dla polecenia refresh. Wyświetla liczbę zapytań do API i szacowany czas, szczegóły wysyłane są jako załącznik\n"
+                                                       "plan refresh_autoroles              - jak wyżej, dla polecenia refresh_autoroles\n"
+                                                       "plan set_role user_id 0|1 role_name - jak wyżej, dla polecenia set_role\n"
+                                                       "apply                               - wprowadza zmiany ostatnio przygotowanego planu\n"
+                                                       "history user_id [rola]              - wyświetla historię zmian ról i nicków użytkownika (opcjonalnie tylko podanej roli)\n"
+                                                       "history rola                        - wyświetla historię nadawania i zabierania podanej roli\n"
+                                                       "jobs                                - wyświetla trwające zadania (refresh, refresh_autoroles, dump_db, dump_users, apply) i ich postęp\n"
+                                                       "cancel id                           - anuluje zadanie o podanym numerze\n"
+                                                       "Zlecenie operacji, która już trwa, nie uruchamia jej ponownie - polecenie czeka na zakończenie trwającej.\n"
+                                                       "\n"
+                                                       "Polecenie może być poprzedzone ID bota (zdefiniowanym w pliku konfiguracyjnym), aby wysyłać komendy do konkretnej instancji bota.\n"
+                                                       "Przy kilku współpracujących instancjach (shard_count) operacje masowe dotyczą tylko użytkowników obsługiwanych przez daną instancję.\n"
+                                                       "```"
+                                                      )
 
 
     async def on_member_join(self, member: discord.Member):
         self.logger.info(f"New user {repr(member.name)} joining the server.")
+        self.member_index.add(member)
 
-        added_roles, removed_roles = await self._update_member_roles(member)
-        await self._single_user_report(f"Aktualizacja ról nowego użytkownika {member.name} zakończona.", added_roles, removed_roles)
+        # with several instances only the one owning the user handles it
+        if self.coordinator.owns(member.id):
+            self.join_batcher.add(member)
+        else:
+            self.logger.debug(f"User {repr(member.name)} is handled by other instance")
 
-        user_roles = member.roles
-        user_roles_names = [role.name for role in user_roles]
-        known_users_role = self.config.roles_source.role_for_known_users()
 
-        user_is_known = known_users_role in user_roles_names
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles != after.roles:
+            self.member_index.update_roles(before, after)
+
+            if after.id == after.guild.me.id:
+                self._update_manageable_roles(after.guild)
 
-        if user_is_known:
-            self.logger.info("User is known")
+
+    async def on_roles_changed(self, guild: discord.Guild):
+        # role created, deleted, moved or its permissions changed
+        self._update_manageable_roles(guild)
+
+
+    def _update_manageable_roles(self, guild: discord.Guild):
+        """
+            Collect roles bot is able to give and take: it needs Manage Roles permission and, unless it owns the guild,
+            role has to be below bot's top role. Roles managed by integrations cannot be given to anyone.
+        """
+        me = guild.me
+
+        if me.guild_permissions.manage_roles:
+            manageable = {role.name for role in guild.roles if not role.is_default() and not role.managed and (role < me.top_role or guild.owner_id == me.id)}
         else:
-            self.logger.info("User is not known")
-            self.unknown_users.add(member.id)
-            config = self.storage.get_config()
+            manageable = set()
 
-            unknown_notified_users = config.get(RolesBot.UnknownNotifiedUsers, {})
-            if isinstance(unknown_notified_users, list):
-                unknown_notified_users = dict.fromkeys(unknown_notified_users, None)
+        if manageable != self.manageable_roles:
+            self.logger.info("Bot can manage %s of %s roles. Manage Roles permission: %s", len(manageable), len(guild.roles), me.guild_permissions.manage_roles)
 
-            member_id = member.id
-            member_id_str = str(member_id)
+        self.manageable_roles = manageable
 
-            guild = self.get_guild(self.guild_id)
-            discord_name, log_name = await utils.build_user_name(self, guild, member_id)
 
-            if self.config.ids_channel_id is None:
-                self.logger.debug(f"User ID notification channel is not configured; not sending ID for the user {log_name}")
-                await self._write_to_dedicated_channel(f"Użytkownik {discord_name} nie istnieje w bazie. Wysyłanie ID wyłączone w konfiguracji.")
-                return
+    async def _run_job(self, name: str, job_function: Callable[[], Awaitable[None]]):
+        """
+            Run long operation as a background job and wait for it.
+            If the same operation is already running, wait for it instead of starting another one.
+        """
+        job, started = self.jobs.start(name, job_function)
+
+        if not started:
+            await self._write_to_dedicated_channel(f"Operacja '{name}' jest już wykonywana (zadanie #{job.id}), oczekiwanie na jej zakończenie.")
+
+        try:
+            # shielded, so job keeps going for other waiters even if this one gets cancelled
+            await asyncio.shield(job.task)
+        except asyncio.CancelledError:
+            if not job.task.cancelled():
+                raise
+
+            if started:
+                await self._write_to_dedicated_channel(f"Zadanie #{job.id} '{name}' zostało anulowane.")
+
+
+    async def _print_jobs(self):
+        running_jobs = self.jobs.jobs()
+
+        if len(running_jobs) == 0:
+            await self._write_to_dedicated_channel("Brak trwających zadań.")
+            return
+
+        status = "Trwające zadania:\n"
+        for job in running_jobs:
+            duration = timedelta(seconds = round((datetime.now() - job.started).total_seconds()))
+            progress = f", {job.stage}: {job.done}/{job.total}" if job.total > 0 else ""
+            waiting = f", oczekujących zleceń: {job.waiting}" if job.waiting > 0 else ""
+            status += f"#{job.id} {job.name} - trwa od {duration}{progress}{waiting}\n"
+
+        await self._write_to_dedicated_channel(status)
+
+
+    async def _profile(self, message: discord.Message, args: List[str]):
+        """
+            Profile bot for given number of seconds or during execution of given command and send report as an attachment
+        """
+        modes = {"cpu": (True, False), "mem": (False, True), "all": (True, True)}
+        mode = "cpu"
 
-            if member_id_str in unknown_notified_users:
-                await self._write_to_dedicated_channel(f"Nowy użytkownik {discord_name} nie istnieje w bazie. Instrukcja nie zostanie wysłana, ponieważ została wysłana już wcześniej.")
+        if args[0] in modes:
+            mode = args[0]
+            args = args[1:]
+
+        if len(args) == 0:
+            await self._write_to_dedicated_channel("Podaj czas w sekundach lub polecenie do sprofilowania")
+            return
+
+        if self.profiler is not None:
+            await self._write_to_dedicated_channel("Profilowanie już trwa")
+            return
+
+        cpu, memory = modes[mode]
+        self.profiler = Profiler(cpu, memory)
+        self.logger.info(f"Starting {mode} profiling for {repr(args)}")
+
+        self.profiler.start()
+        try:
+            if args[0].isdigit():
+                duration = min(int(args[0]), GuildBot.MaxProfilingTime)
+                await self._write_to_dedicated_channel(f"Profilowanie ({mode}) przez {duration} sekund")
+                await asyncio.sleep(duration)
             else:
-                await self._write_to_dedicated_channel(f"Użytkownik {discord_name} nie istnieje w bazie. Wysyłanie ID na dedykowany kanał.")
+                await self._execute_command(message, args[0], args[1:])
+        finally:
+            report = self.profiler.stop()
+            self.profiler = None
 
-                if self.dry_run:
-                    self.logger.debug(f"Dry run, not sending ID for the user {log_name}")
-                else:
-                    channel = guild.get_channel(self.config.ids_channel_id)
-                    msg1: discord.Message = await channel.send(f"{member.mention} Twoje ID to:")
-                    msg2: discord.Message = await channel.send(f"{member.id}")
+        # profiled command is described in the message, file name is not built from user input
+        filename = f"profile-{mode}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+        await self._send_file_to_dedicated_channel(f"Wynik profilowania ({mode}) dla: {' '.join(args)}", filename, report)
+
+
+    async def _process_joined_members(self, members: List[discord.Member]):
+        """
+            Update roles of users who joined recently and send them their IDs if they are unknown.
+
+            Users are processed in batches to handle join bursts with one roles source query, one report and one storage write.
+        """
+        self.logger.info(f"Processing {len(members)} new users.")
+
+        users_query = {member: self._build_user_flags(member.id) for member in members}
+        new_roles = self.config.roles_source.get_users_roles(users_query)
 
-                    unknown_notified_users[member_id_str] = {"channel": channel.id, "messages": [msg1.id, msg2.id]}
-                    config[RolesBot.UnknownNotifiedUsers] = unknown_notified_users
+        roles_changes = {}
+        for member in members:
+            roles_to_add, roles_to_remove = new_roles.get(member.id, ([], []))
+
+            try:
+                roles_changes[member] = await self._apply_member_roles(member, roles_to_add, roles_to_remove)
+            except discord.HTTPException as error:
+                self.logger.error(f"Could not update roles of new user {repr(member.name)}: {error}")
+                roles_changes[member] = ([], [])
+
+        if len(members) == 1:
+            member = members[0]
+            added_roles, removed_roles = roles_changes[member]
+            await self._single_user_report(f"Aktualizacja ról nowego użytkownika {member.name} zakończona.", added_roles, removed_roles)
+        else:
+            await self._joined_users_report(roles_changes)
+
+        known_users_role = self.config.roles_source.role_for_known_users()
+        unknown_members = [member for member in members if not utils.has_role(member, known_users_role)]
+
+        self.logger.info(f"Unknown users among new ones: {len(unknown_members)}")
+
+        if len(unknown_members) == 0:
+            return
+
+        config = self.storage.get_config()
+        unknown_notified_users = config.get(GuildBot.UnknownNotifiedUsers, {})
+        if isinstance(unknown_notified_users, list):
+            unknown_notified_users = dict.fromkeys(unknown_notified_users, None)
+
+        guild = self.client.get_guild(self.guild_id)
+        status = []
+
+        for member in unknown_members:
+            self.members_state.set_known(member.id, False)
+
+            member_id_str = str(member.id)
+            discord_name, log_name = await utils.build_user_name(self.client, guild, member.id)
+
+            if self.config.ids_channel_id is None:
+                self.logger.debug(f"User ID notification channel is not configured; not sending ID for the user {log_name}")
+                status.append(f"Użytkownik {discord_name} nie istnieje w bazie. Wysyłanie ID wyłączone w konfiguracji.")
+            elif member_id_str in unknown_notified_users:
+                status.append(f"Nowy użytkownik {discord_name} nie istnieje w bazie. Instrukcja nie zostanie wysłana, ponieważ została wysłana już wcześniej.")
+            elif self.dry_run:
+                self.logger.debug(f"Dry run, not sending ID for the user {log_name}")
+                status.append(f"Użytkownik {discord_name} nie istnieje w bazie. Wysyłanie ID na dedykowany kanał.")
+            else:
+                # one failed notification must not lose the others, nor the record of those already sent
+                try:
+                    unknown_notified_users[member_id_str] = await self._send_user_id(guild, member)
+                except discord.HTTPException as error:
+                    self.logger.error(f"Could not send ID to the user {log_name}: {error}")
+                    status.append(f"Użytkownik {discord_name} nie istnieje w bazie. **Nie udało się wysłać ID na dedykowany kanał.**")
+                else:
+                    status.append(f"Użytkownik {discord_name} nie istnieje w bazie. Wysyłanie ID na dedykowany kanał.")
 
+        if self.config.ids_channel_id is not None:
+            config[GuildBot.UnknownNotifiedUsers] = unknown_notified_users
             self.storage.set_config(config)
 
+        await self._write_to_dedicated_channel("\n".join(status))
+
+
+    async def _send_user_id(self, guild: discord.Guild, member: discord.Member) -> Dict[str, Any]:
+        """
+            Send user's ID to the ids channel, paced to not hit channel's rate limit during join bursts.
+        """
+        channel = guild.get_channel(self.config.ids_channel_id)
+
+        await self.ids_channel_budget.acquire()
+        msg1: discord.Message = await self.request_scheduler.call(channel.send, f"{member.mention} Twoje ID to:")
+        await self.ids_channel_budget.acquire()
+        msg2: discord.Message = await self.request_scheduler.call(channel.send, f"{member.id}")
+
+        return {"channel": channel.id, "messages": [msg1.id, msg2.id]}
+
+
+    async def _joined_users_report(self, roles_changes: Dict[discord.Member, Tuple[List[str], List[str]]]):
+        """
+            Report to dedicated channel about role changes of many new users at once
+        """
+        self.logger.info("Print report")
+        message_parts = [f"Aktualizacja ról nowych użytkowników ({len(roles_changes)}) zakończona."]
+
+        added_roles_status = "".join(f"{member.name}: {', '.join(added)}\n" for member, (added, _) in roles_changes.items() if len(added) > 0)
+        removed_roles_status = "".join(f"{member.name}: {', '.join(removed)}\n" for member, (_, removed) in roles_changes.items() if len(removed) > 0)
+
+        if added_roles_status:
+            message_parts.append("Nadane role:\n" + added_roles_status)
+
+        if removed_roles_status:
+            message_parts.append("Usunięte role:\n" + removed_roles_status)
+
+        if not added_roles_status and not removed_roles_status:
+            message_parts.append("Brak ról do nadania lub zabrania.")
+
+        final_message = "\n".join(message_parts)
+        await self._write_to_dedicated_channel(escape_markdown(final_message))
+
+
     async def on_member_remove(self, member: discord.Member):
-        guild = self.get_guild(self.guild_id)
-        discord_name, log_name = await utils.build_user_name(self, guild, member)
+        self.member_index.remove(member)
+
+        if self.coordinator.owns(member.id):
+            self.leave_batcher.add(member)
+        else:
+            # state is kept complete on every instance, only reports and revoking belong to the owner
+            self.members_state.remove(member.id)
+
+
+    async def _process_left_members(self, members: List[discord.Member]):
+        """
+            Clean up after users who left the guild.
+
+            Users are processed in batches, so each regulations message is fetched and walked through once per batch (prunes, raids cleanups).
+            Nicknames are not reset, as it is not possible for users who are not on the server anymore.
+        """
+        guild = self.client.get_guild(self.guild_id)
+        discord_names = []
+
+        for member in members:
+            discord_name, log_name = await utils.build_user_name(self.client, guild, member)
+            self.logger.info(f"User {log_name} left guild")
+            discord_names.append(discord_name)
+
+        if len(members) == 1:
+            summary = f"Użytkownik {discord_names[0]} opuścił serwer"
+        else:
+            summary = f"Użytkownicy którzy opuścili serwer ({len(members)}): {', '.join(discord_names)}"
+
+        # forgotten before revoking, so removal events of revoked reactions are not reported as rejections one by one
+        for member in members:
+            self.members_state.remove(member.id)
 
-        self.logger.info(f"User {log_name} left guild")
-        await self._write_to_dedicated_channel(f"Użytkownik {discord_name} opuścił serwer", logging.INFO)
-        await self._user_becomes_unknown(member)
+        with RequestScheduler.priority(Priority.Bulk):
+            await self._write_to_dedicated_channel(summary + "\nUsuwanie akceptacji regulaminu.", logging.INFO)
+            await self._revoke_users_acceptances(members)
 
 
     async def on_raw_reaction_add(self, payload):
@@ -396,7 +758,7 @@ class RolesBot(discord.Client):
 
 
     def _is_level_sufficent_for_send(self, level: int) -> bool:
-        allowed_level = self.storage.get_config()[RolesBot.VerbosityEntry]
+        allowed_level = self.storage.get_config()[GuildBot.VerbosityEntry]
         send = level >= allowed_level
 
         return send
@@ -406,43 +768,76 @@ class RolesBot(discord.Client):
         send = self._is_level_sufficent_for_send(level)
 
         if send:
-            self.logger.debug(f"Sending {level} level message {repr(message)}")
+            self.logger.debug("Sending %s level message %r", level, message)
 
             message_splitted = self._split_message(message)
 
             prefix = "" if self.message_prefix == "" else self.message_prefix + " "
 
             for part in message_splitted:
-                await self.channel.send(prefix + part)
+                await self.request_scheduler.call(self.channel.send, prefix + part)
         else:
-            self.logger.debug(f"Not Sending {level} level message {repr(message)}")
+            self.logger.debug("Not Sending %s level message %r", level, message)
+
+
+    async def _send_file_to_dedicated_channel(self, message: str, filename: str, content: str):
+        self.logger.debug("Sending file %s with message %r", filename, message)
+
+        prefix = "" if self.message_prefix == "" else self.message_prefix + " "
+        file = discord.File(io.BytesIO(content.encode("utf-8")), filename = filename)
+
+        await self.request_scheduler.call(self.channel.send, prefix + message, file = file)
+
+
+    @tasks.loop(seconds = ShardCoordinator.HeartbeatInterval)
+    async def _heartbeat(self):
+        # separate from auto refresh, which waits for whole refresh to finish, while peers take over silent instance's shard
+        try:
+            await self.coordinator.heartbeat()
+        except Exception:
+            self.logger.exception("Shard heartbeat failed")
 
 
     @tasks.loop(seconds = 60)
     async def _auto_refresh(self):
-        now = datetime.now()
-        time_since_last_auto_refresh = now - self.last_auto_refresh
+        if not self.members_ready.is_set():
+            return
 
-        refresh_delta = self.storage.get_config()[RolesBot.AutoRefreshEntry]
+        with RequestScheduler.priority(Priority.Bulk):
+            now = datetime.now()
+            time_since_last_auto_refresh = now - self.last_auto_refresh
 
-        if time_since_last_auto_refresh >= timedelta(minutes = refresh_delta):
-            self.logger.info("Auto refresh condition triggered")
-            await self._write_to_dedicated_channel("Automatyczne odświeżanie ról (timer event).")
-            self.last_auto_refresh = now
+            refresh_delta = self.storage.get_config()[GuildBot.AutoRefreshEntry]
 
-            guild = self.get_guild(self.guild_id)
-            members = self._collect_all_users(guild)
-            user_ids = [member.id for member in members]
+            if time_since_last_auto_refresh >= timedelta(minutes = refresh_delta):
+                self.logger.info("Auto refresh condition triggered")
+                await self._write_to_dedicated_channel("Automatyczne odświeżanie ról (timer event).")
+                self.last_auto_refresh = now
 
-            await self._refresh_roles(members)
-            await self._refresh_names(user_ids)
+                guild = self.client.get_guild(self.guild_id)
+                await self._run_job("refresh", lambda: self._auto_refresh_members(guild))
 
-        time_since_last_thread_refresh = now - self.last_thread_refresh
 
-        if time_since_last_thread_refresh >= timedelta(days = 3):
-            await self._write_to_dedicated_channel("Automatyczne odświeżanie wątków")
-            await self._ping_important_threads()
-            self.last_thread_refresh = now
+    async def _auto_refresh_members(self, guild: discord.Guild):
+        """
+            Refresh started by timer. In adaptive mode its results decide when the next one happens
+        """
+        members = self._collect_own_users(guild)
+        bulk_latency = self.request_scheduler.latency[Priority.Bulk]
+        requests_before, latency_before = bulk_latency.count, bulk_latency.total
+        rate_limited_before = self.metrics.rest_rate_limited.total()
+
+        changes = await self._refresh_members(members)
+
+        config = self.storage.get_config()
+        if config[GuildBot.AdaptiveRefreshEntry]:
+            requests = bulk_latency.count - requests_before
+            average_latency = (bulk_latency.total - latency_before) / requests if requests > 0 else 0.0
+            rate_limited = int(self.metrics.rest_rate_limited.total() - rate_limited_before)
+            result = RefreshResult(len(members), changes, requests, average_latency, rate_limited)
+
+            config[GuildBot.AutoRefreshEntry] = self.refresh_tuner.next_interval(config[GuildBot.AutoRefreshEntry], result)
+            self.storage.set_config(config)
 
 
     async def _single_user_report(self, title: str, added_roles: List[str], removed_roles: List[str]):
@@ -474,18 +869,21 @@ class RolesBot(discord.Client):
         """
             Apply roles user has chosen by reacting to certain messages
         """
-        guild = self.get_guild(payload.guild_id)
+        guild = self.client.get_guild(payload.guild_id)
         channel_id = payload.channel_id
 
         if channel_id in self.config.auto_roles_channels:
             member_id = payload.user_id
             message_id = payload.message_id
 
-            member = guild.get_member(member_id)
-            name_for_discord, name_for_log = await utils.build_user_name(self, guild, member)
+            if not self.coordinator.owns(member_id):
+                return
+
+            member = await self._get_member(guild, member_id)
+            name_for_discord, name_for_log = await utils.build_user_name(self.client, guild, member)
 
             self.logger.info(f"Updating auto roles for user {name_for_log}")
-            channel = await self.fetch_channel(channel_id)
+            channel = await self.client.fetch_channel(channel_id)
             message = await channel.fetch_message(message_id)
             self.logger.debug(f"Caused by reaction on message {message.content} in channel {channel}")
             roles_to_add, roles_to_remove = roles_source(member, message)
@@ -513,51 +911,47 @@ class RolesBot(discord.Client):
             self.logger.error(f"Payload for _check_reaction_on_regulations came from unknown guild: {payload.guild_id} != {self.guild_id}")
             return
 
-        if str(payload.emoji) != RolesBot.AcceptanceEmoji:
+        if str(payload.emoji) != GuildBot.AcceptanceEmoji:
             return
 
         member_id = payload.user_id
 
-        if added:
-            self.user_regulations_status[member_id].add(full_id)
-        else:
-            self.user_regulations_status[member_id].discard(full_id)
+        # acceptance of all regulations can be evaluated only with complete state
+        await self._wait_for_members()
+
+        acceptance_changed = self.members_state.set_regulation(member_id, full_id, added)
 
-        guild = self.get_guild(self.guild_id)
+        if not self.coordinator.owns(member_id):
+            return
+
+        guild = self.client.get_guild(self.guild_id)
         member = guild.get_member(member_id)
         if member is None:
             self.logger.info(f"Got reaction on regulations message: {channel_id}/{message_id} by user who most likely left guild: {member_id}")
         else:
             self.logger.info(f"User {member.name} reacted on regulations message: {channel_id}/{message_id}")
 
-        current_list_of_users = self.member_ids_accepted_regulations
-        new_list_of_users = self._collect_users_who_accepted_all_regulations(self.user_regulations_status)
-
-        removed_acceptance = current_list_of_users - new_list_of_users
-        added_acceptance = new_list_of_users - current_list_of_users
-
-        self.member_ids_accepted_regulations = new_list_of_users
+        accepted = self.members_state.is_accepted(member_id)
+        added_acceptance = [member_id] if acceptance_changed and accepted else []
+        removed_acceptance = [member_id] if acceptance_changed and not accepted else []
 
         affected_users = []
 
         for added in added_acceptance:
-            display_name, _ = await utils.build_user_name(self, guild, added)
+            display_name, _ = await utils.build_user_name(self.client, guild, added)
             await self._write_to_dedicated_channel(f"Użytkownik {display_name} zaakceptował regulamin w całości.")
             affected_users.append(added)
 
         for removed in removed_acceptance:
-            display_name, _ = await utils.build_user_name(self, guild, removed)
+            display_name, _ = await utils.build_user_name(self.client, guild, removed)
             await self._write_to_dedicated_channel(f"Użytkownik {display_name} odrzucił regulamin (lub jego fragment).")
             affected_users.append(removed)
 
-        if len(affected_users) > 1:
-            self.logger.warning(f"There was one change expected, yet got {len(affected_users)}")
-
         for member_id in affected_users:
             affected_member = guild.get_member(member_id)
 
             if affected_member is None:
-                self.logger.debug(f"User {member_id} was not found in the guild, skipping roles update")
+                self.logger.debug("User %s was not found in the guild, skipping roles update", member_id)
             else:
                 added_roles, removed_roles = await self._update_member_roles(affected_member)
                 await self._single_user_report(f"Aktualizacja ról użytkownika {affected_member.name} zakończona.", added_roles, removed_roles)
@@ -566,8 +960,10 @@ class RolesBot(discord.Client):
             await self._refresh_names(added_acceptance)
 
         if len(removed_acceptance) > 0:
-            members = utils.get_members(guild, removed_acceptance)
-            await self._reset_names(members)
+            members = [member for member in utils.get_members(guild, removed_acceptance) if member is not None]
+
+            if len(members) > 0:
+                await self._reset_names(members)
 
 
     async def _check_autorefresh(self, payload):
@@ -585,7 +981,12 @@ class RolesBot(discord.Client):
         if message_id != self.config.user_auto_refresh_roles_message_id[1]:
             return
 
-        guild = self.get_guild(payload.guild_id)
+        if not self.coordinator.owns(payload.user_id):
+            return
+
+        await self._wait_for_members()
+
+        guild = self.client.get_guild(payload.guild_id)
         member = guild.get_member(payload.user_id)
         self.logger.info(f"User {member.name} reacted on autorefresh message.")
 
@@ -601,7 +1002,7 @@ class RolesBot(discord.Client):
         if known and not accepted:
             self.logger.info(f"User {member.name} is known but has not accepted regulations yet. Sending reminder.")
             await self._write_to_dedicated_channel(f"Wysyłanie przypomnienia użytkownikowi {member.display_name} ({member.name}) o akceptacji regulaminu.")
-            await member.send("Został Ci przyznany dostęp do serwera. Teraz tylko przeczytaj i **zaakceptuj** regulamin, aby w pełni korzystać z dostępnych kanałów")
+            await self.request_scheduler.call(member.send, "Został Ci przyznany dostęp do serwera. Teraz tylko przeczytaj i **zaakceptuj** regulamin, aby w pełni korzystać z dostępnych kanałów")
 
 
     async def _update_member_roles(self, member: discord.Member) -> Tuple[List, List]:
@@ -612,73 +1013,141 @@ class RolesBot(discord.Client):
         """
         flags = self._build_user_flags(member.id)
         roles_to_add, roles_to_remove = self.config.roles_source.get_user_roles(member, flags)
-        self.logger.debug(f"Roles to add: {repr(roles_to_add)}, roles to remove: {repr(roles_to_remove)}")
+        self.logger.debug("Roles to add: %r, roles to remove: %r", roles_to_add, roles_to_remove)
 
         added, removed = await self._apply_member_roles(member, roles_to_add, roles_to_remove)
 
         return added, removed
 
 
-    async def _apply_member_roles(self, member: discord.Member, roles_to_add: List[str], roles_to_remove: List[str]) -> Tuple[List[str], List[str]]:
+    def _plan_member_roles(self, member: discord.Member, roles_to_add: List[str], roles_to_remove: List[str]) -> RolesChange:
+        """
+            Compute which of given roles need to be actually added to or removed from the user
+        """
+        member_role_names = {role.name for role in member.roles}
+
+        missing_roles = [add for add in roles_to_add if add not in member_role_names]
+        redundant_roles = [remove for remove in roles_to_remove if remove in member_role_names]
+
+        if self.manageable_roles is None:
+            return RolesChange(member, missing_roles, redundant_roles)
+
+        # requests for roles bot cannot manage would be rejected anyway
+        skipped_roles = [role for role in missing_roles + redundant_roles if role not in self.manageable_roles]
+
+        return RolesChange(member,
+                           [role for role in missing_roles if role in self.manageable_roles],
+                           [role for role in redundant_roles if role in self.manageable_roles],
+                           skipped_roles)
+
+
+    async def _apply_member_roles(self, member: discord.Member, roles_to_add: List[str], roles_to_remove: List[str],
+                                  skipped_roles: Optional[Dict[str, List[str]]] = None) -> Tuple[List[str], List[str]]:
         """
-            Apply given roles to the user
+            Apply given roles to the user.
+
+            Roles bot cannot manage are reported right away, or collected in `skipped_roles` (role name -> user names) for one report of a mass operation.
         """
-        member_roles = member.roles
-        member_role_names = {role.name for role in member_roles}
+        start = time.perf_counter()
+
+        change = self._plan_member_roles(member, roles_to_add, roles_to_remove)
+        added_roles, removed_roles = await self._execute_roles_change(change, skipped_roles)
+
+        self.metrics.apply_member_roles.observe(time.perf_counter() - start)
+
+        return (added_roles, removed_roles)
 
-        added_roles = []
-        removed_roles = []
 
+    async def _execute_roles_change(self, change: RolesChange, skipped_roles: Optional[Dict[str, List[str]]] = None) -> Tuple[List[str], List[str]]:
+        """
+            Send planned roles change to Discord
+        """
+        member = change.member
         issues = ""
 
-        # add missing roles
-        missing_roles = [add for add in roles_to_add if add not in member_role_names]
+        if len(change.skipped) > 0:
+            self.logger.debug("Skipping roles bot cannot manage for %s: %r", member.name, change.skipped)
 
-        if len(missing_roles) > 0:
-            missing_ids = [discord.utils.get(member.guild.roles, name=role_name) for role_name in missing_roles]
+            if skipped_roles is None:
+                issues += f"**Bot nie może zarządzać rolami {', '.join(change.skipped)}, pominięto je u użytkownika {member.display_name} ({member.name})**\n"
+            else:
+                for role_name in change.skipped:
+                    skipped_roles[role_name].append(member.name)
+
+        # add missing roles
+        if len(change.add) > 0:
+            missing_ids = [discord.utils.get(member.guild.roles, name=role_name) for role_name in change.add]
             try:
                 if self.dry_run:
                     self.logger.debug("Dry run mode, not applying roles")
                 else:
-                    await member.add_roles(*missing_ids)
+                    await self.request_scheduler.call(member.add_roles, *missing_ids)
+                    self._journal_changes(member, ChangeJournal.RoleAdded, change.add)
             except discord.errors.Forbidden:
                 self.logger.warning("Some roles could not be applied")
                 issues += f"**Brak uprawnień aby nadać (niektóre) role użytkownikowi {member.display_name} ({member.name})**\n"
-            added_roles = missing_roles
 
         # remove taken roles
-        redundant_roles = [remove for remove in roles_to_remove if remove in member_role_names]
-
-        if len(redundant_roles) > 0:
-            redundant_ids = [discord.utils.get(member.guild.roles, name=role_name) for role_name in redundant_roles]
+        if len(change.remove) > 0:
+            redundant_ids = [discord.utils.get(member.guild.roles, name=role_name) for role_name in change.remove]
             try:
                 if self.dry_run:
                     self.logger.debug("Dry run mode, not applying roles")
                 else:
-                    await member.remove_roles(*redundant_ids)
+                    await self.request_scheduler.call(member.remove_roles, *redundant_ids)
+                    self._journal_changes(member, ChangeJournal.RoleRemoved, change.remove)
             except discord.errors.Forbidden:
                 self.logger.warning("Some roles could not be taken")
                 issues += f"**Brak uprawnień aby zabrać (niektóre) role użytkownikowi {member.display_name} ({member.name})**\n"
 
-            removed_roles = redundant_roles
-
         if issues:
             await self._write_to_dedicated_channel(issues)
 
-        if self.config.roles_source.role_for_known_users() in added_roles:
+        if self.config.roles_source.role_for_known_users() in change.add:
             # user is known now
             await self._user_becomes_known(member.id)
 
-        if self.config.roles_source.role_for_known_users() in removed_roles:
+        if self.config.roles_source.role_for_known_users() in change.remove:
             # user is unknown now
             await self._user_becomes_unknown(member)
 
-        return (added_roles, removed_roles)
+        return (change.add, change.remove)
+
+
+    def _journal_changes(self, member: discord.Member, change: str, values: List[str]):
+        job = jobs.current_job()
+        source = "event" if job is None else job.name
+
+        for value in values:
+            self.journal.record(member.id, member.name, change, value, source)
+
+
+    async def _print_history(self, args: List[str]):
+        if args[0].isdigit():
+            member_id = int(args[0])
+            role = " ".join(args[1:]) if len(args) > 1 else None
+            entries = await asyncio.to_thread(self.journal.member_history, member_id, role, GuildBot.HistoryLimit)
+            title = f"Historia zmian użytkownika {member_id}" + ("" if role is None else f" (rola {role})")
+        else:
+            role = " ".join(args)
+            entries = await asyncio.to_thread(self.journal.role_history, role, GuildBot.HistoryLimit)
+            title = f"Historia zmian roli {role}"
+
+        if len(entries) == 0:
+            await self._write_to_dedicated_channel(f"{title}: brak wpisów.")
+            return
+
+        descriptions = {ChangeJournal.RoleAdded: "nadano rolę", ChangeJournal.RoleRemoved: "zabrano rolę", ChangeJournal.Nickname: "zmieniono nick na"}
+        history = f"{title} (ostatnie {len(entries)}):\n"
+        for entry in entries:
+            history += f"{datetime.fromtimestamp(entry.time).strftime('%Y-%m-%d %H:%M:%S')} {entry.member_name}: {descriptions[entry.change]} {entry.value} ({entry.source})\n"
+
+        await self._write_to_dedicated_channel(escape_markdown(history))
 
 
     async def _user_becomes_known(self, member_id: int):
         config = self.storage.get_config()
-        notified_users = config.get(RolesBot.UnknownNotifiedUsers, {})
+        notified_users = config.get(GuildBot.UnknownNotifiedUsers, {})
 
         member_id_str = str(member_id)
 
@@ -686,153 +1155,120 @@ class RolesBot(discord.Client):
             messages_info = notified_users[member_id_str]
 
             if messages_info is not None:
-                guild = self.get_guild(self.guild_id)
+                guild = self.client.get_guild(self.guild_id)
                 channel_id = messages_info["channel"]
                 messages_ids = messages_info["messages"]
 
                 channel: discord.TextChannel = guild.get_channel(channel_id)
                 try:
                     messages = [await channel.fetch_message(messages_id) for messages_id in messages_ids]
-                    await channel.delete_messages(messages)
+                    await self.request_scheduler.call(channel.delete_messages, messages)
                 except:
                     pass
 
             del notified_users[member_id_str]
-            config[RolesBot.UnknownNotifiedUsers] = notified_users
+            config[GuildBot.UnknownNotifiedUsers] = notified_users
 
             self.storage.set_config(config)
 
 
     async def _user_becomes_unknown(self, member: discord.Member):
         await self._reset_names([member])
-        await self._revoke_user_acceptances(member)
 
+        guild = self.client.get_guild(self.guild_id)
+        discord_name, _ = await utils.build_user_name(self.client, guild, member)
+        await self._write_to_dedicated_channel(f"Usuwanie akceptacji regulaminu użytkownika {discord_name}", logging.INFO)
+        await self._revoke_users_acceptances([member])
 
-    async def _revoke_user_acceptances(self, member: discord.Member):
-        guild = self.get_guild(self.guild_id)
-        discord_name, log_name = await utils.build_user_name(self, guild, member)
 
-        self.logger.info(f"Removing acceptance of regulations for user {log_name}")
-        await self._write_to_dedicated_channel(f"Usuwanie akceptacji regulaminu użytkownika {discord_name}", logging.INFO)
+    async def _revoke_users_acceptances(self, members: List[discord.Member]):
+        """
+            Remove reactions of given users from all regulations messages
+        """
+        guild = self.client.get_guild(self.guild_id)
+        member_ids = {member.id for member in members}
+
+        self.logger.info(f"Removing acceptance of regulations for users {repr(member_ids)}")
 
         for channel_id, message_id in self.config.server_regulations_message_ids:
             message = await utils.get_message(guild, channel_id, message_id)
-            status = await utils.remove_user_reactions(guild, message, member.id)
+            status = await utils.remove_users_reactions(guild, message, member_ids, self.request_scheduler)
 
             if not status:
-                self.logger.warning("Unable to remove user's reaction")
+                self.logger.warning("Unable to remove users' reactions")
 
 
     def _build_user_flags(self, member_id: int) -> Dict[UserStatusFlags, bool]:
         flags = {}
-        flags[UserStatusFlags.Known] = False if member_id in self.unknown_users else True
-        flags[UserStatusFlags.Accepted] = True if member_id in self.member_ids_accepted_regulations else False
+        member_flags = self.members_state.get_flags(member_id)
+        flags[UserStatusFlags.Known] = bool(member_flags & MemberFlags.Known)
+        flags[UserStatusFlags.Accepted] = bool(member_flags & MemberFlags.Accepted)
         return flags
 
 
-    async def _refresh_roles(self, members: List[discord.Member]):
+    def _plan_roles(self, members: List[discord.Member]) -> List[RolesChange]:
         """
-            Iterate over given set of members and update their roles.
+            Compute roles changes for given members. Nothing is sent to Discord.
         """
-        self.logger.info(f"Refreshing roles for {len(members)} users.")
-        added_roles = {}
-        removed_roles = {}
-        guild = self.get_guild(self.guild_id)
+        guild = self.client.get_guild(self.guild_id)
 
         users_query = {member: self._build_user_flags(member.id) for member in members}
         new_roles = self.config.roles_source.get_users_roles(users_query)
 
+        changes = []
         for member_id, (add, remove) in new_roles.items():
-            member = guild.get_member(member_id)
-            self.logger.debug(f"Processing user {repr(member.name)}")
+            change = self._plan_member_roles(guild.get_member(member_id), add, remove)
 
-            start = time.time()
-            added, removed = await self._apply_member_roles(member, add, remove)
-            end = time.time()
+            # changes of skipped roles only are kept, so applying the plan reports them
+            if change.api_calls() > 0 or len(change.skipped) > 0:
+                changes.append(change)
 
-            elsaped = end - start
-            if elsaped > 0.4:
-                self.logger.warning(f"Time consumed in _apply_member_roles(): {end - start}")
+        return changes
 
-            if len(added) > 0:
-                added_roles[member.name] = added
 
-            if len(removed) > 0:
-                removed_roles[member.name] = removed
+    def _plan_nicknames(self, ids: List[int]) -> List[NicknameChange]:
+        """
+            Compute nickname changes for given users. Only users who accepted regulations are renamed.
+        """
+        users_to_proceed = {member_id for member_id in ids if self.members_state.is_accepted(member_id)}
 
-            if len(added) > 0 and len(removed) > 0:
-                # in case of any role change action, perform a sleep to avoid rate limit
-                await asyncio.sleep(0.2)
+        if len(users_to_proceed) == 0:
+            self.logger.warning("No users to refresh their names")
+            return []
 
-        self.logger.info("Print reports")
-        message_parts = []
+        names = self.config.nicknames_source.get_nicknames_for(users_to_proceed)
+        guild = self.client.get_guild(self.guild_id)
 
-        message_parts.append("Aktualizacja ról zakończona.")
-        if len(added_roles) > 0:
-            added_roles_status = "Nowe role nadane użytkownikom:\n"
-            for user, roles in added_roles.items():
-                added_roles_status += f"{user}: {', '.join(roles)}\n"
-            message_parts.append(added_roles_status)
+        changes = []
+        for id, name in names.items():
+            if name is None:
+                continue
 
-        if len(removed_roles) > 0:
-            removed_roles_status = "Role zabrane użytkownikom:\n"
-            for user, roles in removed_roles.items():
-                removed_roles_status += f"{user}: {', '.join(roles)}\n"
-            message_parts.append(removed_roles_status)
-
-        if len(added_roles) == 0 and len(removed_roles) == 0:
-            message_parts.append("Brak zmian do wprowadzenia.")
-
-        final_message = "\n".join(message_parts)
-        final_message_escaped = escape_markdown(final_message)
-        await self._write_to_dedicated_channel(final_message_escaped, logging.DEBUG)
-
-
-    async def _refresh_names(self, ids: List[int]):
-        users_with_accepted_regulations = self.member_ids_accepted_regulations
-        users_to_proceed = set(ids) & users_with_accepted_regulations
-
-        if len(users_to_proceed) == 0:
-            self.logger.warning("No users to refresh their names")
-            return
-
-        names = self.config.nicknames_source.get_nicknames_for(users_to_proceed)
-        guild = self.get_guild(self.guild_id)
-
-        renames = "Zmiany nicków:\n"
-
-        nickname_changes = ""
-        for id, name in names.items():
-            if name is None:
-                continue
-
-            member_id = int(id)
-            member = guild.get_member(member_id)
-            _, log_name = await utils.build_user_name(self, guild, member)
-            self.logger.debug(f"Preparing for refresh of {log_name}")
+            member = guild.get_member(int(id))
 
             if member.display_name == name:
-                self.logger.debug(f"Name already valid: {member.display_name} == {name}")
+                self.logger.debug("Name already valid: %s == %s", member.display_name, name)
             else:
-                self.logger.info(f"Renaming {member.display_name} ({member.name}) to {name}")
-                if self.dry_run:
-                    self.logger.debug("Dry run mode, not changing name")
-                else:
-                    await member.edit(nick = name)
-                nickname_changes += f"{member.display_name} ({member.name}) -> {name}\n"
+                changes.append(NicknameChange(member, name))
 
-        if len(nickname_changes) == 0:
-            nickname_changes = "brak"
+        return changes
 
-        renames += nickname_changes
 
-        await self._write_to_dedicated_channel(renames, logging.DEBUG)
+    def _plan_refresh(self, members: List[discord.Member], description: str) -> ChangesPlan:
+        plan = ChangesPlan(description, self._plan_roles(members), self._plan_nicknames([member.id for member in members]))
+        plan.prioritize(self.config.roles_source.role_for_known_users())
 
+        return plan
 
-    async def _refresh_autoroles(self):
-        guild = self.get_guild(self.guild_id)
-        members = self._collect_all_users(guild)
 
+    async def _plan_autoroles(self, mismatched_only: bool = False) -> ChangesPlan:
+        """
+            Collect roles users have chosen in auto roles channels, but do not have.
+
+            With `mismatched_only` reactions are collected only under messages with number of reactions
+            different from number of role's members, other messages are assumed to be in sync.
+        """
+        guild = self.client.get_guild(self.guild_id)
         roles = [role.name for role in guild.roles]
         roles_to_apply = defaultdict(set)
 
@@ -841,38 +1277,268 @@ class RolesBot(discord.Client):
             channel: discord.TextChannel = await guild.fetch_channel(channel_id)
             async for message in channel.history():
                 content = message.content
-
                 if content in roles:
                     role_name = content
-                    members = await utils.collect_members_reacting_on_message(message, RolesBot.AcceptanceEmoji)
+
+                    if mismatched_only and self._reactions_count(message) == len(discord.utils.get(guild.roles, name = role_name).members):
+                        continue
+
+                    members = await utils.collect_members_reacting_on_message(message, GuildBot.AcceptanceEmoji)
                     for member in members:
-                        if isinstance(member, discord.Member) and not utils.has_role(member, role_name):
+                        if isinstance(member, discord.Member) and self.coordinator.owns(member.id) and not utils.has_role(member, role_name):
                             roles_to_apply[member].add(role_name)
 
         self.logger.debug(f"Found {len(roles_to_apply)} users with missing roles")
-        for member, roles in roles_to_apply.items():
-            discord_name, _ = await utils.build_user_name(self, guild, member)
-            await self._write_to_dedicated_channel(f"Przywracanie brakujących ról użytkownikowi {discord_name}: {', '.join(roles)}")
-            await self._apply_member_roles(member, roles, [])
 
+        return ChangesPlan("refresh_autoroles", [RolesChange(member, sorted(roles), []) for member, roles in roles_to_apply.items()])
 
-    async def _ping_important_threads(self):
-        for thread_id in self.config.threads_to_keep_alive:
-            guild = self.get_guild(self.guild_id)
-            channel = await guild.fetch_channel(thread_id)
-            if channel is None:
-                self.logger.error(f"Could not fetch channel/thread with id {thread_id}")
-                await self._write_to_dedicated_channel(f"Kanał {thread_id} nie istnieje.")
+
+    async def _apply_plan(self, plan: ChangesPlan) -> Tuple[Dict[str, Tuple[List[str], List[str]]], List[str]]:
+        """
+            Apply changes from plan. Returns applied roles changes (by user name) and nickname changes descriptions.
+
+            Plan may be old, so each change is checked against current state of the server before it is sent.
+        """
+        self.logger.info(f"Applying plan {repr(plan.description)}: {len(plan.roles)} roles changes, {len(plan.nicknames)} nickname changes, {plan.api_calls()} requests")
+        guild = self.client.get_guild(self.guild_id)
+        roles_changes = {}
+        skipped_roles = defaultdict(list)
+
+        for index, planned in enumerate(plan.roles, start = 1):
+            member = guild.get_member(planned.member.id)
+            if member is None:
+                self.logger.debug("User %r left guild, skipping roles change", planned.member.name)
                 continue
 
-            self.logger.debug(f"Pinging channel {channel.name}")
-            try:
-                message: discord.Message = await channel.send(".")
-            except discord.errors.Forbidden:
-                channel_link = utils.generate_link(self.guild_id, thread_id)
-                await self._write_to_dedicated_channel(f"Brak praw by pingować kanał {channel_link} ({channel.name})")
+            self.logger.debug("Processing user %r", member.name)
+
+            start = time.time()
+            added, removed = await self._apply_member_roles(member, planned.add, planned.remove, skipped_roles)
+            end = time.time()
+
+            for role_name in planned.skipped:
+                skipped_roles[role_name].append(member.name)
+
+            elsaped = end - start
+            if elsaped > 0.4:
+                self.logger.warning("Time consumed in _apply_member_roles(): %s", end - start)
+
+            if len(added) > 0 or len(removed) > 0:
+                roles_changes[member.name] = (added, removed)
+
+            jobs.report_progress("role", index, len(plan.roles))
+            if index % GuildBot.PlanProgressStep == 0:
+                self.logger.info(f"Applied {index} of {len(plan.roles)} roles changes")
+
+        if len(skipped_roles) > 0:
+            await self._skipped_roles_report(skipped_roles)
+
+        nickname_changes = []
+        for index, planned in enumerate(plan.nicknames, start = 1):
+            jobs.report_progress("nicki", index, len(plan.nicknames))
+            member = guild.get_member(planned.member.id)
+            if member is None or not self.members_state.is_accepted(member.id) or member.display_name == planned.nickname:
+                self.logger.debug("Nickname change of %r is not valid anymore, skipping", planned.member.name)
+                continue
+
+            self.logger.info("Renaming %s (%s) to %s", member.display_name, member.name, planned.nickname)
+            if self.dry_run:
+                self.logger.debug("Dry run mode, not changing name")
             else:
-                await channel.delete_messages([message])
+                await self.request_scheduler.call(member.edit, nick = planned.nickname)
+                self._journal_changes(member, ChangeJournal.Nickname, [planned.nickname])
+            nickname_changes.append(f"{member.display_name} ({member.name}) -> {planned.nickname}")
+
+        return (roles_changes, nickname_changes)
+
+
+    async def _skipped_roles_report(self, skipped_roles: Dict[str, List[str]]):
+        """
+            One warning about all roles changes skipped by mass operation, as bot is not able to manage the roles
+        """
+        self.logger.warning("Skipped changes of roles bot cannot manage: %s", {role_name: len(users) for role_name, users in skipped_roles.items()})
+        report = "**Bot nie może zarządzać rolami (brak uprawnienia 'Zarządzanie rolami' lub rola jest wyżej niż rola bota). Pominięte zmiany:**\n"
+
+        for role_name, users in sorted(skipped_roles.items()):
+            report += f"{role_name}: {len(users)} użytkowników"
+            report += f" ({', '.join(users)})\n" if len(users) <= GuildBot.ReportDetailsLimit else "\n"
+
+        await self._write_to_dedicated_channel(escape_markdown(report), logging.WARNING)
+
+
+    async def _refresh_members(self, members: List[discord.Member]) -> int:
+        """
+            Refresh roles and names of given members. Returns number of changes made
+        """
+        changes = await self._refresh_roles(members)
+        changes += await self._refresh_names([member.id for member in members])
+        await self.coordinator.record_refresh()
+
+        return changes
+
+
+    async def _refresh_roles(self, members: List[discord.Member]) -> int:
+        """
+            Iterate over given set of members and update their roles. Returns number of members whose roles changed
+        """
+        self.logger.info(f"Refreshing roles for {len(members)} users.")
+        refresh_start = time.perf_counter()
+
+        plan = ChangesPlan("refresh roles", self._plan_roles(members))
+        plan.prioritize(self.config.roles_source.role_for_known_users())
+        roles_changes, _ = await self._apply_plan(plan)
+
+        self.metrics.refresh_duration.observe(time.perf_counter() - refresh_start)
+        self.metrics.refresh_members.inc(len(members))
+
+        await self._roles_changes_report(roles_changes)
+
+        return len(roles_changes)
+
+
+    async def _refresh_names(self, ids: List[int]) -> int:
+        plan = ChangesPlan("refresh names", nicknames = self._plan_nicknames(ids))
+        _, nickname_changes = await self._apply_plan(plan)
+
+        await self._nickname_changes_report(nickname_changes)
+
+        return len(nickname_changes)
+
+
+    async def _roles_changes_report(self, roles_changes: Dict[str, Tuple[List[str], List[str]]]):
+        self.logger.info("Print reports")
+        message_parts = []
+
+        message_parts.append("Aktualizacja ról zakończona.")
+
+        if len(roles_changes) > GuildBot.ReportDetailsLimit:
+            added_count = sum(1 for added, _ in roles_changes.values() if len(added) > 0)
+            removed_count = sum(1 for _, removed in roles_changes.values() if len(removed) > 0)
+            # in dry run changes are not journaled, so there are no details to look up
+            details = "" if self.dry_run else " Szczegóły: polecenie 'history'."
+            message_parts.append(f"Nadano role {added_count} użytkownikom, zabrano role {removed_count} użytkownikom.{details}")
+            await self._write_to_dedicated_channel("\n".join(message_parts), logging.DEBUG)
+            return
+
+        added_roles_status = "".join(f"{user}: {', '.join(added)}\n" for user, (added, _) in roles_changes.items() if len(added) > 0)
+        removed_roles_status = "".join(f"{user}: {', '.join(removed)}\n" for user, (_, removed) in roles_changes.items() if len(removed) > 0)
+
+        if added_roles_status:
+            message_parts.append("Nowe role nadane użytkownikom:\n" + added_roles_status)
+
+        if removed_roles_status:
+            message_parts.append("Role zabrane użytkownikom:\n" + removed_roles_status)
+
+        if not added_roles_status and not removed_roles_status:
+            message_parts.append("Brak zmian do wprowadzenia.")
+
+        final_message = "\n".join(message_parts)
+        final_message_escaped = escape_markdown(final_message)
+        await self._write_to_dedicated_channel(final_message_escaped, logging.DEBUG)
+
+
+    async def _nickname_changes_report(self, nickname_changes: List[str]):
+        renames = "Zmiany nicków:\n"
+
+        if len(nickname_changes) == 0:
+            renames += "brak"
+        elif len(nickname_changes) > GuildBot.ReportDetailsLimit:
+            details = "" if self.dry_run else " Szczegóły: polecenie 'history'."
+            renames += f"zmieniono {len(nickname_changes)} nicków.{details}"
+        else:
+            renames += "".join(f"{change}\n" for change in nickname_changes)
+
+        await self._write_to_dedicated_channel(renames, logging.DEBUG)
+
+
+    async def _refresh_autoroles(self, mismatched_only: bool = False) -> int:
+        """
+            Give users roles they have chosen in auto roles channels. Returns number of users who got roles
+        """
+        guild = self.client.get_guild(self.guild_id)
+        plan = await self._plan_autoroles(mismatched_only)
+
+        for change in plan.roles:
+            discord_name, _ = await utils.build_user_name(self.client, guild, change.member)
+            await self._write_to_dedicated_channel(f"Przywracanie brakujących ról użytkownikowi {discord_name}: {', '.join(change.add)}")
+
+        await self._apply_plan(plan)
+
+        return len(plan.roles)
+
+
+    async def _prepare_plan(self, guild: discord.Guild, args: List[str]):
+        """
+            Compute changes of given mass operation without applying them, report their cost and keep them for 'apply' command
+        """
+        operation = args[0]
+        operation_args = args[1:]
+        description = " ".join(args)
+
+        if operation == "refresh":
+            try:
+                members = self._select_members(guild, operation_args) if len(operation_args) > 0 else self._collect_own_users(guild)
+            except ValueError as error:
+                await self._write_to_dedicated_channel(str(error))
+                return
+
+            plan = self._plan_refresh(members, description)
+        elif operation == "refresh_autoroles":
+            plan = await self._plan_autoroles()
+            plan.description = description
+        elif operation == "set_role" and len(operation_args) >= 3:
+            member = guild.get_member(int(operation_args[0])) if operation_args[0].isdigit() else None
+            if member is None:
+                await self._write_to_dedicated_channel(f"Nie znaleziono użytkownika o ID: {operation_args[0]}")
+                return
+
+            role_name = " ".join(operation_args[2:])
+            roles = ([role_name], []) if operation_args[1] == "1" else ([], [role_name])
+            change = self._plan_member_roles(member, *roles)
+            plan = ChangesPlan(description, [change] if change.api_calls() > 0 else [])
+        else:
+            await self._write_to_dedicated_channel(f"Nieznana operacja do zaplanowania: {operation}")
+            return
+
+        api_calls = plan.api_calls()
+        duration = self.request_scheduler.estimate_duration(api_calls, Priority.Bulk)
+        summary = (f"Plan '{description}': {len(plan.roles)} zmian ról, {len(plan.nicknames)} zmian nicków.\n"
+                   f"Zapytania do API: {api_calls}, szacowany czas wykonania: {timedelta(seconds = round(duration))}.\n")
+
+        if plan.is_empty():
+            self.pending_plan = None
+            await self._write_to_dedicated_channel(summary + "Brak zmian do wprowadzenia.")
+        else:
+            self.pending_plan = plan
+            await self._send_file_to_dedicated_channel(summary + "Użyj polecenia 'apply' aby wprowadzić zmiany.", "plan.txt", plan.details())
+
+
+    async def _apply_pending_plan(self):
+        plan = self.pending_plan
+        self.pending_plan = None
+
+        if plan is None:
+            await self._write_to_dedicated_channel("Brak planu do wykonania. Przygotuj go poleceniem 'plan'.")
+            return
+
+        if datetime.now() - plan.created > GuildBot.PlanExpiration:
+            await self._write_to_dedicated_channel(f"Plan '{plan.description}' jest nieaktualny (starszy niż {GuildBot.PlanExpiration}). Przygotuj go ponownie.")
+            return
+
+        roles_changes, nickname_changes = await self._apply_plan(plan)
+
+        if len(plan.roles) > 0:
+            await self._roles_changes_report(roles_changes)
+
+        if len(plan.nicknames) > 0:
+            await self._nickname_changes_report(nickname_changes)
+
+        await self._write_to_dedicated_channel(f"Plan '{plan.description}' wykonany.")
+
+
+    async def _ping_important_threads(self):
+        touched = await self.threads_keeper.touch_all(self.config.threads_to_keep_alive)
+        self.logger.debug(f"Pinged {touched} of {len(self.config.threads_to_keep_alive)} channels")
 
         await self._write_to_dedicated_channel("Zakończono odświeżanie kanałów")
 
@@ -881,22 +1547,23 @@ class RolesBot(discord.Client):
         renames = "Resetowanie nicków:\n"
 
         for member in members:
-            self.logger.info(f"Renaming {member.display_name} ({member.name}) to {member.name}")
+            self.logger.info("Renaming %s (%s) to %s", member.display_name, member.name, member.name)
             try:
-                await member.edit(nick = member.name)
+                await self.request_scheduler.call(member.edit, nick = member.name)
             except discord.errors.Forbidden:
                 renames += f"{member.display_name} ({member.name}) -> {member.name} (**Nieskuteczne, brak uprawnień**)\n"
             except discord.errors.NotFound:
                 renames += f"{member.display_name} ({member.name}) -> {member.name} (**Nieskuteczne, użytkownik opuścił serwer**)\n"
             else:
                 renames += f"{member.display_name} ({member.name}) -> {member.name}\n"
+                self._journal_changes(member, ChangeJournal.Nickname, [member.name])
 
         await self._write_to_dedicated_channel(renames, logging.DEBUG)
 
 
     async def _build_user_details(self, guild: discord.Guild, id: int) -> str:
-        status = await utils.get_user_status(self, guild, id)
-        name, _ = await utils.build_user_name(self, guild, id)
+        status = await utils.get_user_status(self.client, guild, id)
+        name, _ = await utils.build_user_name(self.client, guild, id)
 
         result: str = ""
 
@@ -912,41 +1579,87 @@ class RolesBot(discord.Client):
         return result
 
 
-    def _dump_users_to_csv(self, guild: discord.Guild) -> Tuple[str, int]:
-        date = datetime.now().date().isoformat()
-        path = os.path.join(self.storage_dir, f"users-{date}.csv")
-        members = sorted(guild.members, key=self._user_csv_sort_key)
+    async def _dump_db(self, guild: discord.Guild):
+        users_membership = self.config.roles_source.list_known_users()
+        users_names =  self.config.nicknames_source.get_all_nicknames()
+        status = "List znanych userów z bazy danych:\n"
+
+        for user, data in users_membership.items():
+            if user.isnumeric():
+                # assume id
+                member_id = int(user)
+                member_details = await self._build_user_details(guild, member_id)
+                status += member_details
+            else:
+                # assume direct user name
+                status += f"{user}"
+
+            nickname = users_names.get(user, None)
+            display_nickname = "EMPTY" if nickname is None else "\\*" * len(nickname)
+            status += f": {data} -> {display_nickname}\n"
+
+        await self._write_to_dedicated_channel(status)
+
+
+    async def _dump_users_command(self, guild: discord.Guild, export_format: users_export.ExportFormat, compress: bool, diff: bool):
+        result = await self._dump_users(guild, export_format, compress, diff)
+        status = f"Zapisano listę {result.users_count} użytkowników do pliku `{os.path.basename(result.path)}`."
+
+        if diff:
+            if result.diff_path is None:
+                status += "\nBrak eksportu z poprzedniego dnia, różnice nie zostały zapisane."
+            else:
+                status += f"\nZmiany względem poprzedniego dnia ({result.changed_count}) zapisano do pliku `{os.path.basename(result.diff_path)}`."
+
+        await self._write_to_dedicated_channel(status)
+
+
+    async def _dump_users(self, guild: discord.Guild, export_format: users_export.ExportFormat, compress: bool, diff: bool) -> users_export.ExportResult:
+        """
+            Export guild members to a file in bot's storage.
+
+            Sorting and writing is done in a worker thread so gateway handling is not blocked.
+            Members (ids, names and role ids), roles and accepted users are snapshotted here as plain data,
+            as the event loop keeps modifying them.
+        """
+        members = [(member.id, member.name, member.display_name, [role.id for role in member.roles]) for member in guild.members]
+        accepted_regulations = frozenset(self.members_state.accepted_ids())
+        roles_order = self._build_roles_csv_order(guild.roles)
+        role_names = {role.id: role.name for role in guild.roles if not self._is_default_role(role)}
+        rows = self._users_export_rows(members, accepted_regulations, roles_order, role_names)
+        date = datetime.now().date()
 
-        with open(path, "w", encoding="utf-8", newline="") as users_file:
-            writer = csv.writer(users_file)
-            writer.writerow(["Lp.", "Discord ID", "Discord login", "Nazwa na serwerze", "Role"])
+        return await asyncio.to_thread(users_export.export_users, self.storage_dir, date, rows, export_format, compress, diff)
 
-            for index, member in enumerate(members, start=1):
-                writer.writerow([
-                    index,
-                    member.id,
-                    member.name,
-                    member.display_name,
-                    self._format_roles_for_csv(member.roles),
-                ])
 
-        return path, len(members)
+    def _users_export_rows(self, members: List[Tuple[int, str, str, List[int]]], accepted_regulations: Set[int], roles_order: Dict[int, int], role_names: Dict[int, str]) -> Iterator[users_export.UserRow]:
+        sort_key = lambda member: self._user_csv_sort_key(member, accepted_regulations)
 
+        for index, (member_id, name, display_name, role_ids) in enumerate(sorted(members, key=sort_key), start=1):
+            yield (index, member_id, name, display_name, self._format_roles_for_csv(role_ids, roles_order, role_names))
 
-    def _user_csv_sort_key(self, member: discord.Member) -> Tuple[bool, str, str, int]:
-        accepted_regulations = member.id in self.member_ids_accepted_regulations
-        display_name = member.display_name.casefold()
-        discord_login = member.name.casefold()
 
-        return (not accepted_regulations, display_name, discord_login, member.id)
+    def _user_csv_sort_key(self, member: Tuple[int, str, str, List[int]], accepted_regulations: Set[int]) -> Tuple[bool, str, str, int]:
+        member_id, name, display_name, _ = member
+        accepted = member_id in accepted_regulations
 
+        return (not accepted, display_name.casefold(), name.casefold(), member_id)
 
-    def _format_roles_for_csv(self, roles: List[discord.Role]) -> str:
-        roles_without_everyone = [role for role in roles if not self._is_default_role(role)]
-        sorted_roles = sorted(roles_without_everyone, key=self._role_csv_sort_key)
-        role_names = [role.name for role in sorted_roles]
 
-        return ";".join(role_names)
+    def _build_roles_csv_order(self, roles: List[discord.Role]) -> Dict[int, int]:
+        """
+            Rank guild roles once, so members' roles can be ordered by a simple lookup
+        """
+        sorted_roles = sorted(roles, key=self._role_csv_sort_key)
+        return {role.id: rank for rank, role in enumerate(sorted_roles)}
+
+
+    def _format_roles_for_csv(self, role_ids: List[int], roles_order: Dict[int, int], role_names: Dict[int, str]) -> List[str]:
+        # default role is not in role_names
+        roles_without_everyone = [role_id for role_id in role_ids if role_id in role_names]
+        sorted_roles = sorted(roles_without_everyone, key=lambda role_id: roles_order.get(role_id, len(roles_order)))
+
+        return [role_names[role_id] for role_id in sorted_roles]
 
 
     def _role_csv_sort_key(self, role: discord.Role):
@@ -972,19 +1685,23 @@ class RolesBot(discord.Client):
         """
             Print bot status
         """
-        guild = self.get_guild(self.guild_id)
-
         state = "Obecny stan:\n"
 
-        unknown_user_names = [guild.get_member(member_id).name for member_id in self.unknown_users]
-        state += f"Użytkownicy których id nie istnieje w bazie: {len(unknown_user_names)}\n"
-        state += f"Użytkownicy którzy zaakceptowali wszystkie części regulaminu: {len(self.member_ids_accepted_regulations)}\n"
+        if not self.members_ready.is_set():
+            guild = self.client.get_guild(self.guild_id)
+            state += f"Trwa ładowanie listy użytkowników: {len(guild.members)}/{guild.member_count}\n"
 
-        autorefresh = self.storage.get_config()[RolesBot.AutoRefreshEntry]
+        state += f"Użytkownicy których id nie istnieje w bazie: {self.members_state.unknown_count()}\n"
+        state += f"Użytkownicy którzy zaakceptowali wszystkie części regulaminu: {self.members_state.accepted_count()}\n"
+
+        autorefresh = self.storage.get_config()[GuildBot.AutoRefreshEntry]
         time_left =  timedelta(minutes = autorefresh) - (datetime.now() - self.last_auto_refresh)
         state += f"Czas do automatycznego odświeżenia ról: {time_left}\n"
         state += f"Częstotliwość odświeżenia: {autorefresh} minut\n"
 
+        if self.storage.get_config()[GuildBot.AdaptiveRefreshEntry]:
+            state += f"Częstotliwość dobierana automatycznie ({self.refresh_tuner.min_interval}-{self.refresh_tuner.max_interval} minut): {self.refresh_tuner.reason}\n"
+
         autoroles_urls = [utils.generate_link(self.guild_id, id) for id in self.config.auto_roles_channels]
         autoroles_string = " ".join(autoroles_urls)
         state += f"Obserwowane kanały z autorolami: {autoroles_string}\n"
@@ -993,13 +1710,54 @@ class RolesBot(discord.Client):
             autorefresh_string = utils.generate_link(self.guild_id, self.config.user_auto_refresh_roles_message_id)
             state += f"Wiadomość automatycznego odświeżenia użytkowników: {autorefresh_string}\n"
 
+        if self.manageable_roles is not None:
+            guild = self.client.get_guild(self.guild_id)
+            unmanageable = [role.name for role in guild.roles if not role.is_default() and not role.managed and role.name not in self.manageable_roles]
+            state += f"Role, którymi bot nie może zarządzać: {', '.join(unmanageable) if len(unmanageable) > 0 else 'brak'}\n"
+
         regulations_urls = [utils.generate_link(self.guild_id, id) for id in self.config.server_regulations_message_ids]
         regulations_string = " ".join(regulations_urls)
         state += f"Wiadomości regulaminu do zaakceptowania: {regulations_string}\n"
 
+        for priority, stats in self.request_scheduler.stats.items():
+            state += f"Oczekiwanie na limit zapytań ({priority.name}): {stats.count} zapytań, średnio {stats.average():.2f}s, maksymalnie {stats.max:.2f}s\n"
+
+        if self.config.shard_count > 1:
+            state += f"Obsługiwane części użytkowników: {', '.join(str(shard) for shard in sorted(self.coordinator.owned_shards))} (z {self.config.shard_count})\n"
+
+            for shard_state in self.coordinator.states:
+                last_refresh = "nigdy" if shard_state.last_refresh is None else discord.utils.format_dt(datetime.fromtimestamp(shard_state.last_refresh), 'R')
+                state += f"Część {shard_state.shard}: instancja {shard_state.bot_id}, ostatnio aktywna {discord.utils.format_dt(datetime.fromtimestamp(shard_state.heartbeat), 'R')}, ostatnie odświeżenie: {last_refresh}\n"
+
+        if self.pending_plan is not None:
+            state += f"Przygotowany plan: '{self.pending_plan.description}' ({self.pending_plan.api_calls()} zapytań do API)\n"
+
+        if self.client.stall_detector is not None:
+            state += self._stalls_summary()
+
+        state += f"Fazy uruchomienia bota (gotowy po {self.client.startup.elapsed():.2f}s):\n" + self.client.startup.summary()
+
+        if self.threads_keeper.next_touch is not None:
+            state += f"Najbliższe odświeżenie wątków: {discord.utils.format_dt(self.threads_keeper.next_touch, 'R')}\n"
+
         await self._write_to_dedicated_channel(state)
 
 
+    def _stalls_summary(self) -> str:
+        detector = self.client.stall_detector
+
+        if detector.count == 0:
+            return f"Zablokowania pętli zdarzeń (powyżej {detector.threshold}s): brak\n"
+
+        summary = f"Zablokowania pętli zdarzeń (powyżej {detector.threshold}s): {detector.count}, łącznie {detector.total_duration:.2f}s, "
+        summary += f"najdłuższe {detector.longest.duration:.2f}s w {detector.longest.task}\n"
+
+        for stall in list(detector.stalls)[-GuildBot.StallsInStatus:]:
+            summary += f"    {stall.started.strftime('%Y-%m-%d %H:%M:%S')} {stall.duration:.2f}s w {stall.task}: {stall.location()}\n"
+
+        return summary
+
+
     async def _update_state(self):
         """
             Method collects and updates bot's information about server state.
@@ -1008,24 +1766,145 @@ class RolesBot(discord.Client):
             It can also be used by a manual refresh if things get out of sync for any reason.
         """
 
-        self.unknown_users = self._collect_unknown_users()
-        self.user_regulations_status = await self._collect_user_reactions_on_regulations()
-        self.member_ids_accepted_regulations  = self._collect_users_who_accepted_all_regulations(self.user_regulations_status)
+        guild = self.client.get_guild(self.guild_id)
+        known_user_role = discord.utils.get(guild.roles, name = self.config.roles_source.role_for_known_users())
 
-        if self._is_level_sufficent_for_send(logging.DEBUG):
-            await self._print_status()
+        # members indexing is pure computation, it runs in a thread while reactions are being fetched.
+        # discord.py's caches are modified by the event loop, so the thread gets a snapshot of them
+        entries = MemberIndex.snapshot(self._collect_all_users(guild))
+        known_user_role_id = None if known_user_role is None else known_user_role.id
+
+        (unknown_users, member_index), user_regulations_status = await asyncio.gather(asyncio.to_thread(self._index_members, entries, known_user_role_id),
+                                                                                      self._collect_user_reactions_on_regulations())
+
+        self.member_index = member_index
+        self.members_state = MemberStateTable.build(self.config.server_regulations_message_ids, unknown_users, user_regulations_status)
+
+
+    def _index_members(self, entries: List[MemberEntry], known_user_role_id: Optional[int]) -> Tuple[Set[int], MemberIndex]:
+        unknown_users = {member_id for member_id, role_ids, _ in entries if known_user_role_id not in role_ids}
+        return unknown_users, MemberIndex.from_snapshot(entries)
+
+
+    async def _reconcile_state(self, guild: discord.Guild, disconnected_at: Optional[datetime]):
+        """
+            Cheap alternative to _update_state after reconnection to Discord.
+
+            Number of acceptance reactions under regulations and auto roles messages and number of members are compared
+            with bot's state, and only messages and members which differ are fetched and processed again.
+            Changes cancelling each other out (one reaction added and another removed) are not noticed, refresh fixes them.
+        """
+        start = time.perf_counter()
+        report = []
+
+        if guild.member_count != len(guild.members):
+            self.logger.info("Guild has %s members, %s are known to the bot. Reloading members", guild.member_count, len(guild.members))
+            await guild.chunk()
+            report.append(f"Przeładowano listę użytkowników: {len(guild.members)}")
+
+        # roles changes made while disconnected came with members list, not as events
+        self.member_index = MemberIndex.build(self._collect_all_users(guild))
+        self._update_manageable_roles(guild)
+
+        # users who joined while bot was disconnected
+        joined = [] if disconnected_at is None else [member for member in guild.members if member.joined_at is not None and member.joined_at >= disconnected_at]
+        joined_ids = {member.id for member in joined}
+
+        for member in joined:
+            self.join_batcher.add(member)
+
+        if len(joined) > 0:
+            report.append(f"Nowi użytkownicy: {len(joined)}")
+
+        # users whose known role was given or taken meanwhile
+        current_unknown = self._collect_unknown_users() - joined_ids
+        previous_unknown = {member_id for member_id in self.members_state.unknown_ids() if guild.get_member(member_id) is not None} - joined_ids
+        known_changed = current_unknown ^ previous_unknown
+
+        for member_id in known_changed:
+            self.members_state.set_known(member_id, member_id not in current_unknown)
+
+        if len(known_changed) > 0:
+            report.append(f"Zmiany statusu użytkowników (znany/nieznany): {len(known_changed)}")
+
+        # reactions on regulations
+        acceptance_changed = set()
+        mismatched_regulations = 0
+
+        for regulation in self.config.server_regulations_message_ids:
+            message = await utils.get_message(guild, *regulation)
+            accepting = self.members_state.regulation_ids(regulation)
+
+            if self._reactions_count(message) == len(accepting):
+                continue
+
+            mismatched_regulations += 1
+            reacting = {user.id for user in await utils.collect_members_reacting_on_message(message, GuildBot.AcceptanceEmoji)}
+            self.logger.info("Regulations message %s/%s: %s reactions appeared, %s disappeared", *regulation, len(reacting - accepting), len(accepting - reacting))
+
+            for member_id in reacting ^ accepting:
+                if self.members_state.set_regulation(member_id, regulation, member_id in reacting):
+                    acceptance_changed.add(member_id)
+
+        if mismatched_regulations > 0:
+            report.append(f"Wiadomości regulaminu z niezgodną liczbą reakcji: {mismatched_regulations}, zmiany akceptacji regulaminu: {len(acceptance_changed)}")
+
+        # users who left, but still accept regulations
+        if guild.member_count == len(guild.members):
+            left_ids = set().union(*(self.members_state.regulation_ids(regulation) for regulation in self.config.server_regulations_message_ids))
+            left_ids = {member_id for member_id in left_ids if guild.get_member(member_id) is None and member_id not in self.config.system_users}
+
+            if len(left_ids) > 0:
+                report.append(f"Użytkownicy którzy opuścili serwer: {len(left_ids)}")
+
+                for member_id in left_ids:
+                    self.members_state.remove(member_id)
+
+                await self._revoke_users_acceptances([discord.Object(member_id) for member_id in left_ids])
+
+        affected = [member for member in utils.get_members(guild, list(acceptance_changed | known_changed)) if member is not None and self.coordinator.owns(member.id)]
+
+        if len(affected) > 0:
+            await self._refresh_roles(affected)
+
+            accepted = [member.id for member in affected if member.id in acceptance_changed and self.members_state.is_accepted(member.id)]
+            rejected = [member for member in affected if member.id in acceptance_changed and not self.members_state.is_accepted(member.id)]
+
+            if len(accepted) > 0:
+                await self._refresh_names(accepted)
+
+            if len(rejected) > 0:
+                await self._reset_names(rejected)
+
+        if len(self.config.auto_roles_channels) > 0:
+            restored = await self._refresh_autoroles(mismatched_only = True)
+
+            if restored > 0:
+                report.append(f"Przywrócono role z kanałów autoról użytkownikom: {restored}")
+
+        self.logger.info("State reconciled in %.1fs", time.perf_counter() - start)
 
+        if len(report) == 0:
+            await self._write_to_dedicated_channel("Stan serwera zgodny ze stanem bota, brak zmian.")
+        else:
+            await self._write_to_dedicated_channel("Synchronizacja stanu po ponownym połączeniu:\n" + "\n".join(report))
+
+
+    def _reactions_count(self, message: discord.Message) -> int:
+        reaction = discord.utils.find(lambda reaction: str(reaction.emoji) == GuildBot.AcceptanceEmoji, message.reactions)
+        return 0 if reaction is None else reaction.count
 
-    def _collect_unknown_users(self) -> set[int]:
+
+    def _collect_unknown_users(self, members: Optional[List[discord.Member]] = None) -> set[int]:
         """
-            Method collects unknown users (not recognized by the RolesSource) on the server.
+            Method collects unknown users (not recognized by the RolesSource) on the server, or among given members.
         """
 
         known_user_role_name = self.config.roles_source.role_for_known_users()
-        guild = self.get_guild(self.guild_id)
+        guild = self.client.get_guild(self.guild_id)
 
         known_user_role = discord.utils.get(guild.roles, name = known_user_role_name)
-        members = self._collect_all_users(guild)
+        members = self._collect_all_users(guild) if members is None else members
         members_without_role = {member.id for member in members if known_user_role not in member.roles}
 
         return members_without_role
@@ -1039,21 +1918,68 @@ class RolesBot(discord.Client):
         return members
 
 
+    def _select_members(self, guild: discord.Guild, selectors: List[str]) -> List[discord.Member]:
+        """
+            Resolve member ids and selectors (unknown, not-accepted, joined-since:date, role:name) to members
+            this instance is responsible for. Role name may contain spaces, so role selector has to be the last one.
+
+            Selectors are resolved with bot's in-memory state and MemberIndex. Raises ValueError with message for the user on invalid selector.
+        """
+        ids = set()
+
+        for position, selector in enumerate(selectors):
+            if selector.isdigit():
+                ids.add(int(selector))
+            elif selector == "unknown":
+                ids.update(self.members_state.unknown_ids())
+            elif selector == "not-accepted":
+                # members missing in state table have not accepted regulations either, so it takes a pass over members
+                accepted = self.members_state.accepted_ids()
+                ids.update(member.id for member in guild.members if member.id not in accepted)
+            elif selector.startswith("joined-since:"):
+                date = selector[len("joined-since:"):]
+                try:
+                    since = datetime.fromisoformat(date).astimezone()
+                except ValueError:
+                    raise ValueError(f"Niepoprawna data: {date} (oczekiwany format RRRR-MM-DD)")
+
+                ids.update(self.member_index.joined_since(since))
+            elif selector.startswith("role:"):
+                role_name = " ".join([selector[len("role:"):]] + selectors[position + 1:])
+                role = discord.utils.get(guild.roles, name = role_name)
+
+                if role is None:
+                    raise ValueError(f"Nieznana rola: {role_name}")
+
+                ids.update(self.member_index.role_members(role.id))
+                break
+            else:
+                raise ValueError(f"Nieznany selektor: {selector}. Dostępne: ID użytkownika, unknown, not-accepted, joined-since:RRRR-MM-DD, role:nazwa")
+
+        members = utils.get_members(guild, sorted(ids))
+        return [member for member in members if member is not None and member.id not in self.config.system_users and self.coordinator.owns(member.id)]
+
+
+    def _collect_own_users(self, guild: discord.Guild) -> List[discord.Member]:
+        """
+            Return users this instance is responsible for in mass operations (see ShardCoordinator)
+        """
+        return [member for member in self._collect_all_users(guild) if self.coordinator.owns(member.id)]
+
+
     async def _collect_user_reactions_on_regulations(self) -> Dict[int, Set]:
         """
             function lists which users reacted (accepted) which regulation messages
         """
-        guild = self.get_guild(self.guild_id)
+        guild = self.client.get_guild(self.guild_id)
 
         user_regulations_status = defaultdict(set)
 
-        for channel_id, message_id in self.config.server_regulations_message_ids:
-            regulations_channel = guild.get_channel(channel_id)
-            acceptance_message = await regulations_channel.fetch_message(message_id)
-
-            members = await utils.collect_members_reacting_on_message(acceptance_message, RolesBot.AcceptanceEmoji)
-            self.logger.debug(f"Regulations message {message_id} has positive reactions from {len(members)} members.")
+        # messages are independent, their reactions are collected concurrently
+        regulations = self.config.server_regulations_message_ids
+        reactions = await asyncio.gather(*(self._collect_regulation_reactions(guild, channel_id, message_id) for channel_id, message_id in regulations))
 
+        for (channel_id, message_id), members in zip(regulations, reactions):
             for member in members:
                 user_regulations_status[member.id].add((channel_id, message_id))
 
@@ -1074,12 +2000,290 @@ class RolesBot(discord.Client):
         return user_regulations_status
 
 
-    def _collect_users_who_accepted_all_regulations(self, user_regulations_status: Dict[int, Set]) -> Set[int]:
+    async def _collect_regulation_reactions(self, guild: discord.Guild, channel_id: int, message_id: int) -> List[Union[discord.Member, discord.User]]:
+        regulations_channel = guild.get_channel(channel_id)
+        acceptance_message = await regulations_channel.fetch_message(message_id)
+
+        members = await utils.collect_members_reacting_on_message(acceptance_message, GuildBot.AcceptanceEmoji)
+        self.logger.debug(f"Regulations message {message_id} has positive reactions from {len(members)} members.")
+
+        return members
+
+
+class RolesBot(discord.Client):
+    """
+        Discord client serving one or more guilds over a single gateway connection.
+
+        Each configured guild gets its own GuildBot, events are routed to the one of the guild they come from.
+        Requests of all guilds go through one RequestScheduler, which serves waiting requests of the same priority
+        in order of arrival, so mass operations of several guilds interleave instead of one guild starving others.
+
+        Process-wide settings (intents, members chunking, request budget, metrics, stall detector, gateway recording)
+        are taken from the first config. With a single guild its storage is `storage_dir` itself.
+    """
+    AcceptanceEmoji = GuildBot.AcceptanceEmoji
+
+    def __init__(self, config: Union[BotConfig, List[BotConfig]], storage_dir: str, logger):
+        configs = config if isinstance(config, list) else [config]
+        main_config = configs[0]
+
+        if len({guild_config.guild_id for guild_config in configs}) != len(configs):
+            raise ValueError("Each guild can be configured only once")
+
+        intents = discord.Intents.default()
+        intents.message_content = True
+        intents.members = True
+        client_options = {}
+
+        if main_config.low_memory:
+            intents, client_options = RolesBot._low_memory_profile(configs)
+
+        self.metrics = MetricsRegistry()
+        self.metrics_server = None
+        # requests and 429 responses are counted even without metrics server, adaptive auto refresh relies on them
+        http_trace = self.metrics.http_trace()
+
+        if main_config.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, main_config.metrics_port, logging.getLogger("Metrics"))
+            configs = [dataclasses.replace(guild_config,
+                                           roles_source = InstrumentedSource(guild_config.roles_source, "roles", self.metrics.source_latency),
+                                           nicknames_source = InstrumentedSource(guild_config.nicknames_source, "nicknames", self.metrics.source_latency))
+                       for guild_config in configs]
+
+        # with lazy chunking members are loaded in background after on_ready, so bot can react to events much earlier
+        super().__init__(intents = intents, http_trace = http_trace, chunk_guilds_at_startup = not main_config.lazy_members_chunking, **client_options)
+
+        self.logger = logger
+        self.main_config = main_config
+        self.bot_initialized = False
+        self.commit_hash = None
+        self.commit_hash_lookup = None
+        self.startup = StartupTimings(logging.getLogger("Startup"), self.metrics.startup_phase)
+        self.connect_phase = None
+        self.disconnected_at: Optional[datetime] = None                                    # start of current connection outage
+        self.stall_detector = None if main_config.loop_stall_threshold is None else StallDetector(main_config.loop_stall_threshold, logging.getLogger("StallDetector"))
+        self.recorder = None
+
+        if main_config.gateway_recording is not None:
+            self.recorder = GatewayRecorder(main_config.gateway_recording, {guild_config.guild_id for guild_config in configs}, logging.getLogger("GatewayRecorder"))
+            self.recorder.attach(self._connection)
+
+        self.request_scheduler = RequestScheduler(main_config.request_budget, main_config.request_budget, GuildBot.InteractiveRequestsReserve,
+                                                  logging.getLogger("RequestScheduler"), self._on_request_wait)
+
+        self.guild_bots: Dict[int, GuildBot] = {}
+        for guild_config in configs:
+            if len(configs) == 1:
+                self.guild_bots[guild_config.guild_id] = GuildBot(self, guild_config, storage_dir, logger)
+            else:
+                guild_storage_dir = os.path.join(storage_dir, str(guild_config.guild_id))
+                os.makedirs(guild_storage_dir, exist_ok = True)
+                self.guild_bots[guild_config.guild_id] = GuildBot(self, guild_config, guild_storage_dir, logger.getChild(str(guild_config.guild_id)))
+
+        self.metrics.gauge("gatekeeper_join_queue_depth", "Joined members waiting for processing", lambda: sum(guild_bot.join_batcher.pending() for guild_bot in self.guild_bots.values()))
+        self.metrics.gauge("gatekeeper_leave_queue_depth", "Left members waiting for processing", lambda: sum(guild_bot.leave_batcher.pending() for guild_bot in self.guild_bots.values()))
+        self.metrics.gauge("gatekeeper_interactive_requests_queue_depth", "Interactive requests waiting for request budget", lambda: self.request_scheduler.queue_depth(Priority.Interactive))
+        self.metrics.gauge("gatekeeper_bulk_requests_queue_depth", "Bulk requests waiting for request budget", lambda: self.request_scheduler.queue_depth(Priority.Bulk))
+
+
+    @staticmethod
+    def _low_memory_profile(configs: List[BotConfig]) -> Tuple[discord.Intents, Dict[str, Any]]:
         """
-            Collect users who accepted regulations
+            Intents and client options limiting discord.py caches to what the bot uses.
+
+            Savings come from the disabled messages cache and from intents: events which are not subscribed to
+            (presences, voice states, typing, ...) are neither sent nor cached. Members cache is not limited, as the bot
+            works on complete members list, and the one derived from these intents (joined members, no voice) is minimal already.
         """
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.members = True
+        intents.guild_messages = True
+        intents.guild_reactions = True
+
+        # commands mention the bot, so they come with content anyway. Auto roles are matched by messages content though
+        intents.message_content = any(len(config.auto_roles_channels) > 0 for config in configs)
+
+        options = {
+            "max_messages": None,                                                           # bot uses raw reaction events and fetches messages it needs
+        }
+
+        return intents, options
+
+
+    def run(self, token: str, *, log_level: int = logging.INFO, **kwargs):
+        """
+            Run the bot with logging pipeline configured by the first config (log_file, json_logs, log_sampling),
+            formatting and writing logs in a background thread.
+        """
+        sampling = None if self.main_config.log_sampling is None else SamplingFilter(rate = self.main_config.log_sampling)
+        listener = setup_logging(log_level, self.main_config.log_file, self.main_config.json_logs, sampling)
+
+        try:
+            # discord.py's own handler would bypass the pipeline
+            super().run(token, log_handler = None, **kwargs)
+        finally:
+            listener.stop()
+
+
+    async def setup_hook(self):
+        if self.stall_detector is not None:
+            self.stall_detector.start()
+
+        # called on login, startup is measured from here. Gateway connection (and members chunking, unless lazy) ends with on_ready
+        self.startup = StartupTimings(logging.getLogger("Startup"), self.metrics.startup_phase)
+        self.connect_phase = self.startup.begin("connect")
+        self._start_commit_hash_lookup()
+
+
+    def _start_commit_hash_lookup(self):
+        # spawning git blocks, it runs in a thread while bot connects
+        if self.commit_hash_lookup is None:
+            self.commit_hash_lookup = asyncio.create_task(self.startup.measure("commit hash", asyncio.to_thread(get_current_commit_hash)))
+
+
+    async def close(self):
+        if self.stall_detector is not None:
+            self.stall_detector.stop()
+
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+
+        await super().close()
+
+        for guild_bot in self.guild_bots.values():
+            guild_bot.journal.close()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+    def _on_request_wait(self, priority: Priority, wait: float):
+        self.metrics.request_wait.observe(wait, priority = priority.name)
+
+
+    async def _run_event(self, coro, event_name: str, *args, **kwargs):
+        with self.metrics.event_latency.time(event = event_name):
+            await super()._run_event(coro, event_name, *args, **kwargs)
+
+
+    async def on_ready(self):
+        if not self.bot_initialized:
+            if self.connect_phase is not None:
+                self.startup.finish(self.connect_phase)
+
+            self._start_commit_hash_lookup()
+            self.commit_hash = await self.commit_hash_lookup
+            self.logger.info(f"Bot is ready as {self.user}. git commit: {self.commit_hash}. Guilds: {len(self.guild_bots)}")
+
+            for guild in self.guilds:
+                if guild.id not in self.guild_bots:
+                    self.logger.error(f"Leaving unauthorized guild: {guild.name} ({guild.id})")
+                    await guild.leave()
+
+            missing_guilds = self.guild_bots.keys() - {guild.id for guild in self.guilds}
+            for guild_id in missing_guilds:
+                self.logger.error(f"Bot is not a member of configured guild {guild_id}")
+
+            if len(missing_guilds) == len(self.guild_bots):
+                await self.close()
+                return
+
+            if self.metrics_server is not None:
+                await self.metrics_server.start()
+
+        # guilds start concurrently, members loading and state collection of a big guild does not delay the others
+        available_guilds = [guild for guild in self.guilds if guild.id in self.guild_bots]
+        await asyncio.gather(*(self.guild_bots[guild.id].on_ready(guild, self.commit_hash) for guild in available_guilds))
+
+        if not self.bot_initialized:
+            self.logger.info("Bot ready %.2fs after login", time.perf_counter() - self.startup.started)
+
+        self.bot_initialized = True
+        self.disconnected_at = None
+
+
+    async def on_disconnect(self):
+        if self.disconnected_at is None:
+            self.disconnected_at = discord.utils.utcnow()
+
+
+    async def on_resumed(self):
+        available_guilds = [guild for guild in self.guilds if guild.id in self.guild_bots]
+        await asyncio.gather(*(self.guild_bots[guild.id].on_resumed(guild) for guild in available_guilds))
+
+        self.disconnected_at = None
+
+
+    async def on_guild_join(self, guild: discord.Guild):
+        if guild.id not in self.guild_bots:
+            self.logger.error(f"Leaving unauthorized guild: {guild.name} ({guild.id})")
+            await guild.leave()
+
+
+    async def on_message(self, message: discord.Message):
+        if message.guild is None:
+            self.logger.info(f"Ignoring private message from user {repr(message.author.name)}: {repr(message.content)}")
+            return
+
+        guild_bot = self.guild_bots.get(message.guild.id)
+
+        if guild_bot is None:
+            self.logger.error(f"Got message from guild '{message.guild}', which is not configured. This should never happen.")
+            return
+
+        await guild_bot.on_message(message)
+
+
+    async def on_member_join(self, member: discord.Member):
+        guild_bot = self.guild_bots.get(member.guild.id)
+
+        if guild_bot is not None:
+            await guild_bot.on_member_join(member)
+
+
+    async def on_member_remove(self, member: discord.Member):
+        guild_bot = self.guild_bots.get(member.guild.id)
+
+        if guild_bot is not None:
+            await guild_bot.on_member_remove(member)
+
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        guild_bot = self.guild_bots.get(after.guild.id)
+
+        if guild_bot is not None:
+            await guild_bot.on_member_update(before, after)
+
+
+    async def on_guild_role_create(self, role: discord.Role):
+        await self._route_roles_change(role.guild)
+
+
+    async def on_guild_role_delete(self, role: discord.Role):
+        await self._route_roles_change(role.guild)
+
+
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        await self._route_roles_change(after.guild)
+
+
+    async def _route_roles_change(self, guild: discord.Guild):
+        guild_bot = self.guild_bots.get(guild.id)
+
+        if guild_bot is not None:
+            await guild_bot.on_roles_changed(guild)
+
+
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        guild_bot = self.guild_bots.get(payload.guild_id)
+
+        if guild_bot is not None:
+            await guild_bot.on_raw_reaction_add(payload)
+
 
-        required_acceptations = { channel_and_message for channel_and_message in self.config.server_regulations_message_ids }
-        fully_accepted_users = { member_id for member_id, accepted_messages in user_regulations_status.items() if accepted_messages == required_acceptations }
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        guild_bot = self.guild_bots.get(payload.guild_id)
 
-        return fully_accepted_users
+        if guild_bot is not None:
+            await guild_bot.on_raw_reaction_remove(payload)
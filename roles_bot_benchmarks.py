@@ -0,0 +1,215 @@
+"""
+    Micro benchmarks of RolesBot's in-memory hot paths on a synthetic, large guild.
+
+    Usage (from repository's parent directory):
+        python -m GatekeeperBot.roles_bot_benchmarks --members 100000 --output bench.json [--baseline previous.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple
+
+from . import users_export
+from .bot_config import BotConfig
+from .data_sources import RolesSource, UserStatusFlags
+from .member_state import MemberStateTable
+from .roles_bot import RolesBot
+from .roles_bot_tests import DiscordMock
+
+
+class BenchmarkMember:
+    """
+        Lightweight replacement of discord.Member (MagicMock is too slow and heavy for 100k+ members)
+    """
+
+    def __init__(self, guild, member_id: int, name: str, roles: List):
+        self.guild = guild
+        self.id = member_id
+        self.name = name
+        self.display_name = name.upper()
+        self.mention = f"<@{member_id}>"
+        self.roles = roles
+
+    async def add_roles(self, *roles):
+        pass
+
+    async def remove_roles(self, *roles):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class LargeGuildMock(DiscordMock):
+    def setup_large_guild(self, members_count: int, roles_count: int, roles_per_member: int, known_ratio: float):
+        role_names = ["Known"] + [f"Role{index}" for index in range(roles_count - 1)]
+        self.setup_guild_roles(role_names)
+
+        members = {}
+        roles = self.guild.roles
+        for index in range(members_count):
+            member_roles = random.sample(roles[1:], roles_per_member)
+            if random.random() < known_ratio:
+                member_roles.append(self.roles["Known"])
+
+            member = BenchmarkMember(self.guild, self.get_next_id(), f"user{index}", member_roles)
+            members[member.id] = member
+
+        self.guild.members = list(members.values())
+        self.guild.get_member = members.get
+        self.guild.member_count = members_count
+
+
+class RolesSourceBenchmark(RolesSource):
+    """
+        Roles source which asks for one role to be added to every tenth member
+    """
+
+    def get_user_roles(self, member, flags: Dict[UserStatusFlags, bool]) -> Tuple[List[str], List[str]]:
+        return (["Role0"], []) if member.id % 10 == 0 else ([], [])
+
+    def get_users_roles(self, members) -> Dict[int, Tuple[List[str], List[str]]]:
+        return {member.id: self.get_user_roles(member, flags) for member, flags in members.items()}
+
+    def role_for_known_users(self) -> str:
+        return "Known"
+
+
+def measure(function: Callable[[], Any], repeats: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return {"min": min(timings), "median": statistics.median(timings), "runs": repeats}
+
+
+async def measure_async(coroutine_function: Callable[[], Any], repeats: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        await coroutine_function()
+        timings.append(time.perf_counter() - start)
+
+    return {"min": min(timings), "median": statistics.median(timings), "runs": repeats}
+
+
+async def run_benchmarks(members_count: int, roles_count: int, repeats: int, storage_dir: str) -> Dict[str, Dict[str, float]]:
+    discordMock = LargeGuildMock()
+    discordMock.setup_large_guild(members_count, roles_count, roles_per_member = 5, known_ratio = 0.9)
+    guild = discordMock.guild
+
+    regulations = [(discordMock.get_next_id(), discordMock.get_next_id()) for _ in range(3)]
+    report_channel_id = discordMock.add_channel("report_channel")
+    # request budget is not what is measured here, so make it unlimited
+    config = BotConfig(dedicated_channel = report_channel_id, roles_source = RolesSourceBenchmark(), guild_id = guild.id,
+                       server_regulations_message_ids = regulations, request_budget = 10 ** 9)
+
+    client = RolesBot(config, storage_dir, logger = logging.getLogger("Benchmark"))
+    client.get_guild = discordMock.mock_get_guild
+    bot = client.guild_bots[guild.id]
+    bot.channel = discordMock.channels[report_channel_id]
+
+    # most of members accepted all regulations, some only a part of them
+    user_regulations_status = {member.id: set(regulations if member.id % 7 else regulations[:1]) for member in guild.members}
+    unknown_users = bot._collect_unknown_users()
+    bot.members_state = MemberStateTable.build(regulations, unknown_users, user_regulations_status)
+
+    apply_subset = guild.members[:1000]
+    report = "".join(f"{member.name}: {', '.join(role.name for role in member.roles)}\n" for member in guild.members)
+
+    async def apply_member_roles():
+        for member in apply_subset:
+            await bot._apply_member_roles(member, ["Role1", "Role2"], ["Role3"])
+
+    results = {}
+    results["collect_unknown_users"] = measure(bot._collect_unknown_users, repeats)
+    results["build_members_state"] = measure(lambda: MemberStateTable.build(regulations, unknown_users, user_regulations_status), repeats)
+    results["members_state_lookups"] = measure(lambda: [bot._build_user_flags(member.id) for member in guild.members], repeats)
+    results["apply_member_roles_x1000"] = await measure_async(apply_member_roles, repeats)
+    results["split_message"] = measure(lambda: bot._split_message(report), repeats)
+    results["dump_users_csv"] = await measure_async(lambda: bot._dump_users(guild, users_export.ExportFormat.CSV, False, False), repeats)
+    results["dump_users_jsonl_gz"] = await measure_async(lambda: bot._dump_users(guild, users_export.ExportFormat.JSONL, True, False), repeats)
+    results["refresh_roles"] = await measure_async(lambda: bot._refresh_roles(guild.members), repeats)
+
+    bot.storage.timer.cancel()
+
+    return results
+
+
+def compare_with_baseline(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> bool:
+    """
+        Print comparison with baseline. Returns False if any benchmark got slower than tolerance allows
+    """
+    ok = True
+
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:50} {result['min']:10.4f}s (no baseline)")
+            continue
+
+        ratio = result["min"] / baseline[name]["min"]
+        regression = ratio > tolerance
+        ok = ok and not regression
+        print(f"{name:50} {result['min']:10.4f}s  baseline: {baseline[name]['min']:10.4f}s  x{ratio:.2f}{'  REGRESSION' if regression else ''}")
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "RolesBot hot paths benchmarks on a synthetic guild")
+    parser.add_argument("--members", type = int, default = 10000)
+    parser.add_argument("--roles", type = int, default = 300)
+    parser.add_argument("--repeats", type = int, default = 3)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "file to save results to (JSON)")
+    parser.add_argument("--baseline", help = "results file (JSON) to compare with")
+    parser.add_argument("--tolerance", type = float, default = 1.2, help = "max allowed slowdown against baseline")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        results = asyncio.run(run_benchmarks(args.members, args.roles, args.repeats, storage_dir))
+
+    output = {
+        "meta": {
+            "members": args.members,
+            "roles": args.roles,
+            "repeats": args.repeats,
+            "python": platform.python_version(),
+            "date": datetime.now().isoformat(),
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as output_file:
+            json.dump(output, output_file, indent = 4)
+
+    ok = True
+    if args.baseline:
+        with open(args.baseline, "r", encoding = "utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+
+        ok = compare_with_baseline(results, baseline["results"], args.tolerance)
+    else:
+        for name, result in results.items():
+            print(f"{name:50} {result['min']:10.4f}s")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
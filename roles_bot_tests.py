@@ -1,43 +1,82 @@
 
+import asyncio
+import csv
 import discord
+import glob
+import gzip
+import json
 import logging
+import os
+import tempfile
+import time
 import unittest
+from datetime import date, datetime
 from functools import partial
-from unittest.mock import AsyncMock, MagicMock, patch
-from typing import List, Tuple
+from unittest.mock import AsyncMock, MagicMock, PropertyMock, patch
+from typing import Dict, List, Tuple
 
-from roles_bot import RolesBot, RolesSource
+from .adaptive_refresh import RefreshIntervalTuner, RefreshResult
+from .batching import MicroBatcher
+from .bot_config import BotConfig
+from .coordination import ShardCoordinator, shard_of
+from .data_sources import RolesSource
+from .jobs import JobManager, current_job, report_progress
+from .journal import ChangeJournal
+from .logging_pipeline import JsonFormatter, SamplingFilter
+from .member_state import MemberFlags, MemberStateTable
+from .metrics import Histogram, MetricsRegistry, _route_template
+from .request_scheduler import Priority, RequestScheduler, WaitStats
+from .stall_detector import StallDetector
+from .roles_bot import GuildBot, RolesBot
+from .threads_keeper import ThreadsKeeper
+from . import users_export
+from . import utils
 
 class DiscordMock:
     def __init__(self):
+        self.global_id_counter = 1
         self.guild = MagicMock(spec=discord.Guild)
+        self.guild.id = self.get_next_id()
         self.channels = {}
+        self.messages = {}
         self.roles = {}
-        self.global_id_counter = 1
 
     def get_next_id(self):
         next_id = self.global_id_counter
         self.global_id_counter += 1
         return next_id
 
-    def create_role(self, name: str):
+    def create_role(self, name: str, position: int = 0):
         role_id = self.get_next_id()
-        role = discord.Role(guild=self.guild, state=None, data={"id": role_id, "name": name})
+        role = discord.Role(guild=self.guild, state=None, data={"id": role_id, "name": name, "position": position})
         self.roles[name] = role
         return role
 
-    def setup_guild_roles(self, role_names):
-        self.guild.roles = [self.create_role(name) for name in role_names]
+    def setup_guild_roles(self, role_names, roles_above_bot = []):
+        # bot's own role is placed above given roles
+        self.guild.roles = [self.create_role(name) for name in role_names] + [self.create_role(name, position=200) for name in roles_above_bot]
+        self.guild.me = MagicMock(spec=discord.Member)
+        self.guild.me.id = self.get_next_id()
+        self.guild.me.top_role = self.create_role("Bot", position=100)
+        self.guild.me.guild_permissions = discord.Permissions(manage_roles=True)
+        self.guild.members = []
+        self.guild.get_member = lambda member_id: next((member for member in self.guild.members if member.id == member_id), None)
+
+    def mock_get_guild(self, guild_id: int) -> discord.Guild:
+        return self.guild if guild_id == self.guild.id else None
 
     def setup_member(self, name: str, initial_roles):
         member_id = self.get_next_id()
         member = MagicMock(spec=discord.Member)
         member.guild = self.guild
         member.name = name
+        member.display_name = name
         member.id = member_id
+        member.joined_at = discord.utils.utcnow()
         member.roles = [self.roles[role_name] for role_name in initial_roles]
         member.remove_roles = AsyncMock()
         member.add_roles = AsyncMock()
+        self.guild.members.append(member)
         return member
 
     def add_channel(self, name: str):
@@ -51,6 +90,44 @@ class DiscordMock:
     async def mock_fetch_channel(self, bot_self, channel_id: int) -> discord.abc.GuildChannel:
         return self.channels.get(channel_id, None)
 
+    def add_regulations(self, reactors) -> Tuple[Tuple[int, int], MagicMock]:
+        """
+            Regulations message accepted by given members. Returns its full id and acceptance reaction, whose
+            `reactors` list is what Discord has under the message.
+        """
+        return self.add_reacted_message(self.add_channel("regulations"), reactors)
+
+    def add_reacted_message(self, channel_id: int, reactors, content: str = "") -> Tuple[Tuple[int, int], MagicMock]:
+        channel = self.channels[channel_id]
+        messages = self.messages.setdefault(channel_id, [])
+
+        message = MagicMock(spec=discord.Message)
+        message.id = self.get_next_id()
+        message.guild = self.guild
+        message.content = content
+
+        reaction = MagicMock(spec=discord.Reaction)
+        reaction.emoji = GuildBot.AcceptanceEmoji
+        reaction.message = message
+        reaction.reactors = list(reactors)
+        type(reaction).count = PropertyMock(side_effect=lambda: len(reaction.reactors))
+
+        async def users(limit = None):
+            for user in list(reaction.reactors):
+                yield user
+
+        async def history(limit = 100):
+            for message in list(messages):
+                yield message
+
+        reaction.users = users
+        message.reactions = [reaction]
+        messages.append(message)
+        channel.fetch_message.side_effect = lambda message_id: next(message for message in messages if message.id == message_id)
+        channel.history = history
+
+        return (channel_id, message.id), reaction
+
 
 class RolesSourceFake(RolesSource):
     def __init__(self):
@@ -59,10 +136,13 @@ class RolesSourceFake(RolesSource):
     def set_user_roles(self, user: str, roles_to_add, roles_to_remove):
         self.roles_db[user] = (roles_to_add, roles_to_remove)
 
-    def get_user_roles(self, member: discord.Member) -> Tuple[List[str], List[str]]:
+    def get_user_roles(self, member: discord.Member, flags = None) -> Tuple[List[str], List[str]]:
         data = self.roles_db.get(member.name, ([], []))
         return data
 
+    def get_users_roles(self, members) -> Dict[int, Tuple[List[str], List[str]]]:
+        return {member.id: self.get_user_roles(member) for member in members}
+
     def fetch_user_roles(self, member: discord.Member) -> Tuple[List[str], List[str]]:
         return self.get_user_roles(member)
 
@@ -72,43 +152,1133 @@ class RolesSourceFake(RolesSource):
     def get_user_auto_roles_unreaction(self, member: discord.Member, message: discord.Message) -> Tuple[List[str], List[str]]:
         pass
 
+    def role_for_known_users(self) -> str:
+        return "Known"
+
 
 class TestRolesBot(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.discordMock = DiscordMock()
+        self.discordMock.guild.get_channel = lambda channel_id: self.discordMock.channels.get(channel_id)
+        self.roles_source = RolesSourceFake()
+        self.report_channel_id = self.discordMock.add_channel("report_channel")
+
+        guilds_patch = patch.object(RolesBot, "guilds", new=[self.discordMock.guild])
+        guilds_patch.start()
+        self.addCleanup(guilds_patch.stop)
+
+    def create_bot(self, **config_options) -> Tuple[RolesBot, GuildBot]:
+        config = BotConfig(dedicated_channel=self.report_channel_id, roles_source=self.roles_source, guild_id=self.discordMock.guild.id, **config_options)
+        storage_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(storage_dir.cleanup)
+
+        bot = RolesBot(config, storage_dir.name, logger=logging.getLogger("Test"))
+        bot.fetch_channel = partial(self.discordMock.mock_fetch_channel, self.discordMock)
+        bot.get_guild = self.discordMock.mock_get_guild
+        guild_bot = bot.guild_bots[self.discordMock.guild.id]
+        self.addCleanup(lambda: guild_bot.storage.timer.cancel())
+
+        return bot, guild_bot
+
+    def reports(self) -> List[str]:
+        return [call.args[0] for call in self.discordMock.channels[self.report_channel_id].send.await_args_list]
+
     async def test_user_joins(self):
         # setup discord server mock
-        discordMock = DiscordMock()
-        discordMock.setup_guild_roles(["Add1", "Add2", "RemoveMe", "RemoveMeToo", "LeaveMe"])
+        self.discordMock.setup_guild_roles(["Add1", "Add2", "RemoveMe", "RemoveMeToo", "LeaveMe"])
 
         # roles source will return given roles to be added and removed
-        roles_source = RolesSourceFake()
-        roles_source.set_user_roles("TestUser", ["Add1", "Add2"], ["RemoveMe", "RemoveMeToo"])
+        self.roles_source.set_user_roles("TestUser", ["Add1", "Add2"], ["RemoveMe", "RemoveMeToo"])
+
+        # Setup bot and emulate user join
+        bot, guild_bot = self.create_bot()
+        member = self.discordMock.setup_member("TestUser", ["RemoveMe", "RemoveMeToo", "LeaveMe"])
+
+        await bot.on_ready()
+        await bot.on_member_join(member)
+        await guild_bot.join_batcher.flush()
+
+        # Assert the bot sent a message to the report channel
+        self.discordMock.channels[self.report_channel_id].send.assert_any_call(
+            "Aktualizacja ról nowego użytkownika TestUser zakończona.\nNadane role:\nAdd1, Add2\nUsunięte role:\nRemoveMe, RemoveMeToo"
+        )
+
+        # Assert roles were correctly removed
+        member.remove_roles.assert_awaited_once_with(
+            *[role for role in self.discordMock.guild.roles if role.name in ["RemoveMe", "RemoveMeToo"]]
+        )
+
+        # Assert roles were correctly added
+        member.add_roles.assert_awaited_once_with(
+            *[role for role in self.discordMock.guild.roles if role.name in ["Add1", "Add2"]]
+        )
+
+    async def test_events_routed_to_guild(self):
+        # two guilds served by one client, ids of the second one do not collide with the first one
+        firstGuildMock = DiscordMock()
+        secondGuildMock = DiscordMock()
+        secondGuildMock.global_id_counter = 1000
+        secondGuildMock.guild.id = secondGuildMock.get_next_id()
+
+        for discordMock in [firstGuildMock, secondGuildMock]:
+            discordMock.setup_guild_roles(["Add1", "Add2"])
 
-        with patch.object(RolesBot, "guilds", new=[discordMock.guild]):
-            # Setup bot and emulate user join
-            report_channel_id = discordMock.add_channel("report_channel")
+        first_roles_source = RolesSourceFake()
+        first_roles_source.set_user_roles("TestUser", ["Add1"], [])
+        second_roles_source = RolesSourceFake()
+        second_roles_source.set_user_roles("TestUser", ["Add2"], [])
 
-            bot = RolesBot(dedicated_channel=report_channel_id, roles_source=roles_source, auto_roles_channels=[], logger=logging.getLogger("Test"))
-            bot.fetch_channel = partial(discordMock.mock_fetch_channel, discordMock)
+        with patch.object(RolesBot, "guilds", new=[firstGuildMock.guild, secondGuildMock.guild]):
+            first_channel_id = firstGuildMock.add_channel("report_channel")
+            second_channel_id = secondGuildMock.add_channel("report_channel")
 
-            member = discordMock.setup_member("TestUser", ["RemoveMe", "RemoveMeToo", "LeaveMe"])
+            configs = [BotConfig(dedicated_channel=first_channel_id, roles_source=first_roles_source, guild_id=firstGuildMock.guild.id),
+                       BotConfig(dedicated_channel=second_channel_id, roles_source=second_roles_source, guild_id=secondGuildMock.guild.id)]
+            storage_dir = tempfile.TemporaryDirectory()
+            self.addCleanup(storage_dir.cleanup)
+
+            bot = RolesBot(configs, storage_dir.name, logger=logging.getLogger("Test"))
+            channels = {**firstGuildMock.channels, **secondGuildMock.channels}
+            bot.fetch_channel = AsyncMock(side_effect=lambda channel_id: channels.get(channel_id))
+            bot.get_guild = lambda guild_id: {firstGuildMock.guild.id: firstGuildMock.guild, secondGuildMock.guild.id: secondGuildMock.guild}.get(guild_id)
+
+            for guild_bot in bot.guild_bots.values():
+                self.addCleanup(lambda guild_bot = guild_bot: guild_bot.storage.timer.cancel())
+
+            member = secondGuildMock.setup_member("TestUser", [])
 
             await bot.on_ready()
             await bot.on_member_join(member)
+            await bot.guild_bots[secondGuildMock.guild.id].join_batcher.flush()
 
-            # Assert the bot sent a message to the report channel
-            discordMock.channels[report_channel_id].send.assert_called_once_with(
-                "Aktualizacja ról nowego użytkownika TestUser zakończona.\nNadane role:\nAdd1, Add2\nUsunięte role:\nRemoveMe, RemoveMeToo"
+            # roles are taken from the second guild's config and reported in its channel only
+            member.add_roles.assert_awaited_once_with(secondGuildMock.roles["Add2"])
+            secondGuildMock.channels[second_channel_id].send.assert_any_call(
+                "Aktualizacja ról nowego użytkownika TestUser zakończona.\nNadane role:\nAdd2"
             )
+            self.assertEqual(bot.guild_bots[firstGuildMock.guild.id].join_batcher.pending(), 0)
 
-            # Assert roles were correctly removed
-            member.remove_roles.assert_awaited_once_with(
-                *[role for role in discordMock.guild.roles if role.name in ["RemoveMe", "RemoveMeToo"]]
-            )
+    async def test_refresh_selectors(self):
+        self.discordMock.setup_guild_roles(["Member", "Other"])
+        bot, guild_bot = self.create_bot()
+        guild = self.discordMock.guild
 
-            # Assert roles were correctly added
-            member.add_roles.assert_awaited_once_with(
-                *[role for role in discordMock.guild.roles if role.name in ["Add1", "Add2"]]
-            )
+        member = self.discordMock.setup_member("MemberUser", ["Member"])
+        other = self.discordMock.setup_member("OtherUser", ["Other"])
+
+        await bot.on_ready()
+
+        # role given after index was built comes with member update event
+        before = MagicMock(spec=discord.Member)
+        before.id = other.id
+        before.guild = guild
+        before.roles = list(other.roles)
+        other.roles = other.roles + [self.discordMock.roles["Member"]]
+        await bot.on_member_update(before, other)
+
+        self.assertEqual(guild_bot._select_members(guild, ["role:Member"]), [member, other])
+        self.assertEqual(guild_bot._select_members(guild, ["role:Other"]), [other])
+        self.assertEqual(guild_bot._select_members(guild, ["joined-since:2000-01-01", str(member.id)]), [member, other])
+        self.assertEqual(guild_bot._select_members(guild, ["joined-since:2999-01-01"]), [])
+
+        with self.assertRaises(ValueError):
+            guild_bot._select_members(guild, ["role:Missing"])
+
+    async def test_unmanageable_roles_skipped(self):
+        self.discordMock.setup_guild_roles(["Add1"], roles_above_bot=["Admin"])
+        self.roles_source.set_user_roles("FirstUser", ["Add1", "Admin"], [])
+        self.roles_source.set_user_roles("SecondUser", ["Admin"], [])
+        bot, guild_bot = self.create_bot()
+
+        first = self.discordMock.setup_member("FirstUser", [])
+        second = self.discordMock.setup_member("SecondUser", [])
+
+        await bot.on_ready()
+        await guild_bot._refresh_roles([first, second])
+
+        # role above bot's one is not requested, and it is reported once for the whole refresh
+        first.add_roles.assert_awaited_once_with(self.discordMock.roles["Add1"])
+        second.add_roles.assert_not_awaited()
+
+        warnings = [report for report in self.reports() if "nie może zarządzać" in report]
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("Admin: 2", warnings[0])
+
+    async def test_failed_id_notification_does_not_stop_batch(self):
+        self.discordMock.setup_guild_roles(["Known"])
+        ids_channel_id = self.discordMock.add_channel("ids_channel")
+        bot, guild_bot = self.create_bot(ids_channel_id=ids_channel_id)
+
+        failing = self.discordMock.setup_member("FailingUser", [])
+        notified = self.discordMock.setup_member("NotifiedUser", [])
+
+        async def send(content: str):
+            if content == str(failing.id):
+                raise discord.HTTPException(MagicMock(status=500, reason="Internal Server Error"), "failure")
+
+            return MagicMock(id=self.discordMock.get_next_id())
+
+        self.discordMock.channels[ids_channel_id].send = AsyncMock(side_effect=send)
+
+        await bot.on_ready()
+        await guild_bot._process_joined_members([failing, notified])
+
+        notified_users = guild_bot.storage.get_config()["unknown_notified_users"]
+        self.assertNotIn(str(failing.id), notified_users)
+        self.assertIn(str(notified.id), notified_users)
+        self.assertIn("Nie udało się wysłać ID", self.reports()[-1])
+
+    async def test_members_leaving_in_burst(self):
+        self.discordMock.setup_guild_roles(["Known"])
+        staying = self.discordMock.setup_member("Staying", ["Known"])
+        leaving = [self.discordMock.setup_member(f"Leaving{index}", ["Known"]) for index in range(3)]
+        regulation, reaction = self.discordMock.add_regulations([staying] + leaving)
+        bot, guild_bot = self.create_bot(server_regulations_message_ids=[regulation])
+
+        # Discord sends reaction removal event for each revoked acceptance, while revoking is still in progress
+        async def remove(user):
+            reaction.reactors.remove(user)
+            payload = MagicMock(channel_id=regulation[0], message_id=regulation[1], guild_id=self.discordMock.guild.id, user_id=user.id, emoji=GuildBot.AcceptanceEmoji)
+            await bot.on_raw_reaction_remove(payload)
+
+        reaction.remove = AsyncMock(side_effect=remove)
+
+        await bot.on_ready()
+        self.assertEqual(guild_bot.members_state.accepted_ids(), {staying.id} | {member.id for member in leaving})
+
+        for member in leaving:
+            self.discordMock.guild.members.remove(member)
+
+        await guild_bot._process_left_members(leaving)
+
+        self.assertEqual(reaction.remove.await_count, len(leaving))
+        self.assertEqual(guild_bot.members_state.accepted_ids(), {staying.id})
+        self.assertEqual(len([report for report in self.reports() if "opuścili serwer (3)" in report]), 1)
+        self.assertEqual([report for report in self.reports() if "odrzucił regulamin" in report], [])
+
+    async def test_other_instance_members_ignored(self):
+        self.discordMock.setup_guild_roles(["Add1", "Known"])
+        self.roles_source.set_user_roles("Mine", ["Add1"], [])
+        self.roles_source.set_user_roles("Other", ["Add1"], [])
+        bot, guild_bot = self.create_bot(shard_count=2, shard=0)
+
+        mine = self.discordMock.setup_member("Mine", [])
+        other = self.discordMock.setup_member("Other", [])
+        mine.id = next(member_id for member_id in range(100, 200) if shard_of(member_id, 2) == 0)
+        other.id = next(member_id for member_id in range(100, 200) if shard_of(member_id, 2) == 1)
+
+        await bot.on_ready()
+        await bot.on_member_join(mine)
+        await bot.on_member_join(other)
+        await guild_bot.join_batcher.flush()
+
+        mine.add_roles.assert_awaited_once()
+        other.add_roles.assert_not_awaited()
+        self.assertEqual([report for report in self.reports() if "Other" in report], [])
+
+        # other instance reports the leave, this one only keeps its state in sync
+        self.discordMock.guild.members.remove(other)
+        await bot.on_member_remove(other)
+        await guild_bot.leave_batcher.flush()
+
+        self.assertEqual(guild_bot.members_state.unknown_ids(), [mine.id])
+        self.assertEqual([report for report in self.reports() if "opuścił" in report], [])
+
+    async def test_plan_and_apply(self):
+        self.discordMock.setup_guild_roles(["Add1", "Known"])
+        bot, guild_bot = self.create_bot()
+        member = self.discordMock.setup_member("TestUser", ["Known"])
+
+        await bot.on_ready()
+        self.roles_source.set_user_roles("TestUser", ["Add1"], [])
+        guild_bot._send_file_to_dedicated_channel = AsyncMock()
+
+        await guild_bot._prepare_plan(self.discordMock.guild, ["refresh"])
+
+        summary, filename, details = guild_bot._send_file_to_dedicated_channel.await_args.args
+        self.assertIn("Plan 'refresh': 1 zmian ról, 0 zmian nicków.\nZapytania do API: 1", summary)
+        self.assertEqual(filename, "plan.txt")
+        self.assertIn("TestUser", details)
+        member.add_roles.assert_not_awaited()
+
+        await guild_bot._apply_pending_plan()
+
+        member.add_roles.assert_awaited_once_with(self.discordMock.roles["Add1"])
+        self.assertIsNone(guild_bot.pending_plan)
+        self.assertIn("Plan 'refresh' wykonany.", self.reports())
+
+        # plan is applied once
+        await guild_bot._apply_pending_plan()
+        self.assertIn("Brak planu do wykonania. Przygotuj go poleceniem 'plan'.", self.reports())
+
+    async def test_plan_set_role_for_unknown_user(self):
+        self.discordMock.setup_guild_roles(["Add1"])
+        bot, guild_bot = self.create_bot()
+        await bot.on_ready()
+
+        for user_id in ["12345", "abc"]:
+            await guild_bot._prepare_plan(self.discordMock.guild, ["set_role", user_id, "1", "Add1"])
+            self.assertIn(f"Nie znaleziono użytkownika o ID: {user_id}", self.reports())
+
+        self.assertIsNone(guild_bot.pending_plan)
+
+    async def reconcile(self, guild_bot: GuildBot):
+        # nothing left nor joined unnoticed, unless test removed members from the list itself
+        self.discordMock.guild.member_count = len(self.discordMock.guild.members)
+        await guild_bot._reconcile_state(self.discordMock.guild, None)
+
+    async def test_reconcile_known_users_changes(self):
+        self.discordMock.setup_guild_roles(["Known"])
+        becoming_unknown = self.discordMock.setup_member("BecomingUnknown", ["Known"])
+        becoming_known = self.discordMock.setup_member("BecomingKnown", [])
+        bot, guild_bot = self.create_bot()
+
+        await bot.on_ready()
+        guild_bot._refresh_roles = AsyncMock()
+
+        await self.reconcile(guild_bot)
+        self.assertEqual(self.reports()[-1], "Stan serwera zgodny ze stanem bota, brak zmian.")
+        guild_bot._refresh_roles.assert_not_awaited()
+
+        # known role given and taken while bot was disconnected
+        becoming_unknown.roles = []
+        becoming_known.roles = [self.discordMock.roles["Known"]]
+        await self.reconcile(guild_bot)
+
+        self.assertEqual(guild_bot.members_state.unknown_ids(), [becoming_unknown.id])
+        self.assertCountEqual(guild_bot._refresh_roles.await_args.args[0], [becoming_unknown, becoming_known])
+        self.assertIn("Zmiany statusu użytkowników (znany/nieznany): 2", self.reports()[-1])
+
+    async def test_reconcile_regulations_reactions(self):
+        self.discordMock.setup_guild_roles(["Known"])
+        accepting = self.discordMock.setup_member("Accepting", ["Known"])
+        rejecting = self.discordMock.setup_member("Rejecting", ["Known"])
+        regulation, reaction = self.discordMock.add_regulations([accepting, rejecting])
+        bot, guild_bot = self.create_bot(server_regulations_message_ids=[regulation])
+
+        await bot.on_ready()
+        guild_bot._refresh_roles = AsyncMock()
+        guild_bot._reset_names = AsyncMock()
+
+        reaction.reactors.remove(rejecting)
+        await self.reconcile(guild_bot)
+
+        self.assertEqual(guild_bot.members_state.accepted_ids(), {accepting.id})
+        guild_bot._refresh_roles.assert_awaited_once_with([rejecting])
+        guild_bot._reset_names.assert_awaited_once_with([rejecting])
+        self.assertIn("Wiadomości regulaminu z niezgodną liczbą reakcji: 1, zmiany akceptacji regulaminu: 1", self.reports()[-1])
+
+        # reaction added and another removed keep the count, so the message is not fetched (refresh fixes it)
+        reaction.reactors = [rejecting]
+        await self.reconcile(guild_bot)
+
+        self.assertEqual(guild_bot.members_state.accepted_ids(), {accepting.id})
+        self.assertEqual(self.reports()[-1], "Stan serwera zgodny ze stanem bota, brak zmian.")
+
+    async def test_reconcile_revokes_acceptances_of_left_users(self):
+        self.discordMock.setup_guild_roles(["Known"])
+        staying = self.discordMock.setup_member("Staying", ["Known"])
+        leaving = self.discordMock.setup_member("Leaving", ["Known"])
+        regulation, reaction = self.discordMock.add_regulations([staying, leaving])
+        reaction.remove = AsyncMock(side_effect=reaction.reactors.remove)
+        bot, guild_bot = self.create_bot(server_regulations_message_ids=[regulation])
+
+        await bot.on_ready()
+
+        # user left while bot was disconnected, so no event came
+        self.discordMock.guild.members.remove(leaving)
+        await self.reconcile(guild_bot)
+
+        reaction.remove.assert_awaited_once_with(leaving)
+        self.assertEqual(reaction.reactors, [staying])
+        self.assertEqual(guild_bot.members_state.accepted_ids(), {staying.id})
+        self.assertIn("Użytkownicy którzy opuścili serwer: 1", self.reports()[-1])
+
+    async def test_reconcile_restores_mismatched_autoroles(self):
+        self.discordMock.setup_guild_roles(["Known", "Add1", "Add2"])
+        having_roles = self.discordMock.setup_member("HavingRoles", ["Known", "Add1"])
+        missing_roles = self.discordMock.setup_member("MissingRoles", ["Known", "Add2"])
+
+        autoroles_channel = self.discordMock.add_channel("autoroles")
+        self.discordMock.add_reacted_message(autoroles_channel, [missing_roles], "Add1")
+        self.discordMock.add_reacted_message(autoroles_channel, [having_roles, missing_roles], "Add2")
+        self.discordMock.guild.fetch_channel = partial(self.discordMock.mock_fetch_channel, None)
+
+        bot, guild_bot = self.create_bot(auto_roles_channels=[autoroles_channel])
+        await bot.on_ready()
+
+        members_of = lambda role: [member for member in self.discordMock.guild.members if role in member.roles]
+        with patch.object(discord.Role, "members", property(members_of)):
+            await self.reconcile(guild_bot)
+
+        # number of reactions under Add1 message matches number of role's members, so it is not looked into
+        having_roles.add_roles.assert_awaited_once_with(self.discordMock.roles["Add2"])
+        missing_roles.add_roles.assert_not_awaited()
+        self.assertIn("Przywrócono role z kanałów autoról użytkownikom: 1", self.reports()[-1])
+
+    async def test_dump_users(self):
+        self.discordMock.setup_guild_roles(["Known", "Zeta", "alpha"])
+        everyone = discord.Role(guild=self.discordMock.guild, state=None, data={"id": self.discordMock.guild.id, "name": "@everyone", "position": 0})
+        not_accepting = self.discordMock.setup_member("Adam", ["Known"])
+        accepting = self.discordMock.setup_member("bob", ["Zeta", "Known", "alpha"])
+        accepting.display_name = "Bob B"
+        accepting.roles.append(everyone)
+        regulation, _ = self.discordMock.add_regulations([accepting])
+        bot, guild_bot = self.create_bot(server_regulations_message_ids=[regulation])
+
+        await bot.on_ready()
+        result = await guild_bot._dump_users(self.discordMock.guild, users_export.ExportFormat.CSV, False, False)
+
+        with open(result.path, "r", encoding="utf-8", newline="") as users_file:
+            rows = list(csv.reader(users_file))[1:]
+
+        # users accepting regulations go first, roles are ordered by position and name, without the default role
+        self.assertEqual(rows, [
+            ["1", str(accepting.id), "bob", "Bob B", "alpha;Known;Zeta"],
+            ["2", str(not_accepting.id), "Adam", "Adam", "Known"],
+        ])
+
+    async def test_dry_run_mass_report_without_history_hint(self):
+        self.discordMock.setup_guild_roles(["Known"])
+        bot, guild_bot = self.create_bot()
+
+        await bot.on_ready()
+        roles_changes = {f"User{index}": (["Known"], []) for index in range(GuildBot.ReportDetailsLimit + 1)}
+        guild_bot._write_to_dedicated_channel = AsyncMock()
+
+        await guild_bot._roles_changes_report(roles_changes)
+        self.assertIn("'history'", guild_bot._write_to_dedicated_channel.await_args.args[0])
+
+        guild_bot.dry_run = True
+        await guild_bot._roles_changes_report(roles_changes)
+        self.assertNotIn("'history'", guild_bot._write_to_dedicated_channel.await_args.args[0])
+
+    async def test_profile_report_name_not_built_from_args(self):
+        self.discordMock.setup_guild_roles(["Known"])
+        bot, guild_bot = self.create_bot()
+
+        await bot.on_ready()
+        guild_bot._execute_command = AsyncMock()
+        guild_bot._send_file_to_dedicated_channel = AsyncMock()
+
+        await guild_bot._profile(MagicMock(), ["../../status", "*/?"])
+
+        guild_bot._execute_command.assert_awaited_once()
+        message, filename, _ = guild_bot._send_file_to_dedicated_channel.await_args.args
+        self.assertIn("../../status */?", message)
+        self.assertRegex(filename, r"^profile-cpu-[0-9]{8}-[0-9]{6}\.txt$")
+
+
+class TestMicroBatcher(unittest.IsolatedAsyncioTestCase):
+    async def test_batch_processed_when_full(self):
+        batches = []
+
+        async def process(batch):
+            batches.append(batch)
+
+        batcher = MicroBatcher(process, 60.0, 3, logging.getLogger("Test"))
+        for item in range(4):
+            batcher.add(item)
+
+        # first batch goes without waiting for delay, the rest waits for more items
+        await asyncio.sleep(0.01)
+        self.assertEqual(batches, [[0, 1, 2]])
+        self.assertEqual(batcher.pending(), 1)
+
+        await batcher.flush()
+        self.assertEqual(batches, [[0, 1, 2], [3]])
+
+    async def test_batch_processed_after_delay(self):
+        batches = []
+
+        async def process(batch):
+            batches.append(batch)
+
+        batcher = MicroBatcher(process, 0.05, 100, logging.getLogger("Test"))
+        batcher.add(1)
+        batcher.add(2)
+
+        await asyncio.sleep(0.01)
+        self.assertEqual(batches, [])
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(batches, [[1, 2]])
+        self.assertEqual(batcher.pending(), 0)
+
+    async def test_failed_batch_does_not_stop_batcher(self):
+        batches = []
+
+        async def process(batch):
+            batches.append(batch)
+            if len(batches) == 1:
+                raise RuntimeError("failure")
+
+        batcher = MicroBatcher(process, 0.01, 1, logging.getLogger("Test"))
+        batcher.add(1)
+        batcher.add(2)
+        await batcher.flush()
+
+        self.assertEqual(batches, [[1], [2]])
+
+
+class TestMemberStateTable(unittest.TestCase):
+    First = (1, 100)
+    Second = (1, 200)
+
+    def test_members_kept_sorted(self):
+        table = MemberStateTable([TestMemberStateTable.First, TestMemberStateTable.Second])
+
+        for member_id in [50, 10, 30, 20, 40]:
+            table.set_known(member_id, False)
+
+        table.set_known(30, False)
+        self.assertEqual(list(table.ids), [10, 20, 30, 40, 50])
+        self.assertEqual(table.unknown_ids(), [10, 20, 30, 40, 50])
+
+        table.set_known(30, True)
+        self.assertTrue(table.is_known(30))
+        self.assertEqual(table.unknown_count(), 4)
+
+        self.assertTrue(table.remove(30))
+        self.assertFalse(table.remove(30))
+        self.assertTrue(table.remove(10))
+        self.assertTrue(table.remove(50))
+        self.assertEqual(list(table.ids), [20, 40])
+        self.assertEqual(table.unknown_ids(), [20, 40])
+        self.assertEqual((len(table.flags), len(table.regulations)), (2, 2))
+
+    def test_default_state_not_stored(self):
+        table = MemberStateTable([TestMemberStateTable.First])
+
+        table.set_known(10, True)
+        self.assertFalse(table.set_regulation(20, TestMemberStateTable.First, False))
+
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.get_flags(10), MemberFlags.Known)
+
+    def test_regulations_acceptance(self):
+        table = MemberStateTable.build([TestMemberStateTable.First, TestMemberStateTable.Second], [30],
+                                       {10: [TestMemberStateTable.First], 20: [TestMemberStateTable.First, TestMemberStateTable.Second]})
+
+        self.assertEqual(table.accepted_ids(), {20})
+        self.assertEqual(table.regulation_ids(TestMemberStateTable.First), {10, 20})
+        self.assertEqual(table.regulation_ids(TestMemberStateTable.Second), {20})
+
+        self.assertTrue(table.set_regulation(10, TestMemberStateTable.Second, True))
+        self.assertFalse(table.set_regulation(10, TestMemberStateTable.Second, True))
+        self.assertTrue(table.is_accepted(10))
+        self.assertTrue(table.set_regulation(20, TestMemberStateTable.First, False))
+        self.assertFalse(table.is_accepted(20))
+        self.assertEqual(table.regulation_ids(TestMemberStateTable.First), {10})
+
+        # acceptance and knowledge are independent
+        self.assertFalse(table.set_regulation(30, TestMemberStateTable.First, True))
+        self.assertTrue(table.set_regulation(30, TestMemberStateTable.Second, True))
+        self.assertEqual(table.get_flags(30), MemberFlags.Accepted)
+        self.assertEqual(table.accepted_count(), 2)
+
+    def test_counters_follow_changes(self):
+        regulations = [TestMemberStateTable.First, TestMemberStateTable.Second]
+        table = MemberStateTable.build(regulations, [1, 2, 3], {2: regulations, 4: regulations, 5: [TestMemberStateTable.First]})
+        self.assertEqual((table.accepted_count(), table.unknown_count()), (2, 3))
+
+        table.set_known(2, True)
+        table.set_known(6, False)
+        table.set_regulation(5, TestMemberStateTable.Second, True)
+        table.set_regulation(4, TestMemberStateTable.First, False)
+        table.set_regulation(4, TestMemberStateTable.First, False)
+        table.remove(1)
+        table.remove(5)
+        table.remove(7)
+
+        self.assertEqual((table.accepted_count(), table.unknown_count()), (1, 2))
+        self.assertEqual(table.accepted_ids(), {2})
+        self.assertEqual(table.unknown_ids(), [3, 6])
+        self.assertEqual(table.accepted_count(), sum(1 for flags in table.flags if flags & MemberFlags.Accepted))
+        self.assertEqual(table.unknown_count(), sum(1 for flags in table.flags if not flags & MemberFlags.Known))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_buckets(self):
+        histogram = Histogram("latency_seconds", "Latency", [0.1, 1.0])
+
+        # bucket bound is inclusive (le)
+        for value in [0.05, 0.1, 0.5, 1.0, 3.0]:
+            histogram.observe(value, route="roles")
+
+        histogram.observe(0.2)
+
+        self.assertEqual(histogram.render(), [
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{route="roles",le="0.1"} 2',
+            'latency_seconds_bucket{route="roles",le="1.0"} 4',
+            'latency_seconds_bucket{route="roles",le="+Inf"} 5',
+            'latency_seconds_sum{route="roles"} 4.65',
+            'latency_seconds_count{route="roles"} 5',
+            'latency_seconds_bucket{le="0.1"} 0',
+            'latency_seconds_bucket{le="1.0"} 1',
+            'latency_seconds_bucket{le="+Inf"} 1',
+            "latency_seconds_sum 0.2",
+            "latency_seconds_count 1",
+        ])
+
+    def test_registry_render(self):
+        registry = MetricsRegistry()
+        registry.metrics = []
+
+        counter = registry.counter("requests_total", "Requests")
+        counter.inc(method="GET", route="/guilds/{id}")
+        counter.inc(2, route="/guilds/{id}", method="GET")
+        counter.inc(name='say "hi"\n')
+        registry.gauge("members", "Members", lambda: 42)
+
+        self.assertEqual(counter.total(), 4)
+        self.assertEqual(registry.render(),
+                         "# HELP requests_total Requests\n"
+                         "# TYPE requests_total counter\n"
+                         'requests_total{method="GET",route="/guilds/{id}"} 3\n'
+                         'requests_total{name="say \\"hi\\"\\n"} 1\n'
+                         "# HELP members Members\n"
+                         "# TYPE members gauge\n"
+                         "members 42\n")
+
+    def test_route_template(self):
+        self.assertEqual(_route_template("/api/v10/guilds/123456789012345678/members/223456789012345678/roles/323456789012345678"),
+                         "/guilds/{id}/members/{id}/roles/{id}")
+        self.assertEqual(_route_template("/api/v9/channels/123456789012345678/messages/223456789012345678/reactions/%E2%9C%85/@me"),
+                         "/channels/{id}/messages/{id}/reactions/%E2%9C%85/@me")
+
+        # short numbers are not ids
+        self.assertEqual(_route_template("/api/v10/guilds/123456789012345678/members?limit=1000"), "/guilds/{id}/members?limit=1000")
+        self.assertEqual(_route_template("/gateway/bot"), "/gateway/bot")
+
+
+class TestRefreshIntervalTuner(unittest.TestCase):
+    def setUp(self):
+        self.tuner = RefreshIntervalTuner(10, 120, logging.getLogger("Test"))
+
+    def test_grows_when_rate_limited(self):
+        self.assertEqual(self.tuner.next_interval(20, RefreshResult(1000, 500, 500, 0.1, 3)), 40)
+        self.assertEqual(self.tuner.next_interval(20, RefreshResult(1000, 500, 500, 1.0, 0)), 40)
+        self.assertIn("Discord ogranicza zapytania", self.tuner.reason)
+
+    def test_grows_when_idle(self):
+        self.assertEqual(self.tuner.next_interval(20, RefreshResult(1000, 0, 0, 0.0, 0)), 30)
+
+    def test_shrinks_when_many_changes(self):
+        self.assertEqual(self.tuner.next_interval(40, RefreshResult(1000, 50, 50, 0.1, 0)), 20)
+
+    def test_keeps_interval_when_few_changes(self):
+        self.assertEqual(self.tuner.next_interval(40, RefreshResult(1000, 5, 5, 0.1, 0)), 40)
+
+    def test_clamped_to_bounds(self):
+        self.assertEqual(self.tuner.next_interval(100, RefreshResult(1000, 500, 500, 0.1, 5)), 120)
+        self.assertEqual(self.tuner.next_interval(120, RefreshResult(1000, 0, 0, 0.0, 0)), 120)
+        self.assertIn("osiągnięto granicę", self.tuner.reason)
+        self.assertEqual(self.tuner.next_interval(15, RefreshResult(1000, 500, 500, 0.1, 0)), 10)
+        self.assertEqual(self.tuner.next_interval(10, RefreshResult(1000, 500, 500, 0.1, 0)), 10)
+
+    def test_invalid_bounds(self):
+        for min_interval, max_interval in [(0, 10), (20, 10)]:
+            with self.assertRaises(ValueError):
+                RefreshIntervalTuner(min_interval, max_interval, logging.getLogger("Test"))
+
+
+class TestJobManager(unittest.IsolatedAsyncioTestCase):
+    async def test_single_flight(self):
+        manager = JobManager(logging.getLogger("Test"))
+        release = asyncio.Event()
+        calls = []
+
+        async def job_function():
+            calls.append(current_job().name)
+            report_progress("stage", 1, 2)
+            await release.wait()
+
+        job, started = manager.start("refresh", job_function)
+        same_job, started_again = manager.start("refresh", job_function)
+        other_job, other_started = manager.start("refresh names", job_function)
+        await asyncio.sleep(0)
+
+        self.assertTrue(started)
+        self.assertFalse(started_again)
+        self.assertIs(same_job, job)
+        self.assertEqual(job.waiting, 1)
+        self.assertTrue(other_started)
+        self.assertEqual(manager.jobs(), [job, other_job])
+        self.assertEqual((job.stage, job.done, job.total), ("stage", 1, 2))
+
+        release.set()
+        await asyncio.gather(job.task, other_job.task)
+
+        self.assertEqual(calls, ["refresh", "refresh names"])
+        self.assertEqual(manager.jobs(), [])
+        self.assertIsNone(current_job())
+
+        _, started = manager.start("refresh", job_function)
+        self.assertTrue(started)
+        await manager.jobs()[0].task
+
+    async def test_failed_job_not_running(self):
+        manager = JobManager(logging.getLogger("Test"))
+
+        async def job_function():
+            raise RuntimeError("failure")
+
+        job, _ = manager.start("refresh", job_function)
+
+        with self.assertRaises(RuntimeError):
+            await job.task
+
+        self.assertEqual(manager.running, {})
+        self.assertIsNone(manager.find(job.id))
+
+    async def test_cancel(self):
+        manager = JobManager(logging.getLogger("Test"))
+        job, _ = manager.start("refresh", lambda: asyncio.sleep(60))
+        await asyncio.sleep(0)
+
+        self.assertTrue(manager.cancel(job.id))
+        self.assertFalse(manager.cancel(job.id + 1))
+
+        with self.assertRaises(asyncio.CancelledError):
+            await job.task
+
+        self.assertEqual(manager.jobs(), [])
+
+
+class TestLoggingPipeline(unittest.TestCase):
+    def record(self, msg: str, *args, level: int = logging.DEBUG, **attributes) -> logging.LogRecord:
+        return logging.makeLogRecord(dict(name="Test", levelno=level, levelname=logging.getLevelName(level), msg=msg, args=args, **attributes))
+
+    def test_sampling(self):
+        sampling = SamplingFilter(rate=2, period=1.0)
+        now = [100.0]
+
+        with patch.object(time, "monotonic", lambda: now[0]):
+            passed = [sampling.filter(self.record("Processing user %r", index)) for index in range(5)]
+            self.assertEqual(passed, [True, True, False, False, False])
+
+            # other templates and records above sampled level are not affected
+            self.assertTrue(sampling.filter(self.record("Other message")))
+            self.assertTrue(all(sampling.filter(self.record("Processing user %r", index, level=logging.INFO)) for index in range(5)))
+
+            now[0] += 1.0
+            record = self.record("Processing user %r", 5)
+            self.assertTrue(sampling.filter(record))
+            self.assertEqual(record.getMessage(), "Processing user 5 [3 similar messages suppressed]")
+
+            # nothing was dropped in the previous window
+            now[0] += 1.0
+            record = self.record("Processing user %r", 6)
+            self.assertTrue(sampling.filter(record))
+            self.assertEqual(record.getMessage(), "Processing user 6")
+
+    def test_json_formatter(self):
+        formatter = JsonFormatter()
+
+        record = self.record("Renaming %s", "Żaneta", level=logging.INFO)
+        line = formatter.format(record)
+        entry = json.loads(line)
+
+        self.assertIn("Żaneta", line)
+        self.assertEqual(entry, {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": "INFO",
+            "logger": "Test",
+            "message": "Renaming Żaneta",
+        })
+
+        try:
+            raise ValueError("boom")
+        except ValueError as error:
+            record = self.record("Refresh failed", level=logging.ERROR, exc_info=(type(error), error, error.__traceback__))
+
+        entry = json.loads(formatter.format(record))
+        self.assertEqual((entry["level"], entry["message"]), ("ERROR", "Refresh failed"))
+        self.assertTrue(entry["exception"].startswith("Traceback (most recent call last):"))
+        self.assertTrue(entry["exception"].endswith("ValueError: boom"))
+        self.assertNotIn("stack", entry)
+
+
+class TestStallDetector(unittest.IsolatedAsyncioTestCase):
+    async def test_blocking_code_found(self):
+        detector = StallDetector(0.2, logging.getLogger("Test"))
+        detector.start()
+        self.addCleanup(detector.stop)
+
+        async def blocking():
+            time.sleep(0.5)
+
+        await asyncio.create_task(blocking(), name="blocking")
+        await asyncio.sleep(StallDetector.CheckInterval * 2)
+
+        self.assertEqual(detector.count, 1)
+        stall = detector.stalls[0]
+        self.assertEqual(stall.task, "blocking (TestStallDetector.test_blocking_code_found.<locals>.blocking)")
+        self.assertIn("in blocking", stall.location())
+        self.assertGreaterEqual(stall.duration, 0.2)
+        self.assertIs(detector.longest, stall)
+
+
+class TestChangeJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def open_journal(self) -> ChangeJournal:
+        journal = ChangeJournal(self.directory.name, logging.getLogger("Test"))
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_history_read_back(self):
+        journal = self.open_journal()
+        journal.record(1, "Żaneta", ChangeJournal.RoleAdded, "Member", "refresh")
+        journal.record(2, "Other", ChangeJournal.RoleAdded, "Member", "refresh")
+        journal.record(1, "Żaneta", ChangeJournal.Nickname, "Żaneta K", "event")
+        journal.record(1, "Żaneta", ChangeJournal.RoleRemoved, "Member", "event")
+
+        history = journal.member_history(1)
+        self.assertEqual([(entry.change, entry.value, entry.source) for entry in history],
+                         [(ChangeJournal.RoleAdded, "Member", "refresh"), (ChangeJournal.Nickname, "Żaneta K", "event"), (ChangeJournal.RoleRemoved, "Member", "event")])
+        self.assertEqual(history[0].member_name, "Żaneta")
+        self.assertEqual([entry.change for entry in journal.member_history(1, "Member")], [ChangeJournal.RoleAdded, ChangeJournal.RoleRemoved])
+        self.assertEqual([entry.member_id for entry in journal.role_history("Member", limit = 2)], [2, 1])
+
+        # indexes are rebuilt from segments when journal is opened again
+        journal.close()
+        reopened = self.open_journal()
+        self.assertEqual(reopened.member_history(1), history)
+
+        reopened.record(2, "Other", ChangeJournal.RoleRemoved, "Member", "event")
+        self.assertEqual([entry.change for entry in reopened.member_history(2)], [ChangeJournal.RoleAdded, ChangeJournal.RoleRemoved])
+
+    def test_segments_rotation(self):
+        with patch.object(ChangeJournal, "SegmentSize", 200), patch.object(ChangeJournal, "SegmentsKept", 2):
+            journal = self.open_journal()
+            for index in range(20):
+                journal.record(1, "User", ChangeJournal.RoleAdded, f"Role{index}", "refresh")
+
+            journal.flush()
+            segments = sorted(glob.glob(os.path.join(self.directory.name, "journal-*.jsonl")))
+            self.assertEqual(len(segments), 2)
+            self.assertTrue(all(os.path.getsize(segment) <= 200 + 100 for segment in segments))
+
+            history = journal.member_history(1, limit = 100)
+            self.assertGreater(len(history), 0)
+            self.assertLess(len(history), 20)
+            self.assertEqual([entry.value for entry in history], [f"Role{index}" for index in range(20 - len(history), 20)])
+            self.assertEqual(journal.members_index[1].typecode, "q")
+            self.assertEqual(len(journal.members_index[1]), len(history))
+            self.assertNotIn("Role0", journal.roles_index)
+            self.assertEqual(journal.role_history("Role0"), [])
+            self.assertEqual([entry.value for entry in journal.role_history("Role19")], ["Role19"])
+
+
+class TestShardCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def create_coordinator(self, shard: int, shard_count: int = 4) -> ShardCoordinator:
+        return ShardCoordinator(os.path.join(self.directory.name, "coordination.db"), shard, shard_count, shard + 1, logging.getLogger("Test"))
+
+    def test_shard_of(self):
+        # all instances have to agree on the split, so it cannot change between runs nor Python versions
+        self.assertEqual([shard_of(member_id, 4) for member_id in (1, 2, 3, 1234567890123)], [3, 0, 2, 0])
+        self.assertTrue(all(shard_of(member_id, 1) == 0 for member_id in range(100)))
+
+        shards = [shard_of(member_id, 4) for member_id in range(1000, 5000)]
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        self.assertTrue(all(800 < shards.count(shard) < 1200 for shard in range(4)))
+
+    def test_orphaned_shards_taken_over(self):
+        first = self.create_coordinator(0)
+        second = self.create_coordinator(1)
+        first._heartbeat()
+        second._heartbeat()
+
+        # instances which have not registered yet are given time to start
+        self.assertEqual(first.owned_shards, {0})
+        self.assertEqual(second.owned_shards, {1})
+
+        first.started -= ShardCoordinator.HeartbeatTimeout
+        second.started -= ShardCoordinator.HeartbeatTimeout
+        first._heartbeat()
+        second._heartbeat()
+
+        # orphaned shard goes to alive[shard % len(alive)]
+        self.assertEqual(first.owned_shards, {0, 2})
+        self.assertEqual(second.owned_shards, {1, 3})
+        self.assertTrue(first.owns(next(member_id for member_id in range(100) if shard_of(member_id, 4) == 2)))
+        self.assertFalse(first.owns(next(member_id for member_id in range(100) if shard_of(member_id, 4) == 3)))
+
+        # silent instance does not get its shard back
+        third = self.create_coordinator(2)
+        with patch.object(time, "time", return_value=time.time() - ShardCoordinator.HeartbeatTimeout - 1):
+            third._heartbeat()
+
+        first._heartbeat()
+        self.assertEqual(first.owned_shards, {0, 2})
+
+        # until it reports again, then with alive shards [0, 1, 2] shard 3 goes to alive[3 % 3]
+        third._heartbeat()
+        first._heartbeat()
+        second._heartbeat()
+        self.assertEqual(first.owned_shards, {0, 3})
+        self.assertEqual(second.owned_shards, {1})
+        self.assertEqual(third.owned_shards, {2})
+
+
+class TestUsersExport(unittest.TestCase):
+    Yesterday = date(2024, 5, 1)
+    Today = date(2024, 5, 2)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_csv_diff(self):
+        users_export.export_users(self.directory.name, TestUsersExport.Yesterday, [
+            (1, 10, "same", "Same", ["Role;With;Separators", "Back\\slash"]),
+            (2, 20, "changed", "Changed", ["Member"]),
+            (3, 30, "removed", "Removed", []),
+        ])
+
+        result = users_export.export_users(self.directory.name, TestUsersExport.Today, [
+            (1, 10, "same", "Same", ["Role;With;Separators", "Back\\slash"]),
+            (2, 20, "changed", "Changed", ["Member", "Known"]),
+            (3, 40, "new", "New", ["Known"]),
+        ], diff = True)
+
+        self.assertEqual(result.users_count, 3)
+        self.assertEqual(result.changed_count, 3)
+        self.assertEqual(result.diff_path, users_export.export_path(self.directory.name, TestUsersExport.Today, users_export.ExportFormat.CSV, False, "-diff"))
+
+        with open(result.diff_path, "r", encoding = "utf-8", newline = "") as diff_file:
+            statuses = {int(row[1]): row[-1] for row in list(csv.reader(diff_file))[1:]}
+
+        self.assertEqual(statuses, {20: "zmieniony", 40: "nowy", 30: "usunięty"})
+        self.assertEqual(users_export.read_users(result.path)[10], ("same", "Same", ("Role;With;Separators", "Back\\slash")))
+
+    def test_diff_without_previous_export(self):
+        result = users_export.export_users(self.directory.name, TestUsersExport.Today, [(1, 10, "user", "User", [])], diff = True)
+
+        self.assertIsNone(result.diff_path)
+        self.assertEqual(result.changed_count, 0)
+
+    def test_jsonl_gzip(self):
+        users_export.export_users(self.directory.name, TestUsersExport.Yesterday, [(1, 10, "user", "User", ["Known"])])
+
+        result = users_export.export_users(self.directory.name, TestUsersExport.Today, [
+            (1, 10, "user", "Użytkownik", ["Known"]),
+            (2, 20, "other", "Other", ["Known", "Member"]),
+        ], users_export.ExportFormat.JSONL, compress = True, diff = True)
+
+        self.assertTrue(result.path.endswith("users-2024-05-02.jsonl.gz"))
+
+        with gzip.open(result.path, "rt", encoding = "utf-8") as users_file:
+            entries = [json.loads(line) for line in users_file]
+
+        self.assertEqual(entries, [
+            {"lp": 1, "id": 10, "login": "user", "display_name": "Użytkownik", "roles": ["Known"]},
+            {"lp": 2, "id": 20, "login": "other", "display_name": "Other", "roles": ["Known", "Member"]},
+        ])
+        self.assertEqual(users_export.read_users(result.path), {10: ("user", "Użytkownik", ("Known",)), 20: ("other", "Other", ("Known", "Member"))})
+
+        # previous day's CSV export is compared with JSONL one
+        with gzip.open(result.diff_path, "rt", encoding = "utf-8") as diff_file:
+            statuses = {entry["id"]: entry["status"] for entry in map(json.loads, diff_file)}
+
+        self.assertEqual(statuses, {10: "zmieniony", 20: "nowy"})
+
+    def test_roles_separator_escaping(self):
+        for roles in [[], ["Known"], ["a;b", "c\\", ""], ["\\;", ";"]]:
+            self.assertEqual(users_export.split_roles(users_export.join_roles(roles)), roles)
+
+
+class TestThreadsKeeper(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.discordMock = DiscordMock()
+        self.discordMock.guild.get_channel_or_thread = lambda channel_id: self.discordMock.channels.get(channel_id)
+        self.client = MagicMock(spec=discord.Client)
+        self.client.get_guild = self.discordMock.mock_get_guild
+        self.notify = AsyncMock()
+
+    def create_keeper(self, thread_ids: List[int]) -> ThreadsKeeper:
+        scheduler = RequestScheduler(100, 100, 0, logging.getLogger("Test"))
+        keeper = ThreadsKeeper(self.client, thread_ids, logging.getLogger("Test"), self.notify, scheduler)
+        keeper.guild_id = self.discordMock.guild.id
+        keeper.started_at = discord.utils.utcnow()
+        return keeper
+
+    async def test_failed_thread_does_not_stop_others(self):
+        failing = self.discordMock.add_channel("failing")
+        working = self.discordMock.add_channel("working")
+        self.discordMock.channels[failing].send.side_effect = discord.HTTPException(MagicMock(status=500, reason="Internal Server Error"), "failure")
+
+        keeper = self.create_keeper([failing, working])
+
+        self.assertEqual(await keeper.touch_all([failing, working]), 1)
+        self.discordMock.channels[working].send.assert_awaited_once_with(".")
+        self.assertIn(failing, keeper.last_touch)
+
+    async def test_bulk_touches_run_concurrently(self):
+        tracker = RouteFake(self.discordMock.guild.id)
+        channels = [ChannelFake(self.discordMock.get_next_id(), tracker) for _ in range(10)]
+        self.discordMock.channels.update({channel.id: channel for channel in channels})
+        keeper = self.create_keeper([channel.id for channel in channels])
+
+        with RequestScheduler.priority(Priority.Bulk):
+            self.assertEqual(await keeper.touch_all([channel.id for channel in channels]), len(channels))
+
+        self.assertEqual(tracker.max_running, ThreadsKeeper.Concurrency)
+
+    async def test_missing_guild_skipped(self):
+        channel_id = self.discordMock.add_channel("channel")
+        keeper = self.create_keeper([channel_id])
+        keeper.guild_id = self.discordMock.get_next_id()
+
+        await keeper._touch_due(discord.utils.utcnow())
+        self.assertEqual(await keeper.touch_all([channel_id]), 0)
+        self.discordMock.channels[channel_id].send.assert_not_awaited()
+
+
+class RouteFake:
+    """
+        Object with a guild and a method standing for a Discord request, tracking how many calls run at once
+    """
+    def __init__(self, guild_id: int):
+        self.guild = MagicMock()
+        self.guild.id = guild_id
+        self.running = 0
+        self.max_running = 0
+
+    async def request(self):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+
+
+class ChannelFake(discord.TextChannel):
+    """
+        Text channel whose send stands for a Discord request, tracking how many sends run at once in all channels
+    """
+    def __init__(self, channel_id: int, tracker: RouteFake):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.tracker = tracker
+
+    async def send(self, content: str):
+        await self.tracker.request()
+        return AsyncMock()
+
+
+class TestRequestScheduler(unittest.IsolatedAsyncioTestCase):
+    def test_wait_stats(self):
+        stats = WaitStats()
+        self.assertEqual(stats.average(), 0.0)
+
+        for wait in [1.0, 3.0, 2.0]:
+            stats.add(wait)
+
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.total, 6.0)
+        self.assertEqual(stats.max, 3.0)
+        self.assertEqual(stats.average(), 2.0)
+
+    async def test_interactive_ahead_of_bulk(self):
+        scheduler = RequestScheduler(100, 1, 0, logging.getLogger("Test"))
+        await scheduler.acquire(Priority.Interactive)           # empty the bucket
+
+        order = []
+
+        async def acquire(priority: Priority):
+            await scheduler.acquire(priority)
+            order.append(priority)
+
+        bulk = asyncio.create_task(acquire(Priority.Bulk))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(acquire(Priority.Interactive))
+        await asyncio.gather(bulk, interactive)
+
+        self.assertEqual(order, [Priority.Interactive, Priority.Bulk])
+        self.assertEqual(scheduler.stats[Priority.Bulk].count, 1)
+        self.assertEqual(scheduler.stats[Priority.Interactive].count, 2)
+
+    async def test_estimate_duration(self):
+        scheduler = RequestScheduler(10, 5, 0, logging.getLogger("Test"))
+
+        # nothing observed yet: budget only
+        self.assertAlmostEqual(scheduler.estimate_duration(20, Priority.Bulk), 1.5)
+        self.assertEqual(scheduler.estimate_duration(5, Priority.Bulk), 0.0)
+
+        # route limits make requests slower than the budget allows
+        scheduler.latency[Priority.Bulk].add(0.5)
+        self.assertAlmostEqual(scheduler.estimate_duration(20, Priority.Bulk), 10.0)
+        self.assertAlmostEqual(scheduler.estimate_duration(20, Priority.Interactive), 1.5)
+
+        with patch.object(RequestScheduler, "BulkInFlightPerRoute", 4):
+            self.assertAlmostEqual(scheduler.estimate_duration(20, Priority.Bulk), 2.5)
+
+    async def test_interactive_reserve(self):
+        scheduler = RequestScheduler(1, 3, 2, logging.getLogger("Test"))
+
+        # bulk request cannot use the last 2 tokens
+        await asyncio.wait_for(scheduler.acquire(Priority.Bulk), 0.1)
+        bulk = asyncio.create_task(scheduler.acquire(Priority.Bulk))
+
+        await asyncio.wait_for(scheduler.acquire(Priority.Interactive), 0.1)
+        await asyncio.wait_for(scheduler.acquire(Priority.Interactive), 0.1)
+        self.assertFalse(bulk.done())
+
+        bulk.cancel()
+
+    async def test_bulk_requests_limited_per_route(self):
+        scheduler = RequestScheduler(1000, 1000, 0, logging.getLogger("Test"))
+        first_guild = RouteFake(1)
+        second_guild = RouteFake(2)
+
+        with RequestScheduler.priority(Priority.Bulk):
+            await asyncio.gather(*(scheduler.call(target.request) for target in [first_guild] * 3 + [second_guild] * 3))
+
+        self.assertEqual(first_guild.max_running, RequestScheduler.BulkInFlightPerRoute)
+        self.assertEqual(second_guild.max_running, RequestScheduler.BulkInFlightPerRoute)
+
+        # interactive requests are not held back
+        await asyncio.gather(*(scheduler.call(first_guild.request) for _ in range(3)))
+        self.assertEqual(first_guild.max_running, 3)
+
+    async def test_bulk_message_requests_limited_per_channel(self):
+        scheduler = RequestScheduler(1000, 1000, 0, logging.getLogger("Test"))
+        tracker = RouteFake(1)
+        channels = [ChannelFake(channel_id, tracker) for channel_id in range(10, 13)]
+
+        with RequestScheduler.priority(Priority.Bulk):
+            await asyncio.gather(*(scheduler.call(channel.send, ".") for channel in channels))
+            self.assertEqual(tracker.max_running, len(channels))
+
+            tracker.max_running = 0
+            await asyncio.gather(*(scheduler.call(channels[0].send, ".") for _ in range(3)))
+            self.assertEqual(tracker.max_running, RequestScheduler.BulkInFlightPerRoute)
+
+    async def test_reactions_removed_through_scheduler(self):
+        users = [MagicMock(id=user_id) for user_id in [1, 2, 3]]
+
+        async def reactors():
+            for user in users:
+                yield user
+
+        reaction = MagicMock(spec=discord.Reaction)
+        reaction.users = reactors
+        message = MagicMock(spec=discord.Message)
+        message.reactions = [reaction]
+        scheduler = MagicMock(spec=RequestScheduler)
+
+        self.assertTrue(await utils.remove_users_reactions(MagicMock(), message, {1, 3}, scheduler))
+        self.assertEqual([call.args for call in scheduler.call.await_args_list], [(reaction.remove, users[0]), (reaction.remove, users[2])])
 
 
 if __name__ == "__main__":
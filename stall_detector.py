@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Deque, List, Optional
+
+
+@dataclass
+class Stall:
+    task: str                           # task running when loop was blocked
+    stack: List[str] = field(default_factory = list)
+    started: datetime = field(default_factory = datetime.now)
+    duration: float = 0.0               # seconds
+
+    def location(self) -> str:
+        """
+            Innermost frame of the blocking code
+        """
+        return self.stack[-1].strip().splitlines()[0] if len(self.stack) > 0 else "unknown location"
+
+
+class StallDetector:
+    """
+        Event loop watchdog.
+
+        A task on the loop ticks every CheckInterval and measures how late it wakes up. A separate thread watches
+        the ticks and, when the loop did not tick for longer than `threshold`, captures stack of the loop thread
+        and the task running there, so the blocking code can be found. Finished stalls are kept for status summary.
+    """
+    CheckInterval = 0.05                # seconds
+    StallsKept = 20
+
+    def __init__(self, threshold: float, logger: logging.Logger):
+        self.threshold = threshold
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.last_tick = time.monotonic()
+        self.pending: Optional[Stall] = None
+        self.stalls: Deque[Stall] = deque(maxlen = StallDetector.StallsKept)
+        self.count = 0
+        self.total_duration = 0.0
+        self.longest: Optional[Stall] = None
+        self.loop = None
+        self.loop_thread_id = None
+        self.ticker = None
+        self.watcher = None
+
+    def start(self):
+        """
+            Start watching currently running loop. Must be called from the loop.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.stopped.clear()
+        self.ticker = self.loop.create_task(self._tick(), name = "stall-detector")
+        self.watcher = threading.Thread(target = self._watch, name = "stall-detector", daemon = True)
+        self.watcher.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.ticker is not None:
+            self.ticker.cancel()
+            self.ticker = None
+
+    async def _tick(self):
+        while True:
+            expected = time.monotonic() + StallDetector.CheckInterval
+            await asyncio.sleep(StallDetector.CheckInterval)
+
+            now = time.monotonic()
+            self.last_tick = now
+            lag = now - expected
+
+            if lag >= self.threshold:
+                self._finish_stall(lag)
+
+    def _watch(self):
+        while not self.stopped.wait(StallDetector.CheckInterval):
+            if not self.loop.is_running():
+                # loop finished without stop() being called
+                return
+
+            if time.monotonic() - self.last_tick < self.threshold:
+                continue
+
+            with self.lock:
+                if self.pending is not None:
+                    continue
+
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = traceback.format_stack(frame) if frame is not None else []
+                stall = Stall(self._describe_task(), stack)
+                self.pending = stall
+
+            self.logger.warning(f"Event loop blocked for over {self.threshold}s in {stall.task}, blocking code:\n{''.join(stack)}")
+
+    def _describe_task(self) -> str:
+        task = asyncio.current_task(self.loop)
+
+        if task is None:
+            return "callback"
+
+        return f"{task.get_name()} ({task.get_coro().__qualname__})"
+
+    def _finish_stall(self, duration: float):
+        with self.lock:
+            # watcher may not notice stalls barely over threshold, they are recorded without stack
+            stall = self.pending if self.pending is not None else Stall("unknown task")
+            self.pending = None
+
+        stall.duration = duration
+        self.stalls.append(stall)
+        self.count += 1
+        self.total_duration += duration
+
+        if self.longest is None or duration > self.longest.duration:
+            self.longest = stall
+
+        self.logger.warning(f"Event loop was blocked for {duration:.2f}s in {stall.task} at {stall.location()}")
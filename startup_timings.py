@@ -0,0 +1,75 @@
+import logging
+import time
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Awaitable, Iterator, List, Optional, TypeVar
+
+from .metrics import Histogram
+
+
+T = TypeVar("T")
+
+
+@dataclass
+class StartupPhase:
+    name: str
+    start: float                        # seconds since startup began
+    duration: Optional[float] = None    # seconds, None while phase is running
+
+    def end(self) -> float:
+        return self.start + (self.duration or 0.0)
+
+
+class StartupTimings:
+    """
+        Durations of startup phases, measured from the beginning of startup.
+
+        Independent phases run concurrently, so they overlap and time to ready is the end of the last phase,
+        not a sum of durations. Finished phases are logged and, if histogram is given, observed with phase label.
+    """
+
+    def __init__(self, logger: logging.Logger, histogram: Optional[Histogram] = None):
+        self.logger = logger
+        self.histogram = histogram
+        self.started = time.perf_counter()
+        self.phases: List[StartupPhase] = []
+
+    def begin(self, name: str) -> StartupPhase:
+        phase = StartupPhase(name, time.perf_counter() - self.started)
+        self.phases.append(phase)
+
+        return phase
+
+    def finish(self, phase: StartupPhase):
+        phase.duration = time.perf_counter() - self.started - phase.start
+        self.logger.info("Startup phase '%s' took %.2fs (started at +%.2fs)", phase.name, phase.duration, phase.start)
+
+        if self.histogram is not None:
+            self.histogram.observe(phase.duration, phase = phase.name)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[StartupPhase]:
+        phase = self.begin(name)
+        try:
+            yield phase
+        finally:
+            self.finish(phase)
+
+    async def measure(self, name: str, awaitable: Awaitable[T]) -> T:
+        with self.phase(name):
+            return await awaitable
+
+    def elapsed(self) -> float:
+        """
+            End of the last finished phase
+        """
+        return max((phase.end() for phase in self.phases if phase.duration is not None), default = 0.0)
+
+    def summary(self) -> str:
+        lines = []
+        for phase in sorted(self.phases, key = lambda phase: phase.start):
+            duration = "w trakcie" if phase.duration is None else f"{phase.duration:.2f}s"
+            lines.append(f"    {phase.name}: od +{phase.start:.2f}s, {duration}\n")
+
+        return "".join(lines)
@@ -0,0 +1,170 @@
+import asyncio
+import discord
+import logging
+
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from . import utils
+from .request_scheduler import Priority, RequestScheduler
+
+
+class ThreadsKeeper:
+    """
+        Keeps threads from being auto archived.
+
+        Each thread is touched (message sent and deleted) shortly before its auto archive deadline,
+        which is calculated from gateway cache (thread's auto_archive_duration and last activity).
+        Regular channels do not archive, they are touched every NonThreadPeriod.
+    """
+    Margin = timedelta(hours = 1)                   # how long before deadline thread is touched (at most)
+    MarginFraction = 0.1                            # margin as a fraction of thread's auto archive duration (for short durations)
+    CheckInterval = timedelta(minutes = 30)         # max time between deadlines recalculations
+    NonThreadPeriod = timedelta(days = 3)
+    TouchesPerMinute = 30
+    Concurrency = 5
+
+    def __init__(self, client: discord.Client, thread_ids: List[int], logger: logging.Logger, notify: Callable[[str], Awaitable[None]], scheduler: RequestScheduler):
+        self.client = client
+        self.scheduler = scheduler
+        self.thread_ids = thread_ids
+        self.logger = logger
+        self.notify = notify
+        self.guild_id = None
+        self.task = None
+        self.started_at = None
+        self.next_touch: Optional[datetime] = None
+        self.last_touch: Dict[int, datetime] = {}
+        self.budget = utils.RateBudget(ThreadsKeeper.TouchesPerMinute, 60)
+        self.semaphore = asyncio.Semaphore(ThreadsKeeper.Concurrency)
+
+    def start(self, guild_id: int):
+        self.guild_id = guild_id
+        self.started_at = discord.utils.utcnow()
+
+        if self.task is None and len(self.thread_ids) > 0:
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def touch_time(self, thread_id: int, now: datetime) -> datetime:
+        """
+            Calculate time when thread should be touched to prevent it from being archived
+        """
+        guild = self.client.get_guild(self.guild_id)
+        channel = guild.get_channel_or_thread(thread_id)
+        last_touch = self.last_touch.get(thread_id)
+
+        if channel is None:
+            # not in cache (most likely archived) - touch it as soon as possible, unless it was tried already
+            return now if last_touch is None else last_touch + ThreadsKeeper.NonThreadPeriod
+
+        if not isinstance(channel, discord.Thread):
+            return (last_touch or self.started_at) + ThreadsKeeper.NonThreadPeriod
+
+        if channel.archived:
+            return now
+
+        activity = [channel.archive_timestamp, channel.created_at, last_touch]
+        if channel.last_message_id is not None:
+            activity.append(discord.utils.snowflake_time(channel.last_message_id))
+
+        last_activity = max(timestamp for timestamp in activity if timestamp is not None)
+        archive_duration = timedelta(minutes = channel.auto_archive_duration)
+        margin = min(ThreadsKeeper.Margin, archive_duration * ThreadsKeeper.MarginFraction)
+
+        return last_activity + archive_duration - margin
+
+    async def touch_all(self, thread_ids: List[int]) -> int:
+        """
+            Touch given threads concurrently, within rate budget. Returns number of successfully touched threads.
+        """
+        results = await asyncio.gather(*[self._touch_limited(thread_id) for thread_id in thread_ids])
+        return sum(1 for result in results if result)
+
+    async def _run(self):
+        with RequestScheduler.priority(Priority.Bulk):
+            await self._keep_alive()
+
+    async def _keep_alive(self):
+        while True:
+            now = discord.utils.utcnow()
+            self.next_touch = now + ThreadsKeeper.CheckInterval
+
+            # keeping threads alive must survive any single failure, it is retried on the next check
+            try:
+                await self._touch_due(now)
+            except Exception:
+                self.logger.exception("Failed to keep threads alive")
+
+            wait = (self.next_touch - discord.utils.utcnow()).total_seconds()
+            await asyncio.sleep(max(wait, 1))
+
+    async def _touch_due(self, now: datetime):
+        if self.client.get_guild(self.guild_id) is None:
+            self.logger.warning(f"Guild {self.guild_id} is not available, threads will be checked later")
+            return
+
+        touch_times = {}
+        for thread_id in self.thread_ids:
+            try:
+                touch_times[thread_id] = self.touch_time(thread_id, now)
+            except Exception:
+                self.logger.exception(f"Could not calculate touch time of thread {thread_id}")
+
+        due = [thread_id for thread_id, touch_time in touch_times.items() if touch_time <= now]
+
+        if len(due) > 0:
+            self.logger.info(f"Touching {len(due)} threads close to auto archive")
+            touched = await self.touch_all(due)
+            self.logger.debug(f"Touched {touched} of {len(due)} threads")
+
+        upcoming = [touch_time for thread_id, touch_time in touch_times.items() if thread_id not in due]
+        self.next_touch = min(upcoming + [self.next_touch])
+
+    async def _touch_limited(self, thread_id: int) -> bool:
+        async with self.semaphore:
+            await self.budget.acquire()
+
+            try:
+                return await self._touch(thread_id)
+            except Exception:
+                self.logger.exception(f"Could not touch thread {thread_id}")
+                return False
+            finally:
+                self.last_touch[thread_id] = discord.utils.utcnow()
+
+    async def _touch(self, thread_id: int) -> bool:
+        guild = self.client.get_guild(self.guild_id)
+
+        if guild is None:
+            self.logger.warning(f"Guild {self.guild_id} is not available, thread {thread_id} not touched")
+            return False
+
+        channel = guild.get_channel_or_thread(thread_id)
+
+        if channel is None:
+            try:
+                channel = await guild.fetch_channel(thread_id)
+            except (discord.errors.NotFound, discord.errors.Forbidden):
+                channel = None
+
+        if channel is None:
+            self.logger.error(f"Could not fetch channel/thread with id {thread_id}")
+            await self.notify(f"Kanał {thread_id} nie istnieje.")
+            return False
+
+        self.logger.debug(f"Pinging channel {channel.name}")
+        try:
+            message: discord.Message = await self.scheduler.call(channel.send, ".")
+        except discord.errors.Forbidden:
+            channel_link = utils.generate_link(self.guild_id, thread_id)
+            await self.notify(f"Brak praw by pingować kanał {channel_link} ({channel.name})")
+            return False
+        else:
+            await self.scheduler.call(message.delete)
+
+        return True
@@ -0,0 +1,196 @@
+import csv
+import gzip
+import json
+import os
+
+from dataclasses import dataclass
+from datetime import date, timedelta
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple
+
+
+class ExportFormat(Enum):
+    CSV = "csv"
+    JSONL = "jsonl"
+
+
+# (index, member id, discord login, display name, role names)
+UserRow = Tuple[int, int, str, str, List[str]]
+
+CsvHeader = ["Lp.", "Discord ID", "Discord login", "Nazwa na serwerze", "Role"]
+DiffStatusColumn = "Zmiana"
+RolesSeparator = ";"                                # in CSV, separator and backslash in role names are escaped with backslash
+
+
+@dataclass
+class ExportResult:
+    path: str
+    users_count: int
+    diff_path: Optional[str] = None                 # None when diff was not requested or there was no previous export
+    changed_count: int = 0
+
+
+def export_path(storage_dir: str, day: date, export_format: ExportFormat, compress: bool, suffix: str = "") -> str:
+    name = f"users-{day.isoformat()}{suffix}.{export_format.value}"
+
+    if compress:
+        name += ".gz"
+
+    return os.path.join(storage_dir, name)
+
+
+def find_previous_export(storage_dir: str, day: date) -> Optional[str]:
+    """
+        Return path to the export made on the day before `day` (in any format), or None if there is none.
+    """
+    previous_day = day - timedelta(days = 1)
+
+    for export_format in ExportFormat:
+        for compress in [False, True]:
+            path = export_path(storage_dir, previous_day, export_format, compress)
+            if os.path.isfile(path):
+                return path
+
+    return None
+
+
+def read_users(path: str) -> Dict[int, Tuple[str, str, Tuple[str, ...]]]:
+    """
+        Read export file (any supported format) into dict: member id -> (login, display name, roles)
+    """
+    users = {}
+
+    with _open_text(path, "r") as users_file:
+        if _format_of(path) == ExportFormat.JSONL:
+            for line in users_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    users[int(entry["id"])] = (entry["login"], entry["display_name"], tuple(entry["roles"]))
+        else:
+            reader = csv.reader(users_file)
+            next(reader, None)                                                          # header
+
+            for row in reader:
+                roles = tuple(split_roles(row[4]))
+                users[int(row[1])] = (row[2], row[3], roles)
+
+    return users
+
+
+def export_users(storage_dir: str, day: date, rows: Iterable[UserRow], export_format: ExportFormat = ExportFormat.CSV, compress: bool = False, diff: bool = False) -> ExportResult:
+    """
+        Write rows to the export file of given format, one by one.
+
+        When `diff` is set and previous day's export exists, an additional file with new, changed and removed users is written in the same pass.
+        Meant to be run in a worker thread.
+    """
+    path = export_path(storage_dir, day, export_format, compress)
+    result = ExportResult(path = path, users_count = 0)
+
+    previous_path = find_previous_export(storage_dir, day) if diff else None
+    previous = read_users(previous_path) if previous_path else None
+
+    with _open_text(path, "w") as users_file:
+        writer = _RowWriter(users_file, export_format)
+
+        if previous is None:
+            for row in rows:
+                writer.write(row)
+                result.users_count += 1
+        else:
+            result.diff_path = export_path(storage_dir, day, export_format, compress, "-diff")
+
+            with _open_text(result.diff_path, "w") as diff_file:
+                diff_writer = _RowWriter(diff_file, export_format, with_status = True)
+
+                for row in rows:
+                    writer.write(row)
+                    result.users_count += 1
+
+                    _, member_id, login, display_name, roles = row
+                    previous_entry = previous.pop(member_id, None)
+
+                    if previous_entry is None:
+                        diff_writer.write(row, "nowy")
+                        result.changed_count += 1
+                    elif previous_entry != (login, display_name, tuple(roles)):
+                        diff_writer.write(row, "zmieniony")
+                        result.changed_count += 1
+
+                # whatever is left in previous export is gone now
+                for member_id, (login, display_name, roles) in previous.items():
+                    diff_writer.write((0, member_id, login, display_name, list(roles)), "usunięty")
+                    result.changed_count += 1
+
+    return result
+
+
+def join_roles(roles: Iterable[str]) -> str:
+    """
+        Join role names into single CSV column, escaping separators in names
+    """
+    return RolesSeparator.join(role.replace("\\", "\\\\").replace(RolesSeparator, "\\" + RolesSeparator) for role in roles)
+
+
+def split_roles(column: str) -> List[str]:
+    """
+        Reverse of join_roles
+    """
+    if not column:
+        return []
+
+    roles = []
+    current = []
+    characters = iter(column)
+
+    for character in characters:
+        if character == "\\":
+            current.append(next(characters, ""))
+        elif character == RolesSeparator:
+            roles.append("".join(current))
+            current = []
+        else:
+            current.append(character)
+
+    roles.append("".join(current))
+    return roles
+
+
+class _RowWriter:
+    def __init__(self, output: TextIO, export_format: ExportFormat, with_status: bool = False):
+        self.output = output
+        self.export_format = export_format
+        self.csv_writer = None
+
+        if export_format == ExportFormat.CSV:
+            self.csv_writer = csv.writer(output)
+            self.csv_writer.writerow(CsvHeader + [DiffStatusColumn] if with_status else CsvHeader)
+
+    def write(self, row: UserRow, status: Optional[str] = None):
+        index, member_id, login, display_name, roles = row
+
+        if self.csv_writer is not None:
+            csv_row = [index, member_id, login, display_name, join_roles(roles)]
+            if status is not None:
+                csv_row.append(status)
+
+            self.csv_writer.writerow(csv_row)
+        else:
+            entry = {"lp": index, "id": member_id, "login": login, "display_name": display_name, "roles": roles}
+            if status is not None:
+                entry["status"] = status
+
+            self.output.write(json.dumps(entry, ensure_ascii = False))
+            self.output.write("\n")
+
+
+def _format_of(path: str) -> ExportFormat:
+    name = path[:-len(".gz")] if path.endswith(".gz") else path
+    return ExportFormat.JSONL if name.endswith(f".{ExportFormat.JSONL.value}") else ExportFormat.CSV
+
+
+def _open_text(path: str, mode: str) -> TextIO:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding = "utf-8", newline = "")
+
+    return open(path, mode, encoding = "utf-8", newline = "")
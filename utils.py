@@ -1,8 +1,13 @@
 
+import asyncio
 import discord
+import time
 
+from collections import deque
 from discord.utils import escape_markdown
-from typing import Union, List
+from typing import Union, List, Set
+
+from .request_scheduler import RequestScheduler
 
 
 async def member_from_union(member_or_id: Union[int, discord.Member], guild: discord.Guild = None, client: discord.Client = None) -> discord.Member:
@@ -58,12 +63,19 @@ async def get_user_status(client: discord.Client, guild: discord.Guild, id: int)
         return True
 
 
-async def remove_user_reactions(guild: discord.Guild, message: discord.Message, member_id: int) -> bool:
+async def remove_user_reactions(guild: discord.Guild, message: discord.Message, member_id: int, scheduler: RequestScheduler) -> bool:
+    return await remove_users_reactions(guild, message, {member_id}, scheduler)
+
+
+async def remove_users_reactions(guild: discord.Guild, message: discord.Message, member_ids: Set[int], scheduler: RequestScheduler) -> bool:
+    """
+        Remove reactions of all given users from message, walking through reactors only once
+    """
     try:
         for reaction in message.reactions:
             async for user in reaction.users():
-                if user.id == member_id:
-                    await reaction.remove(user)
+                if user.id in member_ids:
+                    await scheduler.call(reaction.remove, user)
     except discord.Forbidden as e:
         return False
     except discord.HTTPException as e:
@@ -119,3 +131,27 @@ def _reaction_user_fetch_limit(reaction: discord.Reaction) -> int:
 
 def has_role(member: discord.Member, role_name: str) -> bool:
     return any(role.name == role_name for role in member.roles)
+
+
+class RateBudget:
+    """
+        Allows at most `limit` operations in any `period` seconds long window.
+    """
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.timestamps = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            while len(self.timestamps) > 0 and now - self.timestamps[0] >= self.period:
+                self.timestamps.popleft()
+
+            if len(self.timestamps) >= self.limit:
+                await asyncio.sleep(self.period - (now - self.timestamps[0]))
+                self.timestamps.popleft()
+
+            self.timestamps.append(time.monotonic())